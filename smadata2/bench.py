@@ -0,0 +1,277 @@
+#! /usr/bin/python3
+#
+# smadata2.bench - Micro-benchmarks for the protocol code
+# Copyright (C) 2014 David Gibson <david@gibson.dropbear.id.au>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import sys
+import argparse
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+import timeit
+
+from smadata2 import config, db, download
+from smadata2.inverter import smabluetooth, asyncbluetooth, capture, codec
+from smadata2.inverter import simulator
+from smadata2.inverter.base import HistoricSeries
+
+
+def report(name, seconds, count, unit="frame"):
+    print("%-24s %10.2f us/%s" % (name, seconds / count * 1e6, unit))
+
+
+def crc(args):
+    frames = [os.urandom(size) for size in args.sizes]
+
+    for data in frames:
+        print("%d byte frames:" % len(data))
+        for name, fn in [("crc16", codec.crc16),
+                         ("crc16_reference", codec.crc16_reference)]:
+            t = min(timeit.repeat(lambda: fn(0xffff, data),
+                                  number=args.number, repeat=args.repeat))
+            report("  " + name, t, args.number)
+
+
+def encode(args):
+    from2 = b'\x78\x00\x3f\x10\xfb\x39'
+    to2 = b'\xff' * 6
+    # A spot value request, as sent when polling
+    fields = (0xa0, 0x00, 0x00, 0x00, 0x00)
+    template = codec.FrameTemplate(from2, to2, *fields, 0x200, 0x5100)
+
+    def scratch():
+        payload = codec.encode_6560(from2, to2, *fields, 1, 0x200, 0x5100,
+                                    0x00263f00, 0x004657ff)
+        return codec.encode_ppp(codec.SMA_PROTOCOL_ID, payload)
+
+    def templated():
+        return template.build(1, 0x00263f00, 0x004657ff)
+
+    for name, fn in [("from scratch", scratch), ("template", templated)]:
+        t = min(timeit.repeat(fn, number=args.number, repeat=args.repeat))
+        report(name, t, args.number)
+
+
+class ReplayDecoder(smabluetooth.Connection):
+    """Decode every reply in a capture, as if we'd asked for it"""
+
+    def __init__(self, addr, sock):
+        super(ReplayDecoder, self).__init__(addr, sock)
+        self.replies = 0
+        self.points = 0
+        # Nobody is waiting for any of the replies, so they all go to
+        # subscribers
+        for type_, subtype in smabluetooth.RESPONSES:
+            self.subscribe(type_, subtype, self.replied)
+
+    def replied(self, from2, result):
+        self.replies += 1
+        if isinstance(result, HistoricSeries):
+            self.points += len(result)
+
+
+def replay(args):
+    for fname in args.capture:
+        with open(fname, "rb") as f:
+            conn = capture.replay(f, ReplayDecoder)
+        sock = conn.sock
+        nbytes = len(sock.data)
+
+        start = time.perf_counter()
+        while sock.offset < nbytes:
+            conn.rx()
+        elapsed = time.perf_counter() - start
+
+        print("%s: %d bytes, %d replies, %d historic points in %.3f s"
+              % (fname, nbytes, conn.replies, conn.points, elapsed))
+        if elapsed > 0:
+            print("    %.2f MB/s, %.0f replies/s"
+                  % (nbytes / elapsed / 1e6, conn.replies / elapsed))
+
+
+def decode_file(fname):
+    """Decode the received side of a capture with the bare codec"""
+    with open(fname, "rb") as f:
+        sock = capture.ReplaySocket(f)
+    decoder = codec.Decoder()
+    packets = 0
+    for event in decoder.events(sock.data):
+        if isinstance(event, codec.InnerPacket):
+            packets += 1
+    return len(sock.data), packets
+
+
+def decode(args):
+    fnames = args.capture * args.times
+
+    start = time.perf_counter()
+    if args.processes > 1:
+        with multiprocessing.Pool(args.processes) as pool:
+            results = pool.map(decode_file, fnames)
+    else:
+        results = [decode_file(fname) for fname in fnames]
+    elapsed = time.perf_counter() - start
+
+    nbytes = sum(n for n, packets in results)
+    packets = sum(packets for n, packets in results)
+    print("%d bytes, %d inner packets in %.3f s (%.2f MB/s, %.0f packets/s)"
+          % (nbytes, packets, elapsed, nbytes / elapsed / 1e6,
+             packets / elapsed))
+
+
+class SimulatedInverterConfig(config.SMAData2InverterConfig):
+    """An inverter configuration which connects to a simulator"""
+
+    def __init__(self, index, args):
+        # Each link's first inverter is the master for the others
+        link, first = divmod(index, args.per_link)
+        first = index - first
+        last = min(first + args.per_link, args.inverters)
+        invjson = {
+            "bluetooth": "00:80:25:00:00:%02X" % (link + 1),
+            "serial": 2130000000 + index,
+        }
+        if args.window:
+            invjson["download-window"] = args.window
+            invjson["download-inflight"] = args.inflight
+        super(SimulatedInverterConfig, self).__init__(invjson,
+                                                      "sim%d" % index)
+        self.starttime = int(time.time()) - args.days * simulator.DAY
+        self.simargs = dict(bdaddr=self.bdaddr, serial=2130000000 + first,
+                            slaves=[2130000000 + i
+                                    for i in range(first + 1, last)],
+                            history_days=args.days, latency=args.latency,
+                            loss=args.loss, fragment=args.fragment)
+
+    def connect(self):
+        sock, sim = simulator.simulate_pair(**self.simargs)
+        return smabluetooth.Connection(self.bdaddr, sock)
+
+    async def connect_async(self):
+        sock, sim = simulator.simulate_pair(**self.simargs)
+        return asyncbluetooth.AsyncConnection(self.bdaddr, sock)
+
+
+def simulate(args):
+    ics = [SimulatedInverterConfig(i, args) for i in range(args.inverters)]
+    tmpdir = tempfile.mkdtemp()
+    try:
+        sqlite = db.sqlite.create_or_update(os.path.join(tmpdir, "bench.db"))
+
+        start = time.perf_counter()
+        if args.parallel:
+            results = download.download_inverters_parallel(ics, sqlite)
+        else:
+            results = []
+            for link in download.group_links(ics):
+                if len(link) > 1:
+                    results += download.download_linked(link, sqlite)
+                else:
+                    results.append(download.download_inverter(link[0],
+                                                              sqlite))
+        elapsed = time.perf_counter() - start
+    finally:
+        shutil.rmtree(tmpdir)
+
+    points = 0
+    for ic, result in zip(ics, results):
+        if download.failed(result):
+            print("%s: %s" % (ic.name, result))
+        else:
+            points += sum(len(data) for data in result)
+
+    print("%d inverters, %d points in %.3f s (%.0f points/s)"
+          % (len(ics), points, elapsed, points / elapsed))
+
+
+def argparser():
+    parser = argparse.ArgumentParser(description="Benchmark the SMA"
+                                     " protocol implementation")
+    parser.add_argument("--number", type=int, default=10000,
+                        help="Iterations per timing run")
+    parser.add_argument("--repeat", type=int, default=5,
+                        help="Timing runs (the best is reported)")
+
+    subparsers = parser.add_subparsers()
+
+    help = "Time the PPP frame CRC"
+    parse_crc = subparsers.add_parser("crc", help=help)
+    parse_crc.set_defaults(func=crc)
+    parse_crc.add_argument("sizes", type=int, nargs="*",
+                           default=[32, 96, 255])
+
+    help = "Time building a 6560 request frame"
+    parse_encode = subparsers.add_parser("encode", help=help)
+    parse_encode.set_defaults(func=encode)
+
+    help = "Time decoding of capture files recorded with sma2mon --capture"
+    parse_replay = subparsers.add_parser("replay", help=help)
+    parse_replay.set_defaults(func=replay)
+    parse_replay.add_argument("capture", nargs="+")
+
+    help = "Time the protocol codec alone on capture files"
+    parse_decode = subparsers.add_parser("decode", help=help)
+    parse_decode.set_defaults(func=decode)
+    parse_decode.add_argument("--processes", type=int, default=1,
+                              help="Decode in this many worker processes")
+    parse_decode.add_argument("--times", type=int, default=1,
+                              help="Decode each capture this many times")
+    parse_decode.add_argument("capture", nargs="+")
+
+    help = "Time downloads from simulated inverters"
+    parse_simulate = subparsers.add_parser("simulate", help=help)
+    parse_simulate.set_defaults(func=simulate)
+    parse_simulate.add_argument("--inverters", type=int, default=4)
+    parse_simulate.add_argument("--per-link", type=int, default=1,
+                                help="Inverters reached through each"
+                                " Bluetooth link")
+    parse_simulate.add_argument("--days", type=int, default=30,
+                                help="Days of history on each inverter")
+    parse_simulate.add_argument("--parallel", action="store_true",
+                                help="Download from all inverters at once")
+    parse_simulate.add_argument("--window", type=int,
+                                help="Download in windows of this many"
+                                " seconds")
+    parse_simulate.add_argument("--inflight", type=int, default=4,
+                                help="Windowed requests in flight at once")
+    parse_simulate.add_argument("--latency", type=float, default=0.0,
+                                help="Seconds before each reply")
+    parse_simulate.add_argument("--loss", type=float, default=0.0,
+                                help="Probability of dropping a reply"
+                                " packet")
+    parse_simulate.add_argument("--fragment", type=int,
+                                help="Split the stream into writes of at"
+                                " most this many bytes")
+
+    return parser
+
+
+def main(argv=sys.argv):
+    parser = argparser()
+    args = parser.parse_args(argv[1:])
+
+    if not hasattr(args, "func"):
+        parser.print_help()
+        sys.exit(1)
+
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -19,11 +19,12 @@
 
 import sys
 import os
+import time
 import dateutil.parser
 import dateutil.tz
 import json
 
-from .inverter import smabluetooth
+from .inverter import smabluetooth, asyncbluetooth
 from . import pvoutputorg
 from . import datetimeutil
 from . import db
@@ -40,9 +41,50 @@ class SMAData2InverterConfig(object):
             self.starttime = datetimeutil.parse_time(invjson["start-time"])
         else:
             self.starttime = None
+        # Split fast sample downloads into windows of this many
+        # seconds, with several requests in flight at once
+        self.download_window = invjson.get("download-window", None)
+        self.download_inflight = invjson.get("download-inflight", 4)
+        # If set, record raw traffic to a capture file in this directory
+        self.capture_dir = None
+        # If set, keep this many protocol events in memory, and dump
+        # them to stderr if the connection fails
+        self.trace_size = None
+        # If set, a LinkStats accumulating counters and latencies for
+        # every connection to this inverter
+        self.stats = None
+
+    def open_capture(self):
+        """Create a new capture file in capture_dir
+
+        Never overwrites an earlier capture, however quickly
+        connections follow one another.
+        """
+        now = time.time()
+        stamp = "%s-%06d" % (time.strftime("%Y%m%d-%H%M%S",
+                                           time.localtime(now)),
+                             (now % 1) * 1000000)
+        seq = 0
+        while True:
+            suffix = "-%d" % seq if seq else ""
+            fname = "%s-%s%s.smacap" % (self.serial, stamp, suffix)
+            try:
+                return open(os.path.join(self.capture_dir, fname), "xb")
+            except FileExistsError:
+                seq += 1
+
+    def start_recording(self, conn):
+        if self.capture_dir is not None:
+            conn.start_capture(self.open_capture())
+        if self.trace_size is not None:
+            conn.start_trace(self.trace_size, sys.stderr)
+        if self.stats is not None:
+            conn.stats = self.stats
 
     def connect(self):
-        return smabluetooth.Connection(self.bdaddr)
+        conn = smabluetooth.Connection(self.bdaddr)
+        self.start_recording(conn)
+        return conn
 
     def connect_and_logon(self):
         conn = self.connect()
@@ -50,6 +92,21 @@ class SMAData2InverterConfig(object):
         conn.logon()
         return conn
 
+    async def connect_async(self):
+        conn = await asyncbluetooth.AsyncConnection.open(self.bdaddr)
+        self.start_recording(conn)
+        return conn
+
+    async def connect_and_logon_async(self):
+        conn = await self.connect_async()
+        try:
+            await conn.hello()
+            await conn.logon()
+        except BaseException:
+            conn.close()
+            raise
+        return conn
+
     def __str__(self):
         return ("\t%s:\n" % self.name +
                 "\t\tSerial number: '%s'\n" % self.serial +
@@ -109,10 +166,21 @@ class SMAData2Config(object):
         alljson = json.load(f)
 
         dbname = os.path.expanduser("~/.smadata2.sqlite")
+        # SQLite settings applied each time the database is opened
+        self.dbtuning = {}
         if "database" in alljson:
             dbjson = alljson["database"]
             if "filename" in dbjson:
                 dbname = dbjson["filename"]
+            if dbjson.get("profile") == "wal":
+                self.dbtuning.update(db.sqlite.WAL_PROFILE)
+            elif "profile" in dbjson:
+                raise db.Error("Unknown database profile '%s'"
+                               % dbjson["profile"])
+            for key in ("journal-mode", "synchronous", "cache-size",
+                        "mmap-size", "busy-timeout"):
+                if key in dbjson:
+                    self.dbtuning[key.replace("-", "_")] = dbjson[key]
         self.dbname = os.path.expanduser(dbname)
 
         if "pvoutput.org" in alljson:
@@ -137,7 +205,7 @@ class SMAData2Config(object):
                                self.pvoutput_apikey, system.pvoutput_sid)
 
     def database(self):
-        return db.SQLiteDatabase(self.dbname)
+        return db.SQLiteDatabase(self.dbname, self.dbtuning)
 
 
 if __name__ == '__main__':
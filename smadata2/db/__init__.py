@@ -17,11 +17,11 @@
 # with this program; if not, write to the Free Software Foundation, Inc.,
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
-from .base import WrongSchema
+from .base import Error, WrongSchema
 from .base import SAMPLETYPES, SAMPLE_ADHOC, SAMPLE_INV_FAST, SAMPLE_INV_DAILY
 
 from .sqlite import SQLiteDatabase
 
-__all__ = [WrongSchema,
+__all__ = [Error, WrongSchema,
            SAMPLETYPES, SAMPLE_ADHOC, SAMPLE_INV_FAST, SAMPLE_INV_DAILY,
            SQLiteDatabase]
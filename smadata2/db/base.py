@@ -18,6 +18,7 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
 import abc
+import collections
 
 # Ad hoc samples, externally controlled
 SAMPLE_ADHOC = 0
@@ -31,7 +32,7 @@ SAMPLETYPES = [SAMPLE_ADHOC, SAMPLE_INV_FAST, SAMPLE_INV_DAILY]
 all = ['Error', 'WrongSchema', 'StaleResults',
        'STALE_SECONDS',
        'SAMPLE_ADHOC', 'SAMPLE_INV_FAST', 'SAMPLE_INV_DAILY',
-       'SAMPLETYPES']
+       'SAMPLETYPES', 'UpsertCounts']
 
 
 class Error(Exception):
@@ -49,11 +50,51 @@ class StaleResults(Error):
     pass
 
 
+class UpsertCounts(collections.namedtuple('UpsertCounts',
+                                          'new unchanged conflicting')):
+    """What became of the samples given to upsert_samples()
+
+    new were added, unchanged were already stored with the same
+    value, and conflicting were already stored with a different
+    value, which was kept.
+    """
+    __slots__ = ()
+
+    def __add__(self, other):
+        return UpsertCounts(*(a + b for a, b in zip(self, other)))
+
+
 class BaseDatabase(object, metaclass=abc.ABCMeta):
+    def __init__(self):
+        # Running UpsertCounts from upsert_samples(), by
+        # (serial, sample_type)
+        self.ingested = dict()
+
+    def count_ingested(self, serial, sample_type, counts):
+        key = (serial, sample_type)
+        self.ingested[key] = self.ingested.get(key,
+                                               UpsertCounts(0, 0, 0)) + counts
+        return counts
+
     @abc.abstractmethod
     def add_sample(self, serial, timestamp, sample_type, total_yield):
         raise NotImplementedError()
 
+    @abc.abstractmethod
+    def add_samples(self, serial, sample_type, samples):
+        """Add every (timestamp, total_yield) pair in samples"""
+        raise NotImplementedError()
+
+    @abc.abstractmethod
+    def upsert_samples(self, serial, sample_type, samples):
+        """Add the (timestamp, total_yield) pairs which aren't stored yet
+
+        Samples which are already stored are left alone, whatever
+        their value, so overlapping ranges can safely be stored
+        again.  Returns an UpsertCounts.
+        """
+        raise NotImplementedError()
+
     @abc.abstractmethod
     def get_one_sample(self, serial, timestamp):
         raise NotImplementedError()
@@ -17,38 +17,62 @@
 # with this program; if not, write to the Free Software Foundation, Inc.,
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
-from .base import BaseDatabase
+from .base import BaseDatabase, UpsertCounts, SAMPLE_INV_DAILY
 
 
 class MockDatabase(BaseDatabase):
     def __init__(self):
         super(MockDatabase, self).__init__()
+        # (serial, timestamp, sample_type, total_yield) tuples
         self.samples = set()
 
     def add_sample(self, serial, timestamp, sample_type, total_yield):
-        self.samples.add((serial, timestamp, total_yield))
+        self.samples.add((serial, timestamp, sample_type, total_yield))
+
+    def add_samples(self, serial, sample_type, samples):
+        self.samples.update((serial, timestamp, sample_type, total_yield)
+                            for timestamp, total_yield in samples)
+
+    def upsert_samples(self, serial, sample_type, samples):
+        stored = dict(((s, t, st), y) for s, t, st, y in self.samples)
+        # If a timestamp is given more than once, the last value counts
+        incoming = dict(samples)
+        new = unchanged = conflicting = 0
+        for timestamp, total_yield in incoming.items():
+            key = (serial, timestamp, sample_type)
+            if key not in stored:
+                self.samples.add(key[:3] + (total_yield,))
+                new += 1
+            elif stored[key] == total_yield:
+                unchanged += 1
+            else:
+                conflicting += 1
+        return self.count_ingested(serial, sample_type,
+                                   UpsertCounts(new, unchanged, conflicting))
 
     def get_one_sample(self, serial, timestamp):
-        for s, t, y in self.samples:
+        for s, t, st, y in self.samples:
             if (s == serial) and (t == timestamp):
                 return y
         return None
 
     def get_last_sample(self, serial, sample_type=None):
-        stamps = set(t for s, t, y in self.samples)
+        stamps = set(t for s, t, st, y in self.samples
+                     if (s == serial) and
+                     (sample_type is None or st == sample_type))
         if stamps:
             return max(stamps)
         else:
             return None
 
     def get_aggregate_one_sample(self, ts, ids):
-        vals = set(y for s, t, y in self.samples
+        vals = set(y for s, t, st, y in self.samples
                    if (t == ts) and (s in ids))
         return sum(vals)
 
     def get_aggregate_samples(self, from_ts, to_ts, ids):
         rd = {}
-        for s, t, y in self.samples:
+        for s, t, st, y in self.samples:
             if (s in ids) and (t >= from_ts) and (t < to_ts):
                 if t not in rd:
                     rd[t] = y
@@ -58,3 +82,15 @@ class MockDatabase(BaseDatabase):
         for t in sorted(rd.keys()):
             rl.append((t, rd[t]))
         return rl
+
+    def get_daily_yields(self, from_ts, to_ts, ids):
+        daily = {}
+        for s, t, st, y in self.samples:
+            if ((st == SAMPLE_INV_DAILY) and (s in ids) and
+                    (t >= from_ts) and (t < to_ts)):
+                daily.setdefault(t, {})[s] = y
+        rl = []
+        for t in sorted(daily.keys()):
+            if len(daily[t]) == len(ids):
+                rl.append((t,) + tuple(daily[t][s] for s in ids))
+        return rl
@@ -25,11 +25,12 @@ import datetime
 
 from .. import datetimeutil
 
-from .base import BaseDatabase, WrongSchema, StaleResults
+from .base import Error, BaseDatabase, WrongSchema, StaleResults
+from .base import UpsertCounts
 from .base import STALE_SECONDS
 from .base import SAMPLETYPES, SAMPLE_INV_FAST, SAMPLE_INV_DAILY
 
-all = ['SQLiteDatabase']
+all = ['SQLiteDatabase', 'WAL_PROFILE']
 
 _whitespace = re.compile('\\s+')
 
@@ -42,12 +43,80 @@ def squash_schema(sqls):
 
 
 def sqlite_schema(conn):
+    # Indexes SQLite makes itself, for primary keys, have no sql
     c = conn.cursor()
-    c.execute("SELECT sql FROM sqlite_master WHERE type = 'table'")
+    c.execute("SELECT sql FROM sqlite_master"
+              " WHERE type IN ('table', 'index') AND sql IS NOT NULL")
     sqls = [x[0] for x in c.fetchall()]
     return squash_schema(sqls)
 
 
+# Settings applied with PRAGMA each time the database is opened, and
+# the values each may take (None for any integer)
+TUNING = {
+    "journal_mode": ("delete", "truncate", "persist", "memory", "wal",
+                     "off"),
+    "synchronous": ("off", "normal", "full", "extra"),
+    "cache_size": None,
+    "mmap_size": None,
+    "busy_timeout": None,
+}
+
+# Recommended for a collector: readers aren't blocked by a download in
+# progress, and commits only sync the write-ahead log at checkpoints.
+WAL_PROFILE = {
+    "journal_mode": "wal",
+    "synchronous": "normal",
+    "busy_timeout": 5000,
+}
+
+
+def apply_tuning(conn, tuning):
+    """Apply tuning, a dict of TUNING settings, to an sqlite connection"""
+    for name, value in tuning.items():
+        if name not in TUNING:
+            raise Error("Unknown database setting '%s'" % name)
+        allowed = TUNING[name]
+        if allowed is None:
+            if isinstance(value, bool) or not isinstance(value, int):
+                raise Error("Database setting '%s' must be an integer"
+                            % name)
+        else:
+            value = str(value).lower()
+            if value not in allowed:
+                raise Error("Database setting '%s' must be one of %s"
+                            % (name, ", ".join(allowed)))
+        # PRAGMA values can't be bound as parameters, but they've been
+        # checked above
+        conn.execute("PRAGMA %s = %s" % (name, value)).fetchall()
+
+
+# The primary key leads with inverter_serial, which serves the queries
+# on a range of time for given inverters.  This serves those for one
+# sample type, and covers them so the table itself isn't read.
+INDEXES = [
+    """CREATE INDEX generation_by_type
+              ON generation (sample_type, inverter_serial,
+                             timestamp, total_yield)""",
+]
+
+
+def total_yield_at(ts, res):
+    """Sum the yields from get_yield_at_details(), checking they're fresh"""
+    total = 0
+    for serial, (yield_, timestamp) in res.items():
+        total += yield_
+        stale = ts - timestamp
+        if stale > STALE_SECONDS:
+            msg = "Latest data from inverter {} is at {} ({} days, {} hours stale)"
+            oldtime = datetimeutil.format_time(timestamp)
+            stalehours = round(stale / 60 / 60)
+            raise StaleResults(msg.format(serial, oldtime,
+                                          stalehours // 24,
+                                          stalehours % 24))
+    return total
+
+
 class SQLiteDatabase(BaseDatabase):
     DDL = [
         """CREATE TABLE "generation"
@@ -60,12 +129,17 @@ class SQLiteDatabase(BaseDatabase):
                                 timestamp, sample_type))""",
         """CREATE TABLE pvoutput (sid STRING,
                                   last_datetime_uploaded INTEGER)""",
-    ]
+    ] + INDEXES
 
-    def __init__(self, filename):
+    # INSERT ... ON CONFLICT needs SQLite 3.24
+    UPSERT = sqlite3.sqlite_version_info >= (3, 24, 0)
+
+    def __init__(self, filename, tuning=None):
         super(SQLiteDatabase, self).__init__()
 
         self.conn = sqlite3.connect(filename)
+        if tuning:
+            apply_tuning(self.conn, tuning)
 
         schema = sqlite_schema(self.conn)
         if schema != squash_schema(self.DDL):
@@ -81,6 +155,73 @@ class SQLiteDatabase(BaseDatabase):
                   " VALUES (?, ?, ?, ?);",
                   (serial, timestamp, sample_type, total_yield))
 
+    def add_samples(self, serial, sample_type, samples):
+        """Add every (timestamp, total_yield) pair in samples
+
+        The rows are streamed through a single executemany() in the
+        current transaction, rather than a statement for each, and
+        like add_sample() they are only kept once committed.  Returns
+        the number of rows added.
+        """
+        c = self.conn.cursor()
+        c.executemany("INSERT INTO generation" +
+                      " (inverter_serial, timestamp, sample_type," +
+                      " total_yield) VALUES (?, ?, ?, ?);",
+                      ((serial, timestamp, sample_type, total_yield)
+                       for timestamp, total_yield in samples))
+        return c.rowcount
+
+    def upsert_samples(self, serial, sample_type, samples):
+        """Add the (timestamp, total_yield) pairs which aren't stored yet
+
+        The samples are first loaded into a temporary table, so
+        they can be compared with what's stored, then copied across
+        with INSERT ... ON CONFLICT DO NOTHING, or INSERT OR IGNORE
+        before SQLite 3.24.  If a timestamp is
+        given more than once, the last value counts.
+        """
+        c = self.conn.cursor()
+        c.execute("CREATE TEMP TABLE IF NOT EXISTS incoming"
+                  " (timestamp INTEGER PRIMARY KEY, total_yield INTEGER)")
+        c.execute("DELETE FROM incoming")
+        c.executemany("INSERT OR REPLACE INTO incoming"
+                      " (timestamp, total_yield) VALUES (?, ?)", samples)
+
+        c.execute("SELECT count(*) FROM incoming")
+        total = c.fetchone()[0]
+        c.execute("SELECT count(*) FROM incoming JOIN generation"
+                  " ON generation.timestamp = incoming.timestamp"
+                  " WHERE generation.inverter_serial = ?"
+                  " AND generation.sample_type = ?"
+                  " AND generation.total_yield IS NOT incoming.total_yield",
+                  (serial, sample_type))
+        conflicting = c.fetchone()[0]
+
+        if self.UPSERT:
+            # The WHERE clause is needed for SQLite to parse ON
+            # CONFLICT after a SELECT
+            c.execute("INSERT INTO generation"
+                      " (inverter_serial, timestamp, sample_type,"
+                      " total_yield)"
+                      " SELECT ?, timestamp, ?, total_yield FROM incoming"
+                      " WHERE 1"
+                      " ON CONFLICT (inverter_serial, timestamp, sample_type)"
+                      " DO NOTHING", (serial, sample_type))
+        else:
+            # The same, as the conflict is on the primary key
+            c.execute("INSERT OR IGNORE INTO generation"
+                      " (inverter_serial, timestamp, sample_type,"
+                      " total_yield)"
+                      " SELECT ?, timestamp, ?, total_yield FROM incoming",
+                      (serial, sample_type))
+        new = c.rowcount
+        c.execute("DELETE FROM incoming")
+
+        return self.count_ingested(serial, sample_type,
+                                   UpsertCounts(new,
+                                                total - new - conflicting,
+                                                conflicting))
+
     def get_one_sample(self, serial, timestamp):
         c = self.conn.cursor()
         c.execute("SELECT total_yield FROM generation"
@@ -117,37 +258,65 @@ class SQLiteDatabase(BaseDatabase):
         assert(len(r) == 1)
         return r[0][0]
 
-    def get_yield_at_details(self, ts, ids):
+    # Instants looked up at once by get_yield_at_details_many(), to
+    # stay well inside SQLite's limit on bound parameters
+    YIELD_AT_BATCH = 256
+
+    def get_yield_at_details_many(self, timestamps, ids):
+        """Find each inverter's latest sample before each timestamp
+
+        Returns a list with, for each timestamp, a dict of
+        (total_yield, timestamp) by serial, or None if none of the
+        inverters has a sample before it.  Each sample is found with a
+        seek backwards through the primary key, so the cost doesn't
+        grow with the amount of history.  Where there are samples of
+        several types at that instant, the highest type is used.
+        """
+        timestamps = list(timestamps)
+        ids = list(ids)
+        if not ids:
+            return [None] * len(timestamps)
+
         c = self.conn.cursor()
-        c.execute("SELECT max(total_yield), max(timestamp),"
-                  " inverter_serial FROM generation"
-                  " WHERE inverter_serial IN (" + ",".join("?" * len(ids)) + ")"
-                  " AND timestamp < ?"
-                  " GROUP BY inverter_serial",
-                  tuple(ids) + (ts,))
-        r = c.fetchall()
-        if not r:
-            return None
-        assert(len(r) == len(ids))
-        results = {}
-        for yield_, timestamp, serial in r:
-            results[str(serial)] = (yield_, timestamp)
+        serials = ",".join(["(?)"] * len(ids))
+        found = {}
+        for i in range(0, len(timestamps), self.YIELD_AT_BATCH):
+            batch = timestamps[i:i + self.YIELD_AT_BATCH]
+            instants = ",".join(["(?)"] * len(batch))
+            c.execute("WITH instants (ts) AS (VALUES " + instants + "),"
+                      " serials (serial) AS (VALUES " + serials + ")"
+                      " SELECT instants.ts, generation.inverter_serial,"
+                      " generation.total_yield, generation.timestamp"
+                      " FROM instants CROSS JOIN serials"
+                      " JOIN generation ON generation.rowid ="
+                      " (SELECT rowid FROM generation"
+                      "  WHERE inverter_serial = serials.serial"
+                      "  AND timestamp < instants.ts"
+                      "  ORDER BY timestamp DESC, sample_type DESC"
+                      "  LIMIT 1)",
+                      tuple(batch) + tuple(ids))
+            for ts, serial, yield_, timestamp in c.fetchall():
+                found.setdefault(ts, {})[str(serial)] = (yield_, timestamp)
+
+        results = []
+        for ts in timestamps:
+            r = found.get(ts)
+            assert (r is None) or (len(r) == len(ids))
+            results.append(r)
         return results
 
+    def get_yield_at_details(self, ts, ids):
+        return self.get_yield_at_details_many([ts], ids)[0]
+
+    def get_yield_at_many(self, timestamps, ids):
+        """Total yield of the inverters at each of timestamps"""
+        timestamps = list(timestamps)
+        details = self.get_yield_at_details_many(timestamps, ids)
+        return [total_yield_at(ts, res)
+                for ts, res in zip(timestamps, details)]
+
     def get_yield_at(self, ts, ids):
-        res = self.get_yield_at_details(ts, ids)
-        total = 0
-        for serial, (yield_, timestamp) in res.items():
-            total += yield_
-            stale = ts - timestamp
-            if stale > STALE_SECONDS:
-                msg = "Latest data from inverter {} is at {} ({} days, {} hours stale)"
-                oldtime = datetimeutil.format_time(timestamp)
-                stalehours = round(stale / 60 / 60)
-                raise StaleResults(msg.format(serial, oldtime,
-                                              stalehours // 24,
-                                              stalehours % 24))
-        return total
+        return total_yield_at(ts, self.get_yield_at_details(ts, ids))
 
     def get_daily_yields(self, from_ts, to_ts, ids):
         subqs = []
@@ -350,8 +519,18 @@ def update_v2_3(conn):
     conn.execute("VACUUM")
 
 
+SCHEMA_NOINDEX = squash_schema(SQLiteDatabase.DDL[:-len(INDEXES)])
+
+
+def update_noindex(conn):
+    for sql in INDEXES:
+        conn.execute(sql)
+    conn.commit()
+
+
 _schema_table = {
     SCHEMA_CURRENT: None,
+    SCHEMA_NOINDEX: update_noindex,
     SCHEMA_EMPTY: create_from_empty,
     SCHEMA_V0: update_v0,
     SCHEMA_NOPVO: update_nopvo,
@@ -359,16 +538,16 @@ _schema_table = {
 }
 
 
-def try_open(filename):
+def try_open(filename, tuning=None):
     try:
-        db = SQLiteDatabase(filename)
+        db = SQLiteDatabase(filename, tuning)
         return db
     except WrongSchema:
         return None
 
 
-def create_or_update(filename):
-    db = try_open(filename)
+def create_or_update(filename, tuning=None):
+    db = try_open(filename, tuning)
 
     if db is None:
         bkname = filename + ".bak"
@@ -396,6 +575,6 @@ def create_or_update(filename):
         del conn
 
         # Try again
-        db = try_open(filename)
+        db = try_open(filename, tuning)
 
     return db
@@ -2,6 +2,7 @@
 
 import os
 import os.path
+import collections
 import errno
 import sqlite3
 
@@ -10,7 +11,7 @@ from nose.tools import assert_equals, raises
 import smadata2.db
 import smadata2.db.mock
 from smadata2 import check
-from .base import SAMPLE_ADHOC
+from .base import SAMPLE_ADHOC, SAMPLE_INV_FAST, SAMPLE_INV_DAILY
 
 
 def removef(filename):
@@ -94,6 +95,94 @@ class SimpleChecks(BaseDBChecker):
         vmissing = self.db.get_one_sample(serial, 9999)
         assert vmissing is None
 
+    def test_add_samples(self):
+        serial = "__TEST__"
+
+        samples = [(ts, ts // 30) for ts in range(0, 24*3600, 300)]
+        self.db.add_samples(serial, SAMPLE_ADHOC, iter(samples))
+
+        for ts, y in samples:
+            assert_equals(self.db.get_one_sample(serial, ts), y)
+        assert_equals(self.db.get_last_sample(serial), samples[-1][0])
+
+    def test_add_samples_empty(self):
+        serial = "__TEST__"
+
+        self.db.add_samples(serial, SAMPLE_ADHOC, [])
+        assert self.db.get_last_sample(serial) is None
+
+    def test_upsert_samples(self):
+        serial = "__TEST__"
+
+        self.db.add_samples(serial, SAMPLE_ADHOC,
+                            [(0, 0), (300, 10), (600, 20)])
+        counts = self.db.upsert_samples(serial, SAMPLE_ADHOC,
+                                        [(300, 10), (600, 25),
+                                         (900, 30), (1200, 40)])
+        assert_equals(counts, (2, 1, 1))
+        assert_equals(counts.conflicting, 1)
+
+        # The stored value wins over a conflicting one
+        assert_equals(self.db.get_one_sample(serial, 600), 20)
+        assert_equals(self.db.get_one_sample(serial, 1200), 40)
+        assert_equals(self.db.get_last_sample(serial), 1200)
+
+        # Storing the same range again changes nothing
+        counts = self.db.upsert_samples(serial, SAMPLE_ADHOC,
+                                        [(900, 30), (1200, 40)])
+        assert_equals(counts, (0, 2, 0))
+        assert_equals(self.db.ingested[(serial, SAMPLE_ADHOC)], (2, 3, 1))
+
+    def test_upsert_sample_types(self):
+        serial = "__TEST__"
+
+        self.db.add_samples(serial, SAMPLE_INV_FAST, [(0, 0), (300, 10)])
+        # The same instants, as another type of sample, are new
+        counts = self.db.upsert_samples(serial, SAMPLE_INV_DAILY,
+                                        [(0, 5), (300, 10)])
+        assert_equals(counts, (2, 0, 0))
+
+    def test_upsert_repeated(self):
+        serial = "__TEST__"
+
+        self.db.add_samples(serial, SAMPLE_ADHOC, [(0, 0)])
+        # The last of several values for one instant counts
+        counts = self.db.upsert_samples(serial, SAMPLE_ADHOC,
+                                        [(0, 5), (0, 0), (300, 7),
+                                         (300, 10)])
+        assert_equals(counts, (1, 1, 0))
+        assert_equals(self.db.get_one_sample(serial, 300), 10)
+
+    def test_ingested(self):
+        serials = ("__TEST__1", "__TEST__2")
+
+        assert_equals(self.db.ingested, {})
+        for serial in serials:
+            self.db.upsert_samples(serial, SAMPLE_INV_FAST,
+                                   [(0, 0), (300, 10)])
+        self.db.upsert_samples(serials[0], SAMPLE_INV_FAST,
+                               [(300, 10), (600, 20)])
+        self.db.upsert_samples(serials[0], SAMPLE_INV_DAILY, [])
+        assert_equals(self.db.ingested,
+                      {(serials[0], SAMPLE_INV_FAST): (3, 1, 0),
+                       (serials[1], SAMPLE_INV_FAST): (2, 0, 0),
+                       (serials[0], SAMPLE_INV_DAILY): (0, 0, 0)})
+
+    def test_get_daily_yields(self):
+        serials = ("__TEST__1", "__TEST__2")
+
+        for i, serial in enumerate(serials, 1):
+            self.db.add_samples(serial, SAMPLE_INV_DAILY,
+                                [(d * 86400, i * d) for d in range(5)])
+            self.db.add_samples(serial, SAMPLE_INV_FAST,
+                                [(86400 + 300, 1000)])
+        # Only one inverter has this day
+        self.db.add_sample(serials[0], 5 * 86400, SAMPLE_INV_DAILY, 5)
+
+        assert_equals([tuple(r) for r in
+                       self.db.get_daily_yields(86400, 6 * 86400, serials)],
+                      [(d * 86400, d, 2 * d) for d in range(1, 5)])
+
     def test_get_last_sample_missing(self):
         serial = "__TEST__"
 
@@ -194,6 +283,170 @@ for cset in (SimpleChecks, AggregateChecks):
         globals()[name] = type(name, (cset, db), {})
 
 
+class TestSQLiteNoUpsert(SQLiteDBChecker):
+    """Store samples as with a SQLite older than 3.24"""
+
+    def opendb(self):
+        db = super(TestSQLiteNoUpsert, self).opendb()
+        db.UPSERT = False
+        return db
+
+    test_upsert_samples = SimpleChecks.test_upsert_samples
+    test_upsert_sample_types = SimpleChecks.test_upsert_sample_types
+    test_upsert_repeated = SimpleChecks.test_upsert_repeated
+    test_ingested = SimpleChecks.test_ingested
+
+
+class TestSQLiteTuning(SQLiteDBChecker):
+    def opendb(self):
+        self.prepare_sqlite()
+        tuning = dict(smadata2.db.sqlite.WAL_PROFILE,
+                      cache_size=-4000, mmap_size=1 << 20)
+        return smadata2.db.sqlite.create_or_update(self.dbname, tuning)
+
+    def tearDown(self):
+        self.db.conn.close()
+        removef(self.dbname + "-wal")
+        removef(self.dbname + "-shm")
+        super(TestSQLiteTuning, self).tearDown()
+
+    def pragma(self, name):
+        return self.db.conn.execute("PRAGMA %s" % name).fetchone()[0]
+
+    def test_pragmas(self):
+        assert_equals(self.pragma("journal_mode"), "wal")
+        # NORMAL
+        assert_equals(self.pragma("synchronous"), 1)
+        assert_equals(self.pragma("cache_size"), -4000)
+        assert_equals(self.pragma("busy_timeout"), 5000)
+
+    def test_reopen(self):
+        self.db.conn.close()
+        self.db = smadata2.db.SQLiteDatabase(self.dbname,
+                                             {"synchronous": "FULL"})
+        # WAL mode stays with the file, the rest is per connection
+        assert_equals(self.pragma("journal_mode"), "wal")
+        assert_equals(self.pragma("synchronous"), 2)
+
+    @raises(smadata2.db.Error)
+    def test_bad_value(self):
+        smadata2.db.SQLiteDatabase(self.dbname, {"journal_mode": "fast"})
+
+    @raises(smadata2.db.Error)
+    def test_bad_setting(self):
+        smadata2.db.SQLiteDatabase(self.dbname, {"page_size": 4096})
+
+    @raises(smadata2.db.Error)
+    def test_not_integer(self):
+        smadata2.db.SQLiteDatabase(self.dbname, {"mmap_size": "1; DROP"})
+
+
+class TestSQLiteQueryPlans(SQLiteDBChecker):
+    """Check the queries on a range of samples are all index searches"""
+
+    Inverter = collections.namedtuple('Inverter', 'serial')
+
+    def sample_data(self):
+        self.serials = ("1001", "1002")
+        for serial in self.serials:
+            self.db.add_samples(serial, SAMPLE_INV_FAST,
+                                ((ts, ts // 300)
+                                 for ts in range(0, 7*86400, 300)))
+            self.db.add_samples(serial, SAMPLE_INV_DAILY,
+                                ((ts, ts // 86400)
+                                 for ts in range(0, 7*86400, 86400)))
+        self.db.commit()
+
+    def plans(self, fn, *args):
+        """Query plan details for each SELECT that fn(*args) makes"""
+        sqls = []
+        self.db.conn.set_trace_callback(sqls.append)
+        try:
+            fn(*args)
+        finally:
+            self.db.conn.set_trace_callback(None)
+        return [[row[3] for row in self.db.conn.execute(
+                    "EXPLAIN QUERY PLAN " + sql)]
+                for sql in sqls
+                if sql.lstrip().upper().startswith(("SELECT", "WITH"))]
+
+    def check_no_scan(self, name, *args):
+        plans = self.plans(getattr(self.db, name), *args)
+        assert plans
+        for plan in plans:
+            for detail in plan:
+                assert not detail.startswith("SCAN generation"), plan
+        return plans
+
+    def test_no_scans(self):
+        serials = ("1001", "1002")
+        inv = self.Inverter(serials[0])
+        yield self.check_no_scan, "get_aggregate_samples", 0, 86400, serials
+        yield self.check_no_scan, "get_aggregate_one_sample", 3000, serials
+        yield self.check_no_scan, "get_daily_yields", 0, 7*86400, serials
+        yield self.check_no_scan, "get_last_sample", serials[0]
+        yield (self.check_no_scan, "get_last_sample", serials[0],
+               SAMPLE_INV_DAILY)
+        yield self.check_no_scan, "midnights", [inv]
+        yield self.check_no_scan, "get_productions_younger_than", [inv], 86400
+        yield self.check_no_scan, "get_yield_at_many", [3000, 86400], serials
+
+    def test_by_type(self):
+        for name, args in (("get_daily_yields", (0, 7*86400, self.serials)),
+                           ("get_last_sample",
+                            (self.serials[0], SAMPLE_INV_DAILY))):
+            plan = self.check_no_scan(name, *args)[0]
+            assert "COVERING INDEX generation_by_type" in plan[0], plan
+
+
+class TestSQLiteYieldAt(SQLiteDBChecker):
+    def sample_data(self):
+        self.serials = ("1001", "1002")
+        for i, serial in enumerate(self.serials, 1):
+            self.db.add_samples(serial, SAMPLE_INV_FAST,
+                                ((ts, i * ts // 300)
+                                 for ts in range(3600, 3*86400, 300)))
+        self.db.commit()
+
+    def test_details(self):
+        details = self.db.get_yield_at_details(4000, self.serials)
+        assert_equals(details, {"1001": (13, 3900), "1002": (26, 3900)})
+
+    def test_none(self):
+        assert self.db.get_yield_at_details(3600, self.serials) is None
+
+    def test_no_inverters(self):
+        assert self.db.get_yield_at_details(4000, []) is None
+        assert_equals(self.db.get_yield_at_details_many([4000, 86400], []),
+                      [None, None])
+
+    def test_yield_at(self):
+        assert_equals(self.db.get_yield_at(86400, self.serials),
+                      3 * (86400 - 300) // 300)
+
+    def test_many(self):
+        timestamps = [4000, 86400, 3600, 2*86400 + 1]
+        details = self.db.get_yield_at_details_many(timestamps,
+                                                    self.serials)
+        assert_equals(details, [self.db.get_yield_at_details(ts,
+                                                             self.serials)
+                                for ts in timestamps])
+        assert details[2] is None
+        assert_equals(self.db.get_yield_at_many([4000, 86400],
+                                                self.serials),
+                      [39, 3 * (86400 - 300) // 300])
+
+    def test_many_batches(self):
+        timestamps = range(3601, 3*86400, 30)
+        assert len(timestamps) > self.db.YIELD_AT_BATCH
+        totals = self.db.get_yield_at_many(timestamps, self.serials)
+        assert_equals(totals, [3 * ((ts - 1) // 300) for ts in timestamps])
+
+    @raises(smadata2.db.base.StaleResults)
+    def test_stale(self):
+        self.db.get_yield_at(5*86400, self.serials)
+
+
 #
 # Tests for sqlite schema updating
 #
@@ -282,6 +535,28 @@ CREATE TABLE pvoutput (sid STRING,
         del conn
 
 
+class TestUpdateNoIndex(UpdateSQLiteChecker):
+    def prepopulate(self):
+        conn = sqlite3.connect(self.dbname)
+        for sql in smadata2.db.sqlite.SQLiteDatabase.DDL:
+            if not sql.startswith("CREATE INDEX"):
+                conn.execute(sql)
+        conn.execute("""INSERT INTO generation (inverter_serial, timestamp,
+                                                 sample_type, total_yield)
+                            VALUES (?, ?, ?, ?)""",
+                     self.PRESERVE_RECORD[:2] + (SAMPLE_INV_FAST,) +
+                     self.PRESERVE_RECORD[2:])
+        conn.commit()
+
+        del conn
+
+    def test_indexes(self):
+        names = [row[0] for row in self.db.conn.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'index'"
+            " AND sql IS NOT NULL")]
+        assert_equals(names, ["generation_by_type"])
+
+
 class BadSchemaSQLiteChecker(BaseSQLite):
     def setUp(self):
         self.prepare_sqlite()
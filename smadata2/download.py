@@ -17,32 +17,237 @@
 # with this program; if not, write to the Free Software Foundation, Inc.,
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
+import asyncio
+import collections
 import time
 
 from .db import SAMPLE_INV_FAST, SAMPLE_INV_DAILY
+from .inverter.base import Error, HistoricSeries
 
 
-def download_type(ic, db, sample_type, data_fn):
+def download_range(ic, db, sample_type):
     lasttime = db.get_last_sample(ic.serial, sample_type)
     if lasttime is None:
         lasttime = ic.starttime
 
     now = int(time.time())
 
-    data = data_fn(lasttime + 1, now)
+    return lasttime + 1, now
+
+
+def store_samples(ic, db, sample_type, data):
+    """Store downloaded samples, skipping any already stored
+
+    Returns the UpsertCounts.
+    """
+    return db.upsert_samples(ic.serial, sample_type, data)
+
+
+def download_type(ic, db, sample_type, data_fn):
+    fromtime, totime = download_range(ic, db, sample_type)
+
+    data = data_fn(fromtime, totime)
 
-    for timestamp, total in data:
-        db.add_sample(ic.serial, timestamp, sample_type, total)
+    store_samples(ic, db, sample_type, data)
 
     return data
 
 
+def download_type_windowed(ic, db, sample_type, windows_fn):
+    """Download in windows, committing each one as it completes
+
+    windows_fn(fromtime, totime) must generate (start, end, series)
+    for consecutive windows in time order.  If the download fails
+    part way, everything up to the last complete window is kept, and
+    the next download resumes from there.
+    """
+    fromtime, totime = download_range(ic, db, sample_type)
+
+    data = HistoricSeries()
+    for start, end, series in windows_fn(fromtime, totime):
+        store_samples(ic, db, sample_type, series)
+        db.commit()
+        data.extend(series)
+
+    return data
+
+
+def fast_windows_fn(ic, sma):
+    def windows_fn(fromtime, totime):
+        return sma.historic_pipelined(fromtime, totime,
+                                      ic.download_window,
+                                      ic.download_inflight)
+    return windows_fn
+
+
+def download_connection(ic, db, sma):
+    """Download from an already logged on connection or unit"""
+    if ic.download_window:
+        data = download_type_windowed(ic, db, SAMPLE_INV_FAST,
+                                      fast_windows_fn(ic, sma))
+    else:
+        data = download_type(ic, db, SAMPLE_INV_FAST, sma.historic)
+    data_daily = download_type(ic, db, SAMPLE_INV_DAILY, sma.historic_daily)
+
+    db.commit()
+
+    return (data, data_daily)
+
+
 def download_inverter(ic, db):
     sma = ic.connect_and_logon()
+    try:
+        return download_connection(ic, db, sma)
+    finally:
+        sma.close()
+
+
+def download_linked(ics, db):
+    """Download from several inverters through one Bluetooth link
+
+    ics must all share the Bluetooth address of the master inverter,
+    which relays requests to the others on its piconet.  Returns a
+    list with either the (data, data_daily) tuple or the exception
+    raised for each inverter, in the same order as ics.
+    """
+    sma = ics[0].connect()
+    try:
+        sma.hello()
+        units = {unit.serial: unit
+                 for unit in sma.discover(expect=len(ics))}
+
+        results = []
+        for ic in ics:
+            unit = units.get(int(ic.serial))
+            if unit is None:
+                results.append(Error("Inverter %s did not answer through %s"
+                                     % (ic.serial, ic.bdaddr)))
+                continue
+            try:
+                results.append(download_connection(ic, db, unit))
+            except Exception as e:
+                results.append(e)
+    finally:
+        sma.close()
+
+    return results
 
-    data = download_type(ic, db, SAMPLE_INV_FAST, sma.historic)
-    data_daily = download_type(ic, db, SAMPLE_INV_DAILY, sma.historic_daily)
+
+async def download_type_async(ic, db, sample_type, data_fn):
+    fromtime, totime = download_range(ic, db, sample_type)
+
+    data = await data_fn(fromtime, totime)
+
+    store_samples(ic, db, sample_type, data)
+
+    return data
+
+
+async def download_type_windowed_async(ic, db, sample_type, windows_fn):
+    fromtime, totime = download_range(ic, db, sample_type)
+
+    data = HistoricSeries()
+    async for start, end, series in windows_fn(fromtime, totime):
+        store_samples(ic, db, sample_type, series)
+        db.commit()
+        data.extend(series)
+
+    return data
+
+
+async def download_connection_async(ic, db, sma):
+    """Download from an already logged on async connection"""
+    if ic.download_window:
+        windows_fn = fast_windows_fn(ic, sma)
+        data = await download_type_windowed_async(ic, db, SAMPLE_INV_FAST,
+                                                  windows_fn)
+    else:
+        data = await download_type_async(ic, db, SAMPLE_INV_FAST,
+                                         sma.historic)
+    data_daily = await download_type_async(ic, db, SAMPLE_INV_DAILY,
+                                           sma.historic_daily)
 
     db.commit()
 
     return (data, data_daily)
+
+
+async def download_inverter_async(ic, db):
+    sma = await ic.connect_and_logon_async()
+    try:
+        return await download_connection_async(ic, db, sma)
+    finally:
+        sma.close()
+
+
+async def download_linked_async(ics, db):
+    sma = await ics[0].connect_async()
+    try:
+        await sma.hello()
+        units = {unit.serial: unit
+                 for unit in await sma.discover(expect=len(ics))}
+
+        results = []
+        for ic in ics:
+            unit = units.get(int(ic.serial))
+            if unit is None:
+                results.append(Error("Inverter %s did not answer through %s"
+                                     % (ic.serial, ic.bdaddr)))
+                continue
+            try:
+                results.append(await download_connection_async(ic, db, unit))
+            except Exception as e:
+                results.append(e)
+    finally:
+        sma.close()
+
+    return results
+
+
+def failed(result):
+    """Whether a result from a gather() of inverter operations failed
+
+    Failures are exceptions returned in place of a result.
+    Cancellation and interrupts are raised again, not reported.
+    """
+    if isinstance(result, (asyncio.CancelledError, KeyboardInterrupt,
+                           SystemExit)):
+        raise result
+    return isinstance(result, BaseException)
+
+
+def group_links(ics):
+    """Group inverters by the Bluetooth address they're reached through"""
+    links = collections.OrderedDict()
+    for ic in ics:
+        links.setdefault(ic.bdaddr, []).append(ic)
+    return list(links.values())
+
+
+def download_inverters_parallel(ics, db):
+    """Download from several inverters concurrently
+
+    Inverters sharing a Bluetooth address are downloaded one after
+    another through a single link, with download_linked_async().
+    Returns a list with either the (data, data_daily) tuple or the
+    exception raised for each inverter, in the same order as ics.
+    """
+    async def download_link(link):
+        try:
+            if len(link) == 1:
+                return [await download_inverter_async(link[0], db)]
+            else:
+                return await download_linked_async(link, db)
+        except Exception as e:
+            return [e] * len(link)
+
+    async def download_all(links):
+        return await asyncio.gather(*(download_link(link)
+                                      for link in links))
+
+    links = group_links(ics)
+    results = {}
+    for link, linkresults in zip(links, asyncio.run(download_all(links))):
+        for ic, result in zip(link, linkresults):
+            results[id(ic)] = result
+    return [results[id(ic)] for ic in ics]
@@ -0,0 +1,232 @@
+#! /usr/bin/python3
+#
+# smadata2.inverter.asyncbluetooth - asyncio SMA Bluetooth connections
+# Copyright (C) 2014 David Gibson <david@gibson.dropbear.id.au>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import asyncio
+import collections
+import itertools
+import socket
+
+from . import smabluetooth
+from .smabluetooth import Error
+from .smabluetooth import OTYPE_HELLO, OTYPE_GETVAR, OTYPE_VARVAL, OVAR_SIGNAL
+from .smabluetooth import HELLO_PAYLOAD, PendingOuter
+from .smabluetooth import int2bytes16
+from .smabluetooth import decode_signal, SPOT_AC, SPOT_DC
+from .smabluetooth import historic_windows, Unit
+
+__all__ = ['AsyncConnection']
+
+
+class AsyncConnection(smabluetooth.Connection):
+    """Bluetooth connection to an SMA inverter driven by asyncio
+
+    This offers the same operations as smabluetooth.Connection, but as
+    coroutines using non-blocking sockets, so a single event loop can
+    talk to many inverters at once.  Create one with
+    'await AsyncConnection.open(addr)'.
+    """
+
+    def __init__(self, addr, sock):
+        sock.setblocking(False)
+        super(AsyncConnection, self).__init__(addr, sock)
+        self.txbuf = bytearray()
+
+    @classmethod
+    async def open(cls, addr):
+        loop = asyncio.get_running_loop()
+        sock = socket.socket(socket.AF_BLUETOOTH, socket.SOCK_STREAM,
+                             socket.BTPROTO_RFCOMM)
+        sock.setblocking(False)
+        try:
+            await loop.sock_connect(sock, (addr, 1))
+        except BaseException:
+            sock.close()
+            raise
+        return cls(addr, sock)
+
+    #
+    # Transport
+    #
+
+    def tx_send(self, pkt):
+        self.txbuf += pkt
+
+    async def flush(self):
+        if self.txbuf:
+            data = bytes(self.txbuf)
+            self.txbuf.clear()
+            loop = asyncio.get_running_loop()
+            await loop.sock_sendall(self.sock, data)
+
+    async def rx(self, timeout=None):
+        await self.flush()
+        loop = asyncio.get_running_loop()
+        space = self.rx_space()
+        try:
+            n = await asyncio.wait_for(loop.sock_recv_into(self.sock, space),
+                                       timeout)
+        except asyncio.TimeoutError:
+            return
+        self.rx_adapt(n)
+        self.rx_commit(n)
+
+    async def wait_for(self, pending):
+        try:
+            while not pending.done:
+                await self.rx(self.time_left(pending))
+        except Error as e:
+            self.trace_error(e)
+            raise
+        return pending.result()
+
+    async def collect(self, pending):
+        try:
+            remaining = pending.remaining()
+            while (not pending.done) and (remaining > 0):
+                await self.rx(remaining)
+                remaining = pending.remaining()
+        finally:
+            self.abandon(pending)
+        return pending
+
+    async def wait_outer(self, wtype, wpl=bytearray()):
+        w = PendingOuter(wtype, wpl, self.rtt.rto)
+        self.outer_waiters.append(w)
+        try:
+            return await self.wait_for(w)
+        finally:
+            if w in self.outer_waiters:
+                self.outer_waiters.remove(w)
+
+    async def wait_6560(self, wtag):
+        return await self.wait_for(self.expect_6560(wtag))
+
+    async def wait_6560_multi(self, wtag):
+        return await self.wait_for(self.expect_6560(wtag, multi=True))
+
+    #
+    # Operations
+    #
+
+    async def hello(self):
+        with self.stats.operation("hello"):
+            hellopkt = await self.wait_outer(OTYPE_HELLO)
+            if hellopkt != HELLO_PAYLOAD:
+                raise Error("Unexpected HELLO %r" % hellopkt)
+            self.tx_outer(self.ZERO, self.remote_addr,
+                          OTYPE_HELLO, hellopkt)
+            await self.wait_outer(0x05)
+
+    async def getvar(self, varid):
+        self.tx_outer(self.ZERO, self.remote_addr, OTYPE_GETVAR,
+                      int2bytes16(varid))
+        val = await self.wait_outer(OTYPE_VARVAL, int2bytes16(varid))
+        return val[2:]
+
+    async def getsignal(self):
+        with self.stats.operation("getsignal"):
+            self.stats.signal = decode_signal(
+                await self.getvar(OVAR_SIGNAL))
+        return self.stats.signal
+
+    async def logon(self, password=b'0000', timeout=900):
+        with self.stats.operation("logon"):
+            tag = self.tx_logon(password, timeout)
+            await self.wait_6560(tag)
+
+    async def discover(self, password=b'0000', timeout=900, wait=None,
+                       expect=None):
+        with self.stats.operation("discover"):
+            units = self.expect_units(self.tx_logon(password, timeout),
+                                      wait, expect)
+            await self.collect(units)
+        return [Unit(self, addr2) for addr2 in units.units]
+
+    async def total_yield(self, to2=None):
+        with self.stats.operation("total_yield"):
+            return await self.wait_for(self.request(self.tx_yield,
+                                                    to2=to2))
+
+    async def daily_yield(self, to2=None):
+        with self.stats.operation("daily_yield"):
+            return await self.wait_for(self.request(self.tx_gdy, to2=to2))
+
+    async def historic(self, fromtime, totime, to2=None):
+        with self.stats.operation("historic"):
+            reply = self.request(self.tx_historic, fromtime, totime,
+                                 multi=True, to2=to2, windowed=True)
+            return await self.wait_for(reply)
+
+    async def historic_daily(self, fromtime, totime, to2=None):
+        with self.stats.operation("historic_daily"):
+            reply = self.request(self.tx_historic_daily, fromtime, totime,
+                                 multi=True, to2=to2, windowed=True)
+            return await self.wait_for(reply)
+
+    async def spot(self, subtype, first, last, to2=None):
+        with self.stats.operation("spot"):
+            reply = self.request(self.tx_spot, subtype, first, last,
+                                 multi=True, to2=to2)
+            return await self.wait_for(reply)
+
+    async def spot_values(self, to2=None):
+        with self.stats.operation("spot_values"):
+            replies = [self.request(self.tx_spot, *ranges, multi=True,
+                                    to2=to2)
+                       for ranges in (SPOT_AC, SPOT_DC)]
+            values = {}
+            for reply in replies:
+                values.update(await self.wait_for(reply))
+            return values
+
+    async def historic_pipelined(self, fromtime, totime, window, inflight=4,
+                                 daily=False, to2=None):
+        if daily:
+            txfn = self.tx_historic_daily
+        else:
+            txfn = self.tx_historic
+
+        windows = historic_windows(fromtime, totime, window)
+        queue = collections.deque()
+
+        def submit():
+            for start, end in itertools.islice(windows, 1):
+                reply = self.request(txfn, start, end, multi=True, to2=to2,
+                                     windowed=True)
+                queue.append((start, end, reply))
+
+        for i in range(inflight):
+            submit()
+
+        try:
+            while queue:
+                start, end, reply = queue.popleft()
+                with self.stats.operation("historic_window"):
+                    series = await self.wait_for(reply)
+                submit()
+                yield start, end, series
+        finally:
+            # Don't leave the windows still queued registered, if a
+            # window failed or the caller stopped early
+            for start, end, reply in queue:
+                self.abandon(reply)
+
+    async def set_time(self, newtime, tzoffset, to2=None):
+        self.tx_set_time(newtime, tzoffset, to2)
+        await self.flush()
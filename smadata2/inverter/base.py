@@ -18,15 +18,79 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
 import abc
+from array import array
 
 
-all = ["Error"]
+all = ["Error", "Timeout", "HeaderError", "CRCError", "HistoricSeries"]
 
 
 class Error(Exception):
     pass
 
 
+class Timeout(Error):
+    pass
+
+
+class HeaderError(Error):
+    """A packet or frame header is corrupt"""
+    pass
+
+
+class CRCError(Error):
+    """A PPP frame failed its checksum"""
+    pass
+
+
+# array typecode for unsigned 32-bit values on this platform
+U32 = 'I' if array('I').itemsize == 4 else 'L'
+assert array(U32).itemsize == 4
+
+
+class HistoricSeries(object):
+    """A series of (timestamp, value) samples from an inverter
+
+    Stored as two compact arrays of unsigned 32-bit integers rather
+    than as a list of tuples.  Iterating and indexing still produce
+    (timestamp, value) pairs.
+    """
+    __slots__ = ('timestamps', 'values')
+
+    def __init__(self, timestamps=None, values=None):
+        if timestamps is None:
+            timestamps = array(U32)
+        if values is None:
+            values = array(U32)
+        if len(timestamps) != len(values):
+            raise ValueError("Mismatched timestamp and value columns")
+        self.timestamps = timestamps
+        self.values = values
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def __iter__(self):
+        return zip(self.timestamps, self.values)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return HistoricSeries(self.timestamps[i], self.values[i])
+        return (self.timestamps[i], self.values[i])
+
+    def __eq__(self, other):
+        if isinstance(other, HistoricSeries):
+            return ((self.timestamps == other.timestamps) and
+                    (self.values == other.values))
+        return list(self) == list(other)
+
+    def __repr__(self):
+        return "HistoricSeries(%r)" % list(self)
+
+    def extend(self, other):
+        self.timestamps.extend(other.timestamps)
+        self.values.extend(other.values)
+
+
 class InverterConnection(object, metaclass=abc.ABCMeta):
     @abc.abstractmethod
     def total_yield(self):
@@ -0,0 +1,132 @@
+#! /usr/bin/python3
+#
+# smadata2.inverter.capture - Packet capture and replay
+# Copyright (C) 2014 David Gibson <david@gibson.dropbear.id.au>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import struct
+import time
+
+from .base import Error
+
+__all__ = ['DIR_RX', 'DIR_TX', 'CaptureWriter', 'read_capture',
+           'ReplaySocket']
+
+# File format: MAGIC, then the local and remote Bluetooth addresses
+# (6 bytes each, wire order), then a sequence of records, each a
+# RECORD header followed by the raw outer packet.
+MAGIC = b'SMA2CAP\x01'
+HEADER = struct.Struct('<8s6s6s')
+# Direction, time.monotonic() timestamp, packet length
+RECORD = struct.Struct('<BdH')
+
+DIR_RX = 0
+DIR_TX = 1
+
+
+def _wire2addr(b):
+    return "%02X:%02X:%02X:%02X:%02X:%02X" % tuple(reversed(b))
+
+
+class CaptureWriter(object):
+    """Record raw outer packets to a capture file
+
+    The addresses are given in wire order, as Connection keeps them.
+    """
+
+    def __init__(self, f, local_addr, remote_addr):
+        self.f = f
+        f.write(HEADER.pack(MAGIC, local_addr, remote_addr))
+
+    def record(self, direction, pkt):
+        self.f.write(RECORD.pack(direction, time.monotonic(), len(pkt)))
+        self.f.write(pkt)
+
+    def close(self):
+        self.f.close()
+
+
+def read_header(f):
+    """Read the capture header, returning (local_addr, remote_addr)"""
+    hdr = f.read(HEADER.size)
+    if len(hdr) != HEADER.size:
+        raise Error("Truncated capture file header")
+    magic, local, remote = HEADER.unpack(hdr)
+    if magic != MAGIC:
+        raise Error("Not an SMA capture file")
+    return _wire2addr(local), _wire2addr(remote)
+
+
+def read_capture(f):
+    """Generate (direction, timestamp, packet) for each captured packet
+
+    The file must be positioned just after the header.
+    """
+    while True:
+        hdr = f.read(RECORD.size)
+        if not hdr:
+            return
+        if len(hdr) != RECORD.size:
+            raise Error("Truncated capture record")
+        direction, timestamp, length = RECORD.unpack(hdr)
+        pkt = f.read(length)
+        if len(pkt) != length:
+            raise Error("Truncated capture record")
+        yield direction, timestamp, pkt
+
+
+class ReplaySocket(object):
+    """Stand-in socket which plays back the received side of a capture
+
+    Data is delivered as fast as it is read, so a Connection built on
+    this exercises the whole receive path without any Bluetooth
+    hardware.  Anything sent is discarded.  Once the capture is
+    exhausted reads return nothing, which Connection treats as the
+    connection closing.
+    """
+
+    def __init__(self, f):
+        self.local_addr, self.remote_addr = read_header(f)
+        self.data = memoryview(b''.join(pkt for direction, ts, pkt
+                                        in read_capture(f)
+                                        if direction == DIR_RX))
+        self.offset = 0
+
+    def getsockname(self):
+        return (self.local_addr, 1)
+
+    def settimeout(self, timeout):
+        pass
+
+    def recv_into(self, buf, nbytes=0):
+        if not nbytes:
+            nbytes = len(buf)
+        chunk = self.data[self.offset:self.offset + nbytes]
+        buf[:len(chunk)] = chunk
+        self.offset += len(chunk)
+        return len(chunk)
+
+    def sendall(self, data):
+        pass
+
+    def close(self):
+        pass
+
+
+def replay(f, cls):
+    """Make a cls (a Connection subclass) which replays capture file f"""
+    sock = ReplaySocket(f)
+    return cls(sock.remote_addr, sock)
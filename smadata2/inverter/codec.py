@@ -0,0 +1,514 @@
+#! /usr/bin/python3
+#
+# smadata2.inverter.codec - SMA Bluetooth protocol encoding and decoding
+# Copyright (C) 2014 David Gibson <david@gibson.dropbear.id.au>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+# Nothing here touches a socket: decoding takes bytes and produces
+# events (outer packets, PPP frames and inner protocol packets), and
+# encoding takes request fields and produces bytes.  Connection is
+# built on this, and it can equally decode capture files offline.
+
+import binascii
+import collections
+import struct
+
+from .base import Error, HeaderError, CRCError
+
+__all__ = ['Error', 'Decoder', 'OuterPacket', 'PPPFrame', 'InnerPacket',
+           'check_header', 'decode_outer', 'encode_outer',
+           'ppp_escape', 'encode_ppp', 'ppp_pieces', 'decode_ppp',
+           'decode_6560', 'encode_6560', 'FrameTemplate',
+           'OTYPE_PPP', 'OTYPE_PPP2', 'OTYPE_HELLO', 'OTYPE_GETVAR',
+           'OTYPE_VARVAL', 'OTYPE_ERROR', 'OVAR_SIGNAL', 'SMA_PROTOCOL_ID',
+           'ba2bytes', 'bytes2ba', 'int2bytes16', 'int2bytes32', 'bytes2int',
+           'crc16', 'ppp_unescape']
+
+OUTER_HLEN = 18
+OUTER_MAXLEN = 0x70
+
+OTYPE_PPP = 0x01
+OTYPE_HELLO = 0x02
+OTYPE_GETVAR = 0x03
+OTYPE_VARVAL = 0x04
+OTYPE_ERROR = 0x07
+OTYPE_PPP2 = 0x08
+
+OVAR_SIGNAL = 0x05
+
+HELLO_PAYLOAD = b'\x00\x04\x70\x00\x01\x00\x00\x00\x00\x01\x00\x00\x00'
+
+INNER_HLEN = 36
+
+SMA_PROTOCOL_ID = 0x6560
+
+_u16 = struct.Struct('<H')
+# Outer header: start, length, zero, check byte, from, to, type
+_outer_header = struct.Struct('<BBBB6s6sH')
+assert _outer_header.size == OUTER_HLEN
+# PPP header: address, control, protocol
+_ppp_header = struct.Struct('<BBH')
+PPP_HLEN = _ppp_header.size
+# Inner protocol header: length, A2, to address, B1, B2, from address,
+# C1, C2, error, packet count, tag, type, subtype, arg1, arg2
+_inner_header = struct.Struct('<BB6sBB6sBBHHHHHII')
+assert _inner_header.size == INNER_HLEN
+# Offsets within a PPP frame of the 6560 fields which vary between
+# otherwise identical packets: packet count and tag, arg1 and arg2
+_FRAME_COUNT_TAG = PPP_HLEN + 20
+_FRAME_ARGS = PPP_HLEN + 28
+_count_tag = struct.Struct('<HH')
+_args = struct.Struct('<II')
+
+# Decoded events, one for each layer of the protocol.  Payloads may be
+# views into the decoder's buffers, see Decoder.
+OuterPacket = collections.namedtuple('OuterPacket',
+                                     ['from_', 'to_', 'type_', 'payload'])
+PPPFrame = collections.namedtuple('PPPFrame',
+                                  ['from_', 'protocol', 'payload'])
+# Fields in the same order as Connection.rx_6560()'s arguments
+InnerPacket = collections.namedtuple('InnerPacket',
+                                     ['from2', 'to2', 'a2', 'b1', 'b2',
+                                      'c1', 'c2', 'tag', 'type_', 'subtype',
+                                      'arg1', 'arg2', 'extra', 'response',
+                                      'error', 'pktcount', 'first'])
+
+
+def check_header(hdr):
+    """Validate an outer packet header, returning the packet length"""
+    if len(hdr) < OUTER_HLEN:
+        raise ValueError()
+
+    if hdr[0] != 0x7e:
+        raise HeaderError("Missing packet start marker")
+    if (hdr[1] > OUTER_MAXLEN) or (hdr[2] != 0):
+        raise HeaderError("Bad packet length")
+    if hdr[3] != (hdr[0] ^ hdr[1] ^ hdr[2]):
+        raise HeaderError("Bad header check byte")
+    return hdr[1]
+
+
+def ba2bytes(addr):
+    if len(addr) != 6:
+        raise ValueError("Bad length for bluetooth address")
+    assert len(addr) == 6
+    return "%02X:%02X:%02X:%02X:%02X:%02X" % tuple(reversed(addr))
+
+
+def bytes2ba(s):
+    addr = [int(x, 16) for x in s.split(':')]
+    addr.reverse()
+    if len(addr) != 6:
+        raise ValueError("Bad length for bluetooth address")
+    return bytes(addr)
+
+
+def int2bytes16(v):
+    return bytearray([v & 0xff, v >> 8])
+
+
+def int2bytes32(v):
+    return bytearray([v & 0xff, (v >> 8) & 0xff, (v >> 16) & 0xff, v >> 24])
+
+
+def bytes2int(b):
+    return int.from_bytes(b, 'little')
+
+
+crc16_table = [0x0000, 0x1189, 0x2312, 0x329b, 0x4624, 0x57ad, 0x6536, 0x74bf,
+               0x8c48, 0x9dc1, 0xaf5a, 0xbed3, 0xca6c, 0xdbe5, 0xe97e, 0xf8f7,
+               0x1081, 0x0108, 0x3393, 0x221a, 0x56a5, 0x472c, 0x75b7, 0x643e,
+               0x9cc9, 0x8d40, 0xbfdb, 0xae52, 0xdaed, 0xcb64, 0xf9ff, 0xe876,
+               0x2102, 0x308b, 0x0210, 0x1399, 0x6726, 0x76af, 0x4434, 0x55bd,
+               0xad4a, 0xbcc3, 0x8e58, 0x9fd1, 0xeb6e, 0xfae7, 0xc87c, 0xd9f5,
+               0x3183, 0x200a, 0x1291, 0x0318, 0x77a7, 0x662e, 0x54b5, 0x453c,
+               0xbdcb, 0xac42, 0x9ed9, 0x8f50, 0xfbef, 0xea66, 0xd8fd, 0xc974,
+               0x4204, 0x538d, 0x6116, 0x709f, 0x0420, 0x15a9, 0x2732, 0x36bb,
+               0xce4c, 0xdfc5, 0xed5e, 0xfcd7, 0x8868, 0x99e1, 0xab7a, 0xbaf3,
+               0x5285, 0x430c, 0x7197, 0x601e, 0x14a1, 0x0528, 0x37b3, 0x263a,
+               0xdecd, 0xcf44, 0xfddf, 0xec56, 0x98e9, 0x8960, 0xbbfb, 0xaa72,
+               0x6306, 0x728f, 0x4014, 0x519d, 0x2522, 0x34ab, 0x0630, 0x17b9,
+               0xef4e, 0xfec7, 0xcc5c, 0xddd5, 0xa96a, 0xb8e3, 0x8a78, 0x9bf1,
+               0x7387, 0x620e, 0x5095, 0x411c, 0x35a3, 0x242a, 0x16b1, 0x0738,
+               0xffcf, 0xee46, 0xdcdd, 0xcd54, 0xb9eb, 0xa862, 0x9af9, 0x8b70,
+               0x8408, 0x9581, 0xa71a, 0xb693, 0xc22c, 0xd3a5, 0xe13e, 0xf0b7,
+               0x0840, 0x19c9, 0x2b52, 0x3adb, 0x4e64, 0x5fed, 0x6d76, 0x7cff,
+               0x9489, 0x8500, 0xb79b, 0xa612, 0xd2ad, 0xc324, 0xf1bf, 0xe036,
+               0x18c1, 0x0948, 0x3bd3, 0x2a5a, 0x5ee5, 0x4f6c, 0x7df7, 0x6c7e,
+               0xa50a, 0xb483, 0x8618, 0x9791, 0xe32e, 0xf2a7, 0xc03c, 0xd1b5,
+               0x2942, 0x38cb, 0x0a50, 0x1bd9, 0x6f66, 0x7eef, 0x4c74, 0x5dfd,
+               0xb58b, 0xa402, 0x9699, 0x8710, 0xf3af, 0xe226, 0xd0bd, 0xc134,
+               0x39c3, 0x284a, 0x1ad1, 0x0b58, 0x7fe7, 0x6e6e, 0x5cf5, 0x4d7c,
+               0xc60c, 0xd785, 0xe51e, 0xf497, 0x8028, 0x91a1, 0xa33a, 0xb2b3,
+               0x4a44, 0x5bcd, 0x6956, 0x78df, 0x0c60, 0x1de9, 0x2f72, 0x3efb,
+               0xd68d, 0xc704, 0xf59f, 0xe416, 0x90a9, 0x8120, 0xb3bb, 0xa232,
+               0x5ac5, 0x4b4c, 0x79d7, 0x685e, 0x1ce1, 0x0d68, 0x3ff3, 0x2e7a,
+               0xe70e, 0xf687, 0xc41c, 0xd595, 0xa12a, 0xb0a3, 0x8238, 0x93b1,
+               0x6b46, 0x7acf, 0x4854, 0x59dd, 0x2d62, 0x3ceb, 0x0e70, 0x1ff9,
+               0xf78f, 0xe606, 0xd49d, 0xc514, 0xb1ab, 0xa022, 0x92b9, 0x8330,
+               0x7bc7, 0x6a4e, 0x58d5, 0x495c, 0x3de3, 0x2c6a, 0x1ef1, 0x0f78]
+assert len(crc16_table) == 256
+
+
+def crc16_reference(iv, data):
+    """Straightforward table driven CRC, one byte at a time"""
+    crc = iv
+    for b in data:
+        crc = (crc >> 8) ^ crc16_table[(crc ^ b) & 0xff]
+    return crc ^ 0xffff
+
+
+# Bit reversal of each byte value
+_bitrev8 = bytes(int('{:08b}'.format(i)[::-1], 2) for i in range(256))
+
+
+def _bitrev16(v):
+    return (_bitrev8[v & 0xff] << 8) | _bitrev8[v >> 8]
+
+
+def crc16(iv, data):
+    """PPP frame check sequence (CRC-16/X.25 polynomial)
+
+    binascii.crc_hqx() computes the same CRC polynomial, but MSB
+    first, where PPP is LSB first.  Reversing the bits of every input
+    byte, and of the initial and final CRC values, converts one to the
+    other, which lets the per-byte work happen in C.
+    """
+    crc = binascii.crc_hqx(bytes(data).translate(_bitrev8), _bitrev16(iv))
+    return _bitrev16(crc) ^ 0xffff
+
+
+def ppp_unescape(raw):
+    """Remove PPP escaping from raw (without the flag bytes)
+
+    Splits on the escape byte once, rather than examining every byte
+    in Python.
+    """
+    pieces = bytes(raw).split(b'\x7d')
+    if len(pieces) == 1:
+        return pieces[0]
+
+    frame = bytearray(pieces[0])
+    for piece in pieces[1:]:
+        if not piece:
+            raise Error("Bad escape sequence in PPP frame")
+        frame.append(piece[0] ^ 0x20)
+        frame += piece[1:]
+    return frame
+
+
+#
+# Outer packets
+#
+
+def decode_outer(pkt):
+    """Split a complete outer packet into an OuterPacket
+
+    Addresses are left as bytes, in wire order; ba2bytes() formats
+    them for display.
+    """
+    from_, to_, type_ = _outer_header.unpack_from(pkt)[4:]
+    return OuterPacket(from_, to_, type_, pkt[OUTER_HLEN:])
+
+
+def encode_outer(from_, to_, type_, payload, buf=None):
+    """Build an outer packet, between addresses in wire order
+
+    If buf is given the packet is built in it, and a view of the
+    packet returned, otherwise a new bytearray is returned.
+    """
+    pktlen = len(payload) + OUTER_HLEN
+    if pktlen > OUTER_MAXLEN:
+        raise Error("Outer packet too long (%d bytes)" % pktlen)
+    if buf is None:
+        buf = pkt = bytearray(pktlen)
+    else:
+        pkt = memoryview(buf)[:pktlen]
+    _outer_header.pack_into(buf, 0, 0x7e, pktlen, 0x00, pktlen ^ 0x7e,
+                            from_, to_, type_)
+    pkt[OUTER_HLEN:] = payload
+    return pkt
+
+
+#
+# PPP frames
+#
+
+def ppp_escape(frame):
+    """Escape 0x7e (FLAG), 0x7d (ESCAPE), 0x11 (XON) and 0x13 (XOFF)
+
+    One pass over the frame per escaped byte value, each done in C,
+    rather than one Python step per byte.  ESCAPE itself must go
+    first, so the escapes added for the others aren't escaped again.
+    """
+    return (frame.replace(b'\x7d', b'\x7d\x5d')
+            .replace(b'\x7e', b'\x7d\x5e')
+            .replace(b'\x11', b'\x7d\x31')
+            .replace(b'\x13', b'\x7d\x33'))
+
+
+def _ppp_raw(frame):
+    raw = bytearray(b'\x7e')
+    raw += ppp_escape(frame)
+    raw.append(0x7e)
+    return raw
+
+
+def encode_ppp(protocol, payload):
+    """Build an escaped PPP frame, including both flag bytes"""
+    end = PPP_HLEN + len(payload)
+    frame = bytearray(end + 2)
+    _ppp_header.pack_into(frame, 0, 0xff, 0x03, protocol)
+    frame[PPP_HLEN:end] = payload
+    with memoryview(frame) as mv:
+        _u16.pack_into(frame, end, crc16(0xffff, mv[:end]))
+    return _ppp_raw(frame)
+
+
+def ppp_pieces(raw):
+    """Generate (outer type, payload) for the packets carrying raw
+
+    Long frames are split across several outer packets, all but the
+    last of type PPP2.
+    """
+    maxpiece = OUTER_MAXLEN - OUTER_HLEN
+    raw = memoryview(raw)
+    while len(raw) > maxpiece:
+        yield OTYPE_PPP2, raw[:maxpiece]
+        raw = raw[maxpiece:]
+    yield OTYPE_PPP, raw
+
+
+def decode_ppp(raw):
+    """Check a PPP frame (without flag bytes), returning (protocol, payload)"""
+    frame = memoryview(ppp_unescape(raw))
+    if (len(frame) < 6) or (frame[0] != 0xff) or (frame[1] != 0x03):
+        raise HeaderError("Bad header on PPP frame")
+
+    pcrc = _u16.unpack_from(frame, len(frame) - 2)[0]
+    ccrc = crc16(0xffff, frame[:-2])
+    if pcrc != ccrc:
+        raise CRCError("Bad CRC on PPP frame")
+
+    protocol = _u16.unpack_from(frame, 2)[0]
+    return protocol, frame[4:-2]
+
+
+#
+# Inner (6560) protocol
+#
+
+def decode_6560(payload):
+    """Parse an inner protocol packet into an InnerPacket"""
+    if len(payload) < INNER_HLEN:
+        raise Error("Inner protocol packet too short (%d bytes)"
+                    % len(payload))
+    (innerlen, a2, to2, b1, b2, from2, c1, c2, error, pktcount,
+     tag, type_, subtype, arg1, arg2) = _inner_header.unpack_from(payload)
+    if len(payload) != (innerlen * 4):
+        raise Error(("Inner length field (0x%02x = %d bytes)" +
+                     " does not match actual length (%d bytes)")
+                    % (innerlen, innerlen * 4, len(payload)))
+    first = bool(tag & 0x8000)
+    tag = tag & 0x7fff
+    response = bool(type_ & 1)
+    type_ = type_ & ~1
+    extra = payload[INNER_HLEN:]
+    return InnerPacket(from2, to2, a2, b1, b2, c1, c2, tag,
+                       type_, subtype, arg1, arg2, extra,
+                       response, error, pktcount, first)
+
+
+def encode_6560(from2, to2, a2, b1, b2, c1, c2, tag,
+                type_, subtype, arg1, arg2, extra=b'',
+                response=False, error=0, pktcount=0, first=True):
+    if len(extra) % 4 != 0:
+        raise Error("Inner protocol payloads must" +
+                    " have multiple of 4 bytes length")
+    if type_ & 0x1:
+        raise ValueError("Inner protocol type must be even")
+    innerlen = (len(extra) + INNER_HLEN) // 4
+    if first:
+        tag |= 0x8000
+    if response:
+        type_ |= 1
+    payload = bytearray(_inner_header.pack(innerlen, a2, bytes(to2), b1, b2,
+                                           bytes(from2), c1, c2, error,
+                                           pktcount, tag, type_, subtype,
+                                           arg1, arg2))
+    payload.extend(extra)
+    return payload
+
+
+class FrameTemplate(object):
+    """A prebuilt PPP frame for a 6560 packet
+
+    Requests of the same kind differ only in their tag, arguments and
+    extra data (and packet count, for replies), so everything else is
+    packed once, up front.  The CRC of the constant part of the frame
+    is also kept, so only the varying part is checksummed for each
+    packet.
+    """
+
+    def __init__(self, from2, to2, a2, b1, b2, c1, c2, type_, subtype,
+                 nextra=0, response=False, error=0):
+        if nextra % 4 != 0:
+            raise Error("Inner protocol payloads must" +
+                        " have multiple of 4 bytes length")
+        if type_ & 0x1:
+            raise ValueError("Inner protocol type must be even")
+        self.nextra = nextra
+        self.end = PPP_HLEN + INNER_HLEN + nextra
+        self.frame = bytearray(self.end + 2)
+        _ppp_header.pack_into(self.frame, 0, 0xff, 0x03, SMA_PROTOCOL_ID)
+        _inner_header.pack_into(self.frame, PPP_HLEN,
+                                (INNER_HLEN + nextra) // 4, a2, bytes(to2),
+                                b1, b2, bytes(from2), c1, c2, error, 0, 0,
+                                type_ | int(response), subtype, 0, 0)
+        # Checksum state (without the final inversion) after the
+        # constant leading part of the frame
+        self.crc = crc16(0xffff, self.frame[:_FRAME_COUNT_TAG]) ^ 0xffff
+
+    def build(self, tag, arg1, arg2, extra=b'', pktcount=0, first=True):
+        """Return the escaped frame, including both flag bytes"""
+        if len(extra) != self.nextra:
+            raise ValueError("Template is for %d bytes of extra data"
+                             % self.nextra)
+        frame = self.frame
+        if first:
+            tag |= 0x8000
+        _count_tag.pack_into(frame, _FRAME_COUNT_TAG, pktcount, tag)
+        _args.pack_into(frame, _FRAME_ARGS, arg1, arg2)
+        end = self.end
+        frame[end - self.nextra:end] = extra
+        with memoryview(frame) as mv:
+            crc = crc16(self.crc, mv[_FRAME_COUNT_TAG:end])
+        _u16.pack_into(frame, end, crc)
+        return _ppp_raw(frame)
+
+
+class Decoder(object):
+    """Incremental decoder for a received byte stream
+
+    Received data lives in a ring buffer, buf[start:end].  Callers
+    either read straight into space() and then commit() what they
+    read, or hand over data from elsewhere with feed().  Either way
+    each complete outer packet comes back as a view into the buffer,
+    which is only valid until the next call to space(), so anything
+    kept longer must be copied.
+    """
+
+    def __init__(self, maxbuffer=8192, minread=512, maxread=4096):
+        self.maxbuffer = maxbuffer
+        self.minread = minread
+        self.maxread = maxread
+
+        self.rxbuf = bytearray(maxbuffer)
+        self.rxview = memoryview(self.rxbuf)
+        self.rxstart = 0
+        self.rxend = 0
+        self.rxsize = minread
+        # Partial PPP frames, by sending address
+        self.pppbuf = dict()
+
+    def space(self):
+        """Return a view of the buffer space for the next read
+
+        Any partial packet left from the last read is first moved to
+        the start of the buffer if there's not enough room after it.
+        """
+        if self.rxend + self.rxsize > self.maxbuffer:
+            partial = bytes(self.rxview[self.rxstart:self.rxend])
+            self.rxend = len(partial)
+            self.rxstart = 0
+            self.rxview[:self.rxend] = partial
+        return self.rxview[self.rxend:self.rxend + self.rxsize]
+
+    def adapt(self, n):
+        """Adjust the read size according to how full the last read was"""
+        if n >= self.rxsize:
+            self.rxsize = min(self.rxsize * 2, self.maxread)
+        elif n < self.rxsize // 4:
+            self.rxsize = max(self.rxsize // 2, self.minread)
+
+    def commit(self, n):
+        """Account for n bytes read into space(), generating packets"""
+        self.rxend += n
+        return self._packets()
+
+    def _packets(self):
+        while (self.rxend - self.rxstart) >= OUTER_HLEN:
+            start = self.rxstart
+            pktlen = check_header(self.rxview[start:start + OUTER_HLEN])
+
+            if (self.rxend - start) < pktlen:
+                break
+
+            self.rxstart = start + pktlen
+            yield self.rxview[start:start + pktlen]
+
+        if self.rxstart == self.rxend:
+            self.rxstart = self.rxend = 0
+
+    def feed(self, data):
+        """Generate the complete outer packets after adding data"""
+        data = memoryview(data)
+        while data:
+            space = self.space()
+            n = min(len(space), len(data))
+            space[:n] = data[:n]
+            data = data[n:]
+            yield from self.commit(n)
+
+    def ppp(self, from_, data):
+        """Generate (protocol, payload) for PPP frames completed by data
+
+        Frames may be split across several outer packets, so partial
+        frames are kept for each sender.
+        """
+        pppbuf = self.pppbuf.setdefault(from_, bytearray())
+
+        pppbuf.extend(data)
+        term = pppbuf.find(b'\x7e', 1)
+        while term >= 0:
+            if pppbuf[0] != 0x7e:
+                del pppbuf[:term+1]
+                raise Error("Missing flag byte on PPP packet")
+
+            with memoryview(pppbuf) as mv:
+                raw = mv[1:term].tobytes()
+            del pppbuf[:term+1]
+
+            yield decode_ppp(raw)
+
+            term = pppbuf.find(b'\x7e', 1)
+
+    def events(self, data):
+        """Decode data right through, generating events for each layer
+
+        Each outer packet gives an OuterPacket, each complete PPP frame
+        a PPPFrame, and each inner protocol packet an InnerPacket,
+        lowest layer first.
+        """
+        for pkt in self.feed(data):
+            outer = decode_outer(pkt)
+            yield outer
+            if outer.type_ not in (OTYPE_PPP, OTYPE_PPP2):
+                continue
+            for protocol, payload in self.ppp(outer.from_, outer.payload):
+                yield PPPFrame(outer.from_, protocol, payload)
+                if protocol == SMA_PROTOCOL_ID:
+                    yield decode_6560(payload)
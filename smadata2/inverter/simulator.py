@@ -0,0 +1,318 @@
+#! /usr/bin/python3
+#
+# smadata2.inverter.simulator - Simulated Bluetooth SMA inverter
+# Copyright (C) 2014 David Gibson <david@gibson.dropbear.id.au>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import os
+import random
+import socket
+import struct
+import threading
+import time
+
+from .base import Error
+from . import smabluetooth
+from .smabluetooth import OTYPE_HELLO, OTYPE_GETVAR, OTYPE_VARVAL
+from .smabluetooth import OVAR_SIGNAL, HELLO_PAYLOAD, HISTORIC_RECLEN
+
+__all__ = ['SimulatedUnit', 'SimulatedInverter', 'simulate_pair', 'serve',
+           'listen_unix', 'listen_tcp']
+
+OTYPE_HELLO_DONE = 0x05
+
+# Error code for requests we don't understand or refuse
+ERROR_REJECTED = 0x0015
+
+DAY = 24 * 60 * 60
+FAST_INTERVAL = 5 * 60
+# Generation ramps up linearly between these times (UTC)
+DAWN = 8 * 60 * 60
+DUSK = 20 * 60 * 60
+
+
+class SimulatedUnit(object):
+    """One simulated inverter's clock and synthetic generation history"""
+
+    def __init__(self, serial, susyid=0x0083, password=b'0000',
+                 history_days=30, daily_energy=20000, start_total=1000000):
+        self.serial = serial
+        self.addr2 = struct.pack('<HI', susyid, serial)
+        self.password = password
+        self.daily_energy = daily_energy
+        self.start_total = start_total
+
+        self.clock_offset = 0
+        self.tzoffset = 0
+        now = self.now()
+        self.epoch = now - (now % DAY) - history_days * DAY
+        self.logged_on = False
+
+    def now(self):
+        return int(time.time()) + self.clock_offset
+
+    def total_at(self, ts):
+        """Total yield (Wh) at time ts"""
+        days, secs = divmod(ts - self.epoch, DAY)
+        frac = min(max(secs - DAWN, 0), DUSK - DAWN) / (DUSK - DAWN)
+        return (self.start_total + days * self.daily_energy +
+                int(frac * self.daily_energy))
+
+    def power_at(self, ts):
+        """AC power (W) at time ts"""
+        secs = (ts - self.epoch) % DAY
+        if DAWN <= secs < DUSK:
+            return self.daily_energy * 3600 // (DUSK - DAWN)
+        return 0
+
+    def spot_records(self, subtype, first, last):
+        """(LRI code, value) for each spot value in first..last"""
+        power = self.power_at(self.now())
+        if subtype == 0x5100:
+            phase = power // 3
+            records = [(0x263f, 1, power), (0x4657, 1, 5000)]
+            for i in range(3):
+                records += [(0x4640 + i, 1, phase),
+                            (0x4648 + i, 1, 23000),
+                            (0x4650 + i, 1, phase * 1000 // 230)]
+        else:
+            string = power // 2
+            records = []
+            for i in (1, 2):
+                records += [(0x251e, i, string),
+                            (0x451f, i, 40000),
+                            (0x4521, i, string * 1000 // 400)]
+        return [((0x40 << 24) | (lri << 8) | cls, value)
+                for lri, cls, value in sorted(records)
+                if (first >> 8) <= lri <= (last >> 8)]
+
+    def samples(self, fromtime, totime, interval):
+        first = max(fromtime, self.epoch)
+        first += -first % interval
+        last = min(totime, self.now())
+        return [(ts, self.total_at(ts))
+                for ts in range(first, last + 1, interval)]
+
+
+class SimulatedInverter(smabluetooth.Connection):
+    """The inverter end of an SMA Bluetooth connection
+
+    Speaks the real outer, PPP and 6560 framing over any stream
+    socket, answering hello, getvar, logon, yield, daily yield, spot
+    value, historic, historic daily and set time requests from a
+    synthetic generation history of history_days days.
+
+    Each serial number in slaves adds another unit on the piconet,
+    reachable through this one, as in a multi-inverter site.  All the
+    units are in the units list, this one first as master.
+
+    For load testing, each reply can be delayed by latency seconds,
+    each 6560 reply packet dropped with probability loss, and the
+    byte stream split into writes of at most fragment bytes.
+    """
+    HELLO_INTERVAL = 1.0
+
+    def __init__(self, sock, bdaddr="00:80:25:00:00:01", serial=2130000001,
+                 susyid=0x0083, password=b'0000', history_days=30,
+                 daily_energy=20000, start_total=1000000, slaves=(),
+                 records_per_packet=40, latency=0.0, loss=0.0,
+                 fragment=None, seed=None):
+        super(SimulatedInverter, self).__init__("00:00:00:00:00:00", sock)
+        self.units = [SimulatedUnit(s, susyid, password, history_days,
+                                    daily_energy, start_total + i * 100000)
+                      for i, s in enumerate((serial,) + tuple(slaves))]
+        self.master = self.units[0]
+        self.bdaddr = bdaddr
+        self.local_addr = smabluetooth.bytes2ba(bdaddr)
+        self.local_addr2 = self.master.addr2
+        self.records_per_packet = records_per_packet
+        self.latency = latency
+        self.loss = loss
+        self.fragment = fragment
+        self.random = random.Random(seed)
+        self.helloed = False
+
+    #
+    # Transport
+    #
+
+    def tx_send(self, pkt):
+        if self.fragment:
+            pkt = memoryview(bytes(pkt))
+            while pkt:
+                n = self.random.randint(1, self.fragment)
+                self.sock.sendall(pkt[:n])
+                pkt = pkt[n:]
+        else:
+            self.sock.sendall(pkt)
+
+    def run(self):
+        """Serve the client until it disconnects"""
+        try:
+            while not self.helloed:
+                self.tx_outer(self.local_addr, self.ZERO,
+                              OTYPE_HELLO, HELLO_PAYLOAD)
+                self.rx(self.HELLO_INTERVAL)
+            while True:
+                self.rx()
+        except (Error, OSError):
+            pass
+        finally:
+            self.sock.close()
+
+    #
+    # Requests
+    #
+
+    def rx_outer(self, from_, to_, type_, payload):
+        if not self.rxfilter_outer(to_):
+            return
+
+        if type_ == OTYPE_HELLO:
+            if payload == HELLO_PAYLOAD:
+                self.helloed = True
+                self.tx_outer(self.local_addr, self.ZERO,
+                              OTYPE_HELLO_DONE, b'\x00\x00')
+        elif type_ == OTYPE_GETVAR:
+            varid = smabluetooth.bytes2int(payload[:2])
+            if varid == OVAR_SIGNAL:
+                value = bytes([0x00, 0x00, 0xc0, 0x00])
+                self.tx_outer(self.local_addr, self.ZERO,
+                              OTYPE_VARVAL, bytes(payload[:2]) + value)
+
+        super(SimulatedInverter, self).rx_outer(from_, to_, type_, payload)
+
+    def reply(self, unit, to2, tag, type_, subtype, arg1, arg2, extra=b'',
+              error=0, pktcount=0, first=True):
+        if self.loss and (self.random.random() < self.loss):
+            return
+        self.tx_6560(unit.addr2, to2, 0xa0, 0x00, 0x01, 0x00, 0x01,
+                     tag, type_, subtype, arg1, arg2, extra,
+                     response=True, error=error, pktcount=pktcount,
+                     first=first)
+
+    def reply_historic(self, unit, to2, tag, type_, subtype, fromtime,
+                       totime, interval):
+        points = unit.samples(fromtime, totime, interval)
+        n = self.records_per_packet
+        pieces = [points[i:i + n] for i in range(0, len(points), n)] or [[]]
+        for i, piece in enumerate(pieces):
+            extra = b''.join(struct.pack('<III', ts, val, 0)
+                             for ts, val in piece)
+            assert len(extra) == len(piece) * HISTORIC_RECLEN
+            self.reply(unit, to2, tag, type_, subtype, fromtime, totime,
+                       extra, pktcount=len(pieces) - i - 1, first=(i == 0))
+
+    def reply_spot(self, unit, to2, tag, type_, subtype, first, last):
+        now = unit.now()
+        extra = b''.join(struct.pack('<IIi16x', code, now, value)
+                         for code, value
+                         in unit.spot_records(subtype, first, last))
+        self.reply(unit, to2, tag, type_, subtype, first, last, extra)
+
+    def reply_value(self, unit, to2, tag, type_, subtype, arg1, arg2, ts,
+                    value):
+        extra = struct.pack('<IIII', arg1 | 0x01, ts, value, 0)
+        self.reply(unit, to2, tag, type_, subtype, arg1, arg2, extra)
+
+    def rx_6560(self, from2, to2, a2, b1, b2, c1, c2, tag,
+                type_, subtype, arg1, arg2, extra,
+                response, error, pktcount, first):
+        if response:
+            return
+
+        for unit in self.units:
+            if (to2 == unit.addr2) or (to2 == self.BROADCAST2):
+                self.handle(unit, from2, tag, type_, subtype, arg1, arg2,
+                            extra)
+
+    def handle(self, unit, from2, tag, type_, subtype, arg1, arg2, extra):
+        """Answer a 6560 request as one unit"""
+        if self.latency:
+            time.sleep(self.latency)
+
+        now = unit.now()
+        args = (unit, from2, tag, type_, subtype, arg1, arg2)
+
+        if (type_, subtype) == (0x040c, 0xfffd):
+            password = bytes(((c - 0x88) % 0xff) for c in extra[8:20])
+            if password.rstrip(b'\x00') == unit.password:
+                unit.logged_on = True
+                self.reply(*args, extra)
+            else:
+                self.reply(*args, error=0x0100)
+        elif not unit.logged_on:
+            self.reply(*args, error=ERROR_REJECTED)
+        elif (type_, subtype, arg1) == (0x200, 0x5400, 0x00260100):
+            self.reply_value(*args, now, unit.total_at(now))
+        elif (type_, subtype, arg1) == (0x200, 0x5400, 0x00262200):
+            daily = unit.total_at(now) - unit.total_at(now - now % DAY)
+            self.reply_value(*args, now, daily)
+        elif (type_, subtype) in ((0x200, 0x5100), (0x200, 0x5380)):
+            self.reply_spot(*args)
+        elif (type_, subtype) == (0x200, 0x7000):
+            self.reply_historic(*args, FAST_INTERVAL)
+        elif (type_, subtype) == (0x200, 0x7020):
+            self.reply_historic(*args, DAY)
+        elif (type_, subtype) == (0x20a, 0xf000):
+            ts = smabluetooth.bytes2int(extra[4:8])
+            unit.tzoffset = smabluetooth.bytes2int(extra[16:18])
+            unit.clock_offset = ts - int(time.time())
+        else:
+            self.reply(*args, error=ERROR_REJECTED)
+
+
+def _start(sock, kwargs):
+    sim = SimulatedInverter(sock, **kwargs)
+    thread = threading.Thread(target=sim.run, daemon=True)
+    thread.start()
+    return sim
+
+
+def simulate_pair(**kwargs):
+    """Start a simulated inverter on one end of a socketpair
+
+    Returns (sock, sim): the client end of the socketpair, and the
+    SimulatedInverter running on the other end in a background thread.
+    """
+    client, server = socket.socketpair()
+    return client, _start(server, kwargs)
+
+
+def serve(listener, **kwargs):
+    """Run a simulated inverter for each connection to listener"""
+    while True:
+        sock, addr = listener.accept()
+        _start(sock, kwargs)
+
+
+def listen_unix(path, **kwargs):
+    if os.path.exists(path):
+        os.unlink(path)
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(path)
+    listener.listen()
+    serve(listener, **kwargs)
+
+
+def listen_tcp(host, port, **kwargs):
+    family, type_, proto, cname, addr = socket.getaddrinfo(
+        host, port, type=socket.SOCK_STREAM, flags=socket.AI_PASSIVE)[0]
+    listener = socket.socket(family, type_, proto)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind(addr)
+    listener.listen()
+    serve(listener, **kwargs)
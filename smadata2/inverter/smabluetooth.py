@@ -21,352 +21,816 @@ import sys
 import getopt
 import time
 import socket
+import struct
+import itertools
+import collections
+import functools
+from array import array
 
 from . import base
-from .base import Error
+from . import capture
+from . import codec
+from . import stats
+from . import trace
+from .capture import DIR_RX, DIR_TX
+from .codec import OTYPE_PPP, OTYPE_PPP2, OTYPE_HELLO, OTYPE_GETVAR
+from .codec import OTYPE_VARVAL, OTYPE_ERROR, OVAR_SIGNAL, HELLO_PAYLOAD
+from .codec import SMA_PROTOCOL_ID
+from .codec import ba2bytes, bytes2ba, int2bytes16, int2bytes32, bytes2int
+from .base import Error, Timeout, HeaderError, CRCError, HistoricSeries
 from smadata2.datetimeutil import format_time
 
-__all__ = ['Connection',
+__all__ = ['Connection', 'Unit',
            'OTYPE_PPP', 'OTYPE_PPP2', 'OTYPE_HELLO', 'OTYPE_GETVAR',
            'OTYPE_VARVAL', 'OTYPE_ERROR',
            'OVAR_SIGNAL',
-           'int2bytes16', 'int2bytes32', 'bytes2int']
+           'int2bytes16', 'int2bytes32', 'bytes2int', 'decode_addr2',
+           'decode_yield', 'decode_historic', 'decode_spot',
+           'historic_windows', 'historic_gaps', 'Yield', 'SpotValue',
+           'SPOT_AC', 'SPOT_DC',
+           'RESPONSES', 'response_decoder', 'decode_response']
+
+# Historic records are (timestamp, value, unknown) LE32 triples
+HISTORIC_RECLEN = 12
+# Value reported for intervals with no data
+HISTORIC_NODATA = 0xffffffff
+
+# Spot value records: LRI code, timestamp, value, then 16 bytes we
+# don't use (more values, or minimum/maximum for some quantities)
+_spot_record = struct.Struct('<IIi16x')
+SPOT_RECLEN = _spot_record.size
+# Values reported for quantities which aren't available right now
+SPOT_NODATA = (-0x80000000, -1)
+
+# Register ranges for batched spot value requests: (subtype, first
+# LRI, last LRI).  Each covers every quantity in its class we decode.
+SPOT_AC = (0x5100, 0x00263f00, 0x004657ff)
+SPOT_DC = (0x5380, 0x00251e00, 0x004521ff)
+
+# Spot value quantities by LRI: (name, divisor, unit)
+SPOT_LRIS = {
+    0x263f: ("ac_power", 1, "W"),
+    0x4640: ("ac_power_a", 1, "W"),
+    0x4641: ("ac_power_b", 1, "W"),
+    0x4642: ("ac_power_c", 1, "W"),
+    0x4648: ("ac_voltage_a", 100, "V"),
+    0x4649: ("ac_voltage_b", 100, "V"),
+    0x464a: ("ac_voltage_c", 100, "V"),
+    0x4650: ("ac_current_a", 1000, "A"),
+    0x4651: ("ac_current_b", 1000, "A"),
+    0x4652: ("ac_current_c", 1000, "A"),
+    0x4657: ("grid_frequency", 100, "Hz"),
+    0x251e: ("dc_power", 1, "W"),
+    0x451f: ("dc_voltage", 100, "V"),
+    0x4521: ("dc_current", 1000, "A"),
+}
+
+
+class RTTEstimator(object):
+    """Smoothed round trip time estimate for one link
+
+    Uses the Jacobson/Karels algorithm (as TCP does, RFC 6298) to
+    derive a retransmission timeout from measured round trip times.
+    """
+    ALPHA = 1 / 8
+    BETA = 1 / 4
+    K = 4
+
+    def __init__(self, initial=5.0, minrto=1.0, maxrto=60.0):
+        self.srtt = None
+        self.rttvar = None
+        self.minrto = minrto
+        self.maxrto = maxrto
+        self.rto = initial
+
+    def sample(self, rtt):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = ((1 - self.BETA) * self.rttvar +
+                           self.BETA * abs(self.srtt - rtt))
+            self.srtt = (1 - self.ALPHA) * self.srtt + self.ALPHA * rtt
+        rto = self.srtt + self.K * self.rttvar
+        self.rto = min(max(rto, self.minrto), self.maxrto)
+
+    def backoff(self, timeout):
+        return min(timeout * 2, self.maxrto)
+
+
+class Pending(object):
+    """Future-like result of something we're waiting to receive
+
+    The wait times out if nothing relevant arrives for timeout seconds.
+    If resend is set, it is called to retransmit the request instead.
+    """
+
+    def __init__(self, timeout=None):
+        self.done = False
+        self.value = None
+        self.exception = None
+        self.timeout = timeout
+        self.resend = None
+        self.retries = 0
+        self.started = time.monotonic()
+        self.touched = self.started
+        # The reply this one is helping to complete, if any
+        self.parent = None
+
+    def touch(self):
+        self.touched = time.monotonic()
+
+    def remaining(self):
+        if self.timeout is None:
+            return None
+        return self.touched + self.timeout - time.monotonic()
+
+    def set_result(self, value):
+        self.value = value
+        self.done = True
+
+    def set_exception(self, exception):
+        self.exception = exception
+        self.done = True
+
+    def result(self):
+        if not self.done:
+            raise Error("Result is not yet available")
+        if self.exception is not None:
+            raise self.exception
+        return self.value
+
+
+class PendingOuter(Pending):
+    """Wait for an outer protocol packet of a given type"""
+
+    def __init__(self, wtype, wpl=b'', timeout=None):
+        super(PendingOuter, self).__init__(timeout)
+        self.wtype = wtype
+        self.wpl = bytes(wpl)
+
+    def match(self, type_, payload):
+        return ((type_ == self.wtype) and
+                (payload[:len(self.wpl)] == self.wpl))
+
+
+class PendingReply(Pending):
+    """Reassemble the reply to a 6560 request with a given tag
+
+    If multi is set, the reply may span several packets and the result
+    is the list of (from2, type_, subtype, arg1, arg2, extra) for each
+    of them.  Otherwise the result is that tuple for the single reply
+    packet.  If decode is set, the result is instead whatever the
+    decoder registered for the kind of reply makes of it.
+
+    A request which is resent gets a new tag, but a late reply to any
+    of its earlier tags is just as good, so all of them are in tags.
+
+    The packets of a multipacket reply are collected by their packet
+    count, so they may arrive in any order, or more than once.  For a
+    request covering a window of historic data, window is set to
+    (fromtime, totime) and refetch(start, end) sends the request again
+    for part of it.  If some packets go missing the reply is then
+    completed from new requests, its children, for just the missing
+    time ranges.
+    """
+
+    def __init__(self, tag, multi=False, timeout=None, unit=None,
+                 decode=False):
+        super(PendingReply, self).__init__(timeout)
+        self.tag = tag
+        self.tags = [tag]
+        self.multi = multi
+        # If set, only accept replies from this unit's 6560 address
+        self.unit = unit
+        self.decode = decode
+        # Tag of the reply being reassembled
+        self.current = None
+        # Number of packets in the reply, known once the first arrives
+        self.expected = None
+        # Packets received so far, by packet count
+        self.fragments = {}
+        self.replied = None
+        self.window = None
+        self.refetch = None
+        self.children = None
+
+    def restart(self, tag):
+        """Start again after the request was resent with a new tag"""
+        self.tag = tag
+        self.tags.append(tag)
+        self.current = None
+        self.expected = None
+        self.fragments = {}
+        self.replied = None
+        self.retries += 1
+        self.started = time.monotonic()
+        self.touched = self.started
+
+    def complete(self, value):
+        if self.decode:
+            try:
+                value = decode_response(value if self.multi else [value])
+            except Error as e:
+                self.set_exception(e)
+                return
+        self.set_result(value)
 
-OUTER_HLEN = 18
+    def feed(self, tag, from2, type_, subtype, arg1, arg2, extra,
+             error, pktcount, first):
+        if (self.current is not None) and (tag != self.current):
+            # Part of the reply to another copy of the request; we're
+            # already reassembling one
+            return
+        self.current = tag
 
-OTYPE_PPP = 0x01
-OTYPE_HELLO = 0x02
-OTYPE_GETVAR = 0x03
-OTYPE_VARVAL = 0x04
-OTYPE_ERROR = 0x07
-OTYPE_PPP2 = 0x08
+        if error:
+            self.set_exception(Error("SMA device returned error 0x%x"
+                                     % error))
+            return
 
-OVAR_SIGNAL = 0x05
+        packet = (from2, type_, subtype, arg1, arg2, extra)
 
-INNER_HLEN = 36
+        if not self.multi:
+            if (pktcount != 0) or not first:
+                self.set_exception(Error("Unexpected multipacket reply"))
+            else:
+                self.complete(packet)
+            return
 
-SMA_PROTOCOL_ID = 0x6560
+        if self.children is not None:
+            # Already completing this from requests for what's missing
+            return
 
+        if first:
+            self.expected = pktcount + 1
+        if self.expected is not None:
+            highest = max(pktcount, max(self.fragments, default=0))
+            if highest >= self.expected:
+                self.set_exception(Error("Packet index %d beyond the %d"
+                                         " packets of the reply"
+                                         % (highest, self.expected)))
+                return
 
-def waiter(fn):
-    def waitfn(self, *args):
-        fn(self, *args)
-        if hasattr(self, '__waitcond_' + fn.__name__):
-            wc = getattr(self, '__waitcond_' + fn.__name__)
-            if wc is None:
-                self.waitvar = args
-            else:
-                self.waitvar = wc(*args)
-    return waitfn
-
-
-def _check_header(hdr):
-    if len(hdr) < OUTER_HLEN:
-        raise ValueError()
-
-    if hdr[0] != 0x7e:
-        raise Error("Missing packet start marker")
-    if (hdr[1] > 0x70) or (hdr[2] != 0):
-        raise Error("Bad packet length")
-    if hdr[3] != (hdr[0] ^ hdr[1] ^ hdr[2]):
-        raise Error("Bad header check byte")
-    return hdr[1]
-
-
-def ba2bytes(addr):
-    if len(addr) != 6:
-        raise ValueError("Bad length for bluetooth address")
-    assert len(addr) == 6
-    return "%02X:%02X:%02X:%02X:%02X:%02X" % tuple(reversed(addr))
-
-
-def bytes2ba(s):
-    addr = [int(x, 16) for x in s.split(':')]
-    addr.reverse()
-    if len(addr) != 6:
-        raise ValueError("Bad length for bluetooth address")
-    return bytearray(addr)
-
-
-def int2bytes16(v):
-    return bytearray([v & 0xff, v >> 8])
-
-
-def int2bytes32(v):
-    return bytearray([v & 0xff, (v >> 8) & 0xff, (v >> 16) & 0xff, v >> 24])
-
-
-def bytes2int(b):
-    v = 0
-    while b:
-        v = v << 8
-        v += b.pop()
-    return v
-
-
-crc16_table = [0x0000, 0x1189, 0x2312, 0x329b, 0x4624, 0x57ad, 0x6536, 0x74bf,
-               0x8c48, 0x9dc1, 0xaf5a, 0xbed3, 0xca6c, 0xdbe5, 0xe97e, 0xf8f7,
-               0x1081, 0x0108, 0x3393, 0x221a, 0x56a5, 0x472c, 0x75b7, 0x643e,
-               0x9cc9, 0x8d40, 0xbfdb, 0xae52, 0xdaed, 0xcb64, 0xf9ff, 0xe876,
-               0x2102, 0x308b, 0x0210, 0x1399, 0x6726, 0x76af, 0x4434, 0x55bd,
-               0xad4a, 0xbcc3, 0x8e58, 0x9fd1, 0xeb6e, 0xfae7, 0xc87c, 0xd9f5,
-               0x3183, 0x200a, 0x1291, 0x0318, 0x77a7, 0x662e, 0x54b5, 0x453c,
-               0xbdcb, 0xac42, 0x9ed9, 0x8f50, 0xfbef, 0xea66, 0xd8fd, 0xc974,
-               0x4204, 0x538d, 0x6116, 0x709f, 0x0420, 0x15a9, 0x2732, 0x36bb,
-               0xce4c, 0xdfc5, 0xed5e, 0xfcd7, 0x8868, 0x99e1, 0xab7a, 0xbaf3,
-               0x5285, 0x430c, 0x7197, 0x601e, 0x14a1, 0x0528, 0x37b3, 0x263a,
-               0xdecd, 0xcf44, 0xfddf, 0xec56, 0x98e9, 0x8960, 0xbbfb, 0xaa72,
-               0x6306, 0x728f, 0x4014, 0x519d, 0x2522, 0x34ab, 0x0630, 0x17b9,
-               0xef4e, 0xfec7, 0xcc5c, 0xddd5, 0xa96a, 0xb8e3, 0x8a78, 0x9bf1,
-               0x7387, 0x620e, 0x5095, 0x411c, 0x35a3, 0x242a, 0x16b1, 0x0738,
-               0xffcf, 0xee46, 0xdcdd, 0xcd54, 0xb9eb, 0xa862, 0x9af9, 0x8b70,
-               0x8408, 0x9581, 0xa71a, 0xb693, 0xc22c, 0xd3a5, 0xe13e, 0xf0b7,
-               0x0840, 0x19c9, 0x2b52, 0x3adb, 0x4e64, 0x5fed, 0x6d76, 0x7cff,
-               0x9489, 0x8500, 0xb79b, 0xa612, 0xd2ad, 0xc324, 0xf1bf, 0xe036,
-               0x18c1, 0x0948, 0x3bd3, 0x2a5a, 0x5ee5, 0x4f6c, 0x7df7, 0x6c7e,
-               0xa50a, 0xb483, 0x8618, 0x9791, 0xe32e, 0xf2a7, 0xc03c, 0xd1b5,
-               0x2942, 0x38cb, 0x0a50, 0x1bd9, 0x6f66, 0x7eef, 0x4c74, 0x5dfd,
-               0xb58b, 0xa402, 0x9699, 0x8710, 0xf3af, 0xe226, 0xd0bd, 0xc134,
-               0x39c3, 0x284a, 0x1ad1, 0x0b58, 0x7fe7, 0x6e6e, 0x5cf5, 0x4d7c,
-               0xc60c, 0xd785, 0xe51e, 0xf497, 0x8028, 0x91a1, 0xa33a, 0xb2b3,
-               0x4a44, 0x5bcd, 0x6956, 0x78df, 0x0c60, 0x1de9, 0x2f72, 0x3efb,
-               0xd68d, 0xc704, 0xf59f, 0xe416, 0x90a9, 0x8120, 0xb3bb, 0xa232,
-               0x5ac5, 0x4b4c, 0x79d7, 0x685e, 0x1ce1, 0x0d68, 0x3ff3, 0x2e7a,
-               0xe70e, 0xf687, 0xc41c, 0xd595, 0xa12a, 0xb0a3, 0x8238, 0x93b1,
-               0x6b46, 0x7acf, 0x4854, 0x59dd, 0x2d62, 0x3ceb, 0x0e70, 0x1ff9,
-               0xf78f, 0xe606, 0xd49d, 0xc514, 0xb1ab, 0xa022, 0x92b9, 0x8330,
-               0x7bc7, 0x6a4e, 0x58d5, 0x495c, 0x3de3, 0x2c6a, 0x1ef1, 0x0f78]
-assert(len(crc16_table) == 256)
-
-
-def crc16(iv, data):
-    crc = iv
-    for b in data:
-        crc = (crc >> 8) ^ crc16_table[(crc ^ b) & 0xff]
-    return crc ^ 0xffff
+        # Duplicates are ignored
+        self.fragments.setdefault(pktcount, packet)
+        if len(self.fragments) == self.expected:
+            self.complete(self.packets())
 
+    def packets(self):
+        """The packets received so far, in order"""
+        return [self.fragments[i]
+                for i in sorted(self.fragments, reverse=True)]
+
+    def recoverable(self):
+        """Can the missing parts of this reply be fetched alone?"""
+        return ((self.refetch is not None) and
+                (bool(self.fragments) or (self.children is not None)))
+
+    def adopt(self):
+        """Complete this reply once all of its children are done"""
+        if not all(c.done for c in self.children):
+            return
+        packets = self.packets()
+        for c in self.children:
+            if c.exception is not None:
+                self.set_exception(c.exception)
+                return
+            packets.extend(c.value)
+        # The missing ranges were between the packets we had, so
+        # putting everything in time order splices them in
+        packets.sort(key=_historic_start)
+        self.complete(packets)
+
+
+class PendingUnits(Pending):
+    """Collect the 6560 address of every unit answering a broadcast
+
+    Completes once expect units have replied, if expect is given.
+    Otherwise the caller waits out the timeout, then takes the units
+    that replied.
+    """
+
+    def __init__(self, tag, timeout=None, expect=None):
+        super(PendingUnits, self).__init__(timeout)
+        self.tag = tag
+        self.tags = [tag]
+        self.expect = expect
+        self.unit = None
+        self.units = []
+        self.replied = None
+
+    def feed(self, tag, from2, type_, subtype, arg1, arg2, extra,
+             error, pktcount, first):
+        from2 = bytes(from2)
+        if not error and (from2 not in self.units):
+            self.units.append(from2)
+            if (self.expect is not None) and \
+               (len(self.units) >= self.expect):
+                self.set_result(self.units)
+
+
+def decode_addr2(addr2):
+    """Split a 6560 address into (SUSyID, serial number)"""
+    return struct.unpack('<HI', addr2)
+
+
+def decode_signal(val):
+    """Convert a signal level variable to a fraction of full strength"""
+    return val[2] / 0xff
+
+
+Yield = collections.namedtuple('Yield', ['timestamp', 'value'])
+
+
+def decode_yield(packet):
+    """Extract a Yield from a yield or daily yield reply"""
+    from2, type_, subtype, arg1, arg2, extra = packet
+    return Yield(bytes2int(extra[4:8]), bytes2int(extra[8:12]))
+
+
+def decode_historic(extras):
+    """Decode the payloads of a historic data reply in one pass
+
+    extras is the sequence of payloads from every packet of the
+    reply.  Returns a HistoricSeries, omitting records with no data.
+    """
+    raw = b''.join(extras)
+    if len(raw) % HISTORIC_RECLEN:
+        raise Error("Historic data payload length %d is not a multiple"
+                    " of the record length" % len(raw))
+
+    words = array(base.U32)
+    words.frombytes(raw)
+    if sys.byteorder != 'little':
+        words.byteswap()
+
+    timestamps = words[0::3]
+    values = words[1::3]
+    if HISTORIC_NODATA in values:
+        timestamps = array(base.U32,
+                           itertools.compress(timestamps,
+                                              map(HISTORIC_NODATA.__ne__,
+                                                  values)))
+        values = array(base.U32, filter(HISTORIC_NODATA.__ne__, values))
+    return HistoricSeries(timestamps, values)
+
+
+def _historic_start(packet):
+    # Timestamp of the first record in a historic reply packet
+    extra = packet[5]
+    if not extra:
+        return -1
+    return bytes2int(extra[0:4])
+
+
+def historic_gaps(fragments, expected, fromtime, totime):
+    """Find the time ranges missing from a partial historic reply
+
+    fragments maps packet counts to the packets received so far, and
+    expected is the number of packets in the reply, or None if the
+    first packet hasn't arrived.  Records are in time order through
+    the reply, so whatever a missing packet held lies between the
+    records either side of it.  Returns a list of (start, end) ranges,
+    inclusive, which between them cover everything missing.
+    """
+    gaps = []
+    start = fromtime
+    missing = expected is None
+    prev = expected
+    for pktcount in sorted(fragments, reverse=True):
+        if (prev is not None) and (prev - pktcount > 1):
+            missing = True
+        prev = pktcount
+
+        extra = fragments[pktcount][5]
+        if not extra:
+            continue
+        first = bytes2int(extra[0:4])
+        last = bytes2int(extra[-HISTORIC_RECLEN:4 - HISTORIC_RECLEN])
+        if missing:
+            gaps.append((start, first - 1))
+            missing = False
+        start = last + 1
+
+    if (prev != 0) or missing:
+        gaps.append((start, totime))
+    return [(start, end) for start, end in gaps if start <= end]
+
+
+SpotValue = collections.namedtuple('SpotValue', ['timestamp', 'value', 'unit'])
+
+
+def decode_spot(extras):
+    """Decode the payloads of a spot value reply in one pass
+
+    Returns a dict mapping quantity names to SpotValues, with values
+    scaled to the given unit, or None where the inverter has no
+    reading.  DC quantities are per string, so their names have the
+    string number appended (e.g. 'dc_voltage_1').  Unknown LRIs are
+    skipped.
+    """
+    raw = b''.join(extras)
+    if len(raw) % SPOT_RECLEN:
+        raise Error("Spot value payload length %d is not a multiple"
+                    " of the record length" % len(raw))
+
+    values = {}
+    for code, timestamp, value in _spot_record.iter_unpack(raw):
+        lri = (code >> 8) & 0xffff
+        if lri not in SPOT_LRIS:
+            continue
+        name, divisor, unit = SPOT_LRIS[lri]
+        if name.startswith("dc_"):
+            name = "%s_%d" % (name, code & 0xff)
+        if value in SPOT_NODATA:
+            value = None
+        elif divisor != 1:
+            value = value / divisor
+        values[name] = SpotValue(timestamp, value, unit)
+    return values
+
+
+# Decoders for each kind of 6560 response, by (type, subtype).  Each is
+# given the list of (from2, type_, subtype, arg1, arg2, extra) packets
+# making up a complete reply.
+RESPONSES = {}
+
+
+def response_decoder(*kinds):
+    """Register the decorated function to decode replies of each kind"""
+    def register(fn):
+        for kind in kinds:
+            RESPONSES[kind] = fn
+        return fn
+    return register
+
+
+def decode_response(packets):
+    """Decode a complete reply with the decoder for its kind
+
+    Replies of kinds with no registered decoder are returned as is.
+    """
+    from2, type_, subtype = packets[0][:3]
+    decoder = RESPONSES.get((type_, subtype))
+    if decoder is None:
+        return packets
+    return decoder(packets)
+
+
+@response_decoder((0x040c, 0xfffd))
+def _decode_logon(packets):
+    # The 6560 address of the unit which accepted the logon
+    return bytes(packets[0][0])
+
+
+@response_decoder((0x200, 0x5400))
+def _decode_yield(packets):
+    return decode_yield(packets[0])
+
+
+@response_decoder((0x200, 0x7000), (0x200, 0x7020))
+def _decode_historic(packets):
+    return decode_historic(p[5] for p in packets)
+
+
+@response_decoder((0x200, SPOT_AC[0]), (0x200, SPOT_DC[0]))
+def _decode_spot(packets):
+    return decode_spot(p[5] for p in packets)
 
-class Connection(base.InverterConnection):
-    MAXBUFFER = 512
-    BROADCAST = "ff:ff:ff:ff:ff:ff"
-    BROADCAST2 = bytearray(b'\xff\xff\xff\xff\xff\xff')
 
-    def __init__(self, addr):
-        self.sock = socket.socket(socket.AF_BLUETOOTH, socket.SOCK_STREAM,
-                                  socket.BTPROTO_RFCOMM)
-        self.sock.connect((addr, 1))
+def historic_windows(fromtime, totime, window):
+    """Split the range fromtime..totime (inclusive) into windows
 
-        self.remote_addr = addr
-        self.local_addr = self.sock.getsockname()[0]
+    Yields (start, end) for consecutive windows of at most window
+    seconds covering the range.
+    """
+    for start in range(fromtime, totime + 1, window):
+        yield start, min(start + window - 1, totime)
 
-        self.local_addr2 = bytearray(b'\x78\x00\x3f\x10\xfb\x39')
 
-        self.rxbuf = bytearray()
-        self.pppbuf = dict()
+class Connection(base.InverterConnection):
+    # Size of the receive buffer
+    MAXBUFFER = 8192
+    # Limits for the adaptive size of each socket read
+    MINREAD = 512
+    MAXREAD = 4096
+    MAXRETRIES = 3
+    MAXTEMPLATES = 64
+    MAXUNSOLICITED = 16
+    # Addresses are kept as bytes, in wire order
+    ZERO = bytes(6)
+    BROADCAST = b'\xff' * 6
+    BROADCAST2 = b'\xff' * 6
+
+    def __init__(self, addr, sock=None):
+        if sock is None:
+            sock = socket.socket(socket.AF_BLUETOOTH, socket.SOCK_STREAM,
+                                 socket.BTPROTO_RFCOMM)
+            sock.connect((addr, 1))
+        self.sock = sock
+        # Timeout last set on sock; never a valid one to begin with
+        self.rxtimeout = -1
+
+        self.remote_addr = bytes2ba(addr)
+        sockname = self.sock.getsockname()
+        ipsock = (getattr(self.sock, 'family', None)
+                  in (socket.AF_INET, socket.AF_INET6))
+        if isinstance(sockname, tuple) and not ipsock:
+            self.local_addr = bytes2ba(sockname[0])
+        else:
+            # Not a Bluetooth socket (e.g. a socketpair for testing, or
+            # a TCP connection to a simulator)
+            self.local_addr = self.ZERO
+
+        self.local_addr2 = b'\x78\x00\x3f\x10\xfb\x39'
+
+        self.decoder = codec.Decoder(self.MAXBUFFER, self.MINREAD,
+                                     self.MAXREAD)
 
         self.tagcounter = 0
+        # Outstanding 6560 requests, by tag
+        self.pending = dict()
+        # Callbacks for replies nobody is waiting for, by (type, subtype)
+        self.subscribers = dict()
+        # Such replies being reassembled, by tag
+        self.unsolicited = dict()
+        self.outer_waiters = []
+        self.rtt = RTTEstimator()
+
+        # Outgoing packets are built in place here
+        self.txpkt = bytearray(codec.OUTER_MAXLEN)
+        # Prebuilt 6560 frames, by their constant fields
+        self.templates = dict()
+
+        self.capture = None
+        self.tracer = None
+        self.stats = stats.LinkStats()
+
+    def start_capture(self, f):
+        """Record every raw packet sent or received to file f"""
+        self.capture = capture.CaptureWriter(f, self.local_addr,
+                                             self.remote_addr)
+
+    def start_trace(self, size=1024, errfile=None):
+        """Record protocol events at every layer in a ring buffer
+
+        Returns the trace.Tracer holding the last size events.
+        """
+        self.tracer = trace.Tracer(size, errfile)
+        return self.tracer
+
+    def trace_error(self, exc):
+        if self.tracer is not None:
+            self.tracer.error(exc)
+
+    def close(self):
+        self.sock.close()
+        if self.capture is not None:
+            self.capture.close()
+            self.capture = None
 
     def gettag(self):
-        self.tagcounter += 1
+        # Tags are 15 bits, the top bit of the field marks the first
+        # packet of a reply
+        self.tagcounter = (self.tagcounter % 0x7fff) + 1
         return self.tagcounter
 
     #
     # RX side
     #
 
-    def rx(self):
-        space = self.MAXBUFFER - len(self.rxbuf)
-        self.rxbuf += self.sock.recv(space)
-
-        while len(self.rxbuf) >= OUTER_HLEN:
-            pktlen = _check_header(self.rxbuf[:OUTER_HLEN])
-
-            if len(self.rxbuf) < pktlen:
-                return
-
-            pkt = self.rxbuf[:pktlen]
-            del self.rxbuf[:pktlen]
-
-            self.rx_raw(pkt)
+    def rx_space(self):
+        return self.decoder.space()
+
+    def rx_adapt(self, n):
+        self.decoder.adapt(n)
+
+    def rx(self, timeout=None):
+        # Reconfiguring the socket costs a system call, so only do it
+        # when the timeout changes
+        if timeout != self.rxtimeout:
+            self.sock.settimeout(timeout)
+            self.rxtimeout = timeout
+        try:
+            n = self.sock.recv_into(self.rx_space())
+        except socket.timeout:
+            return
+        self.rx_adapt(n)
+        self.rx_commit(n)
+
+    def rx_data(self, data):
+        """Process received data which was read into another buffer"""
+        if not data:
+            raise Error("Connection closed by inverter")
+        data = memoryview(data)
+        while data:
+            space = self.rx_space()
+            n = min(len(space), len(data))
+            space[:n] = data[:n]
+            data = data[n:]
+            self.rx_commit(n)
+
+    def rx_commit(self, n):
+        """Process n bytes newly read into the space from rx_space()"""
+        if not n:
+            raise Error("Connection closed by inverter")
+        try:
+            for pkt in self.decoder.commit(n):
+                self.rx_raw(pkt)
+        except HeaderError:
+            self.stats.header_errors += 1
+            raise
+        except CRCError:
+            self.stats.crc_errors += 1
+            raise
 
-    @waiter
     def rx_raw(self, pkt):
-        from_ = ba2bytes(pkt[4:10])
-        to_ = ba2bytes(pkt[10:16])
-        type_ = bytes2int(pkt[16:18])
-        payload = pkt[OUTER_HLEN:]
+        # pkt is a view into the receive buffer, so it (and slices of
+        # it) must be copied by anything that keeps it beyond this call
+        if self.capture is not None:
+            self.capture.record(capture.DIR_RX, pkt)
+        if self.tracer is not None:
+            self.tracer.record(DIR_RX, trace.LAYER_RAW, (len(pkt),))
+        self.stats.packets_rx += 1
+        self.stats.bytes_rx += len(pkt)
 
-        self.rx_outer(from_, to_, type_, payload)
+        self.rx_outer(*codec.decode_outer(pkt))
 
     def rxfilter_outer(self, to_):
         return ((to_ == self.local_addr) or
                 (to_ == self.BROADCAST) or
-                (to_ == "00:00:00:00:00:00"))
+                (to_ == self.ZERO))
 
-    @waiter
     def rx_outer(self, from_, to_, type_, payload):
+        if self.tracer is not None:
+            self.tracer.record(DIR_RX, trace.LAYER_OUTER,
+                               (from_, to_, type_, len(payload)))
         if not self.rxfilter_outer(to_):
             return
 
+        for w in self.outer_waiters:
+            if w.match(type_, payload):
+                w.set_result(bytearray(payload))
+                self.outer_waiters.remove(w)
+                break
+
         if (type_ == OTYPE_PPP) or (type_ == OTYPE_PPP2):
             self.rx_ppp_raw(from_, payload)
 
     def rx_ppp_raw(self, from_, payload):
-        if from_ not in self.pppbuf:
-            self.pppbuf[from_] = bytearray()
-        pppbuf = self.pppbuf[from_]
-
-        pppbuf.extend(payload)
-        term = pppbuf.find(b'\x7e', 1)
-        if term < 0:
-            return
-
-        raw = pppbuf[:term+1]
-        del pppbuf[:term+1]
-
-        assert raw[-1] == 0x7e
-        if raw[0] != 0x7e:
-            raise Error("Missing flag byte on PPP packet")
-
-        raw = raw[1:-1]
-        frame = bytearray()
-        while raw:
-            b = raw.pop(0)
-            if b == 0x7d:
-                frame.append(raw.pop(0) ^ 0x20)
-            else:
-                frame.append(b)
-
-        if (frame[0] != 0xff) or (frame[1] != 0x03):
-            raise Error("Bad header on PPP frame")
-
-        pcrc = bytes2int(frame[-2:])
-        ccrc = crc16(0xffff, frame[:-2])
-        if pcrc != ccrc:
-            raise Error("Bad CRC on PPP frame")
+        for protocol, frame in self.decoder.ppp(from_, payload):
+            self.rx_ppp(from_, protocol, frame)
 
-        protocol = bytes2int(frame[2:4])
-
-        self.rx_ppp(from_, protocol, frame[4:-2])
-
-    @waiter
     def rx_ppp(self, from_, protocol, payload):
+        if self.tracer is not None:
+            self.tracer.record(DIR_RX, trace.LAYER_PPP,
+                               (from_, protocol, len(payload)))
+        self.stats.frames_rx += 1
         if protocol == SMA_PROTOCOL_ID:
-            innerlen = payload[0]
-            if len(payload) != (innerlen * 4):
-                raise Error("Inner length field (0x%02x = %d bytes)" +
-                            " does not match actual length (%d bytes)"
-                            % (innerlen, innerlen * 4, len(payload)))
-            a2 = payload[1]
-            to2 = payload[2:8]
-            b1 = payload[8]
-            b2 = payload[9]
-            from2 = payload[10:16]
-            c1 = payload[16]
-            c2 = payload[17]
-            error = bytes2int(payload[18:20])
-            pktcount = bytes2int(payload[20:22])
-            tag = bytes2int(payload[22:24])
-            first = bool(tag & 0x8000)
-            tag = tag & 0x7fff
-            type_ = bytes2int(payload[24:26])
-            response = bool(type_ & 1)
-            type_ = type_ & ~1
-            subtype = bytes2int(payload[26:28])
-            arg1 = bytes2int(payload[28:32])
-            arg2 = bytes2int(payload[32:36])
-            extra = payload[36:]
-            self.rx_6560(from2, to2, a2, b1, b2, c1, c2, tag,
-                         type_, subtype, arg1, arg2, extra,
-                         response, error, pktcount, first)
+            self.rx_6560(*codec.decode_6560(payload))
 
     def rxfilter_6560(self, to2):
         return ((to2 == self.local_addr2) or
                 (to2 == self.BROADCAST2))
 
-    @waiter
     def rx_6560(self, from2, to2, a2, b1, b2, c1, c2, tag,
                 type_, subtype, arg1, arg2, extra,
                 response, error, pktcount, first):
+        if self.tracer is not None:
+            self.tracer.record(DIR_RX, trace.LAYER_6560,
+                               (from2, to2, tag, type_, subtype, arg1, arg2,
+                                len(extra), response, error, pktcount,
+                                first))
         if not self.rxfilter_6560(to2):
             return
 
-        pass
+        if not response:
+            return
+
+        reply = self.pending.get(tag)
+        if reply is None:
+            self.rx_unsolicited(from2, tag, type_, subtype, arg1, arg2,
+                                extra, error, pktcount, first)
+            return
+
+        if (reply.unit is not None) and (from2 != reply.unit):
+            # Another unit on the piconet answering a broadcast
+            return
+
+        reply.touch()
+        if reply.parent is not None:
+            reply.parent.touch()
+        if reply.replied is None:
+            reply.replied = reply.touched
+            # Karn's algorithm: only time requests sent once
+            if reply.retries == 0:
+                self.rtt.sample(reply.replied - reply.started)
+
+        reply.feed(tag, from2, type_, subtype, arg1, arg2, extra,
+                   error, pktcount, first)
+        if reply.done:
+            self.retire(reply)
+            if reply.parent is not None:
+                reply.parent.adopt()
+
+    def rx_unsolicited(self, from2, tag, type_, subtype, arg1, arg2, extra,
+                       error, pktcount, first):
+        """Pass a reply nobody is waiting for to its subscribers
+
+        That is usually a late reply, to a request which was abandoned
+        after timing out.
+        """
+        callbacks = self.subscribers.get((type_, subtype))
+        if not callbacks:
+            return
+
+        reply = self.unsolicited.get(tag)
+        if reply is None:
+            if len(self.unsolicited) >= self.MAXUNSOLICITED:
+                # Drop the leftovers of replies which never completed
+                self.unsolicited.clear()
+            reply = PendingReply(tag, multi=True, decode=True)
+            self.unsolicited[tag] = reply
+
+        reply.feed(tag, from2, type_, subtype, arg1, arg2, extra,
+                   error, pktcount, first)
+        if reply.done:
+            del self.unsolicited[tag]
+            if reply.exception is None:
+                for callback in list(callbacks):
+                    callback(bytes(from2), reply.value)
+
+    def subscribe(self, type_, subtype, callback):
+        """Call callback(from2, result) for unrequested replies
+
+        This covers replies of the given kind which arrive when nobody
+        is waiting for them.  The result is decoded as for request().
+        """
+        self.subscribers.setdefault((type_, subtype), []).append(callback)
+
+    def unsubscribe(self, type_, subtype, callback):
+        self.subscribers[(type_, subtype)].remove(callback)
 
     #
     # Tx side
     #
     def tx_raw(self, pkt):
-        if _check_header(pkt) != len(pkt):
+        if codec.check_header(pkt) != len(pkt):
             raise ValueError("Bad packet")
-        self.sock.send(bytes(pkt))
+        if self.capture is not None:
+            self.capture.record(capture.DIR_TX, pkt)
+        if self.tracer is not None:
+            self.tracer.record(DIR_TX, trace.LAYER_RAW, (len(pkt),))
+        self.stats.packets_tx += 1
+        self.stats.bytes_tx += len(pkt)
+        self.tx_send(pkt)
 
-    def tx_outer(self, from_, to_, type_, payload):
-        pktlen = len(payload) + OUTER_HLEN
-        pkt = bytearray([0x7e, pktlen, 0x00, pktlen ^ 0x7e])
-        pkt += bytes2ba(from_)
-        pkt += bytes2ba(to_)
-        pkt += int2bytes16(type_)
-        pkt += payload
-        assert _check_header(pkt) == pktlen
+    def tx_send(self, pkt):
+        self.sock.sendall(pkt)
 
-        self.tx_raw(pkt)
+    def tx_outer(self, from_, to_, type_, payload):
+        if self.tracer is not None:
+            self.tracer.record(DIR_TX, trace.LAYER_OUTER,
+                               (from_, to_, type_, len(payload)))
+        self.tx_raw(codec.encode_outer(from_, to_, type_, payload,
+                                       self.txpkt))
+
+    def tx_ppp_raw(self, to_, raw):
+        if self.tracer is not None:
+            self.tracer.record(DIR_TX, trace.LAYER_PPP,
+                               (to_, None, len(raw)))
+        self.stats.frames_tx += 1
+        for type_, piece in codec.ppp_pieces(raw):
+            self.tx_outer(self.local_addr, to_, type_, piece)
 
     def tx_ppp(self, to_, protocol, payload):
-        frame = bytearray(b'\xff\x03')
-        frame += int2bytes16(protocol)
-        frame += payload
-        frame += int2bytes16(crc16(0xffff, frame))
-
-        rawpayload = bytearray()
-        rawpayload.append(0x7e)
-        for b in frame:
-            # Escape \x7e (FLAG), 0x7d (ESCAPE), 0x11 (XON) and 0x13 (XOFF)
-            if b in [0x7e, 0x7d, 0x11, 0x13]:
-                rawpayload.append(0x7d)
-                rawpayload.append(b ^ 0x20)
-            else:
-                rawpayload.append(b)
-        rawpayload.append(0x7e)
-
-        self.tx_outer(self.local_addr, to_, OTYPE_PPP, rawpayload)
+        self.tx_ppp_raw(to_, codec.encode_ppp(protocol, payload))
+
+    def template(self, from2, to2, a2, b1, b2, c1, c2, type_, subtype,
+                 nextra, response, error):
+        key = (bytes(from2), bytes(to2), a2, b1, b2, c1, c2, type_, subtype,
+               nextra, response, error)
+        template = self.templates.get(key)
+        if template is None:
+            if len(self.templates) >= self.MAXTEMPLATES:
+                self.templates.clear()
+            template = codec.FrameTemplate(*key)
+            self.templates[key] = template
+        return template
 
     def tx_6560(self, from2, to2, a2, b1, b2, c1, c2, tag,
                 type_, subtype, arg1, arg2, extra=bytearray(),
                 response=False, error=0, pktcount=0, first=True):
-        if len(extra) % 4 != 0:
-            raise Error("Inner protocol payloads must" +
-                        " have multiple of 4 bytes length")
-        innerlen = (len(extra) + INNER_HLEN) // 4
-        payload = bytearray()
-        payload.append(innerlen)
-        payload.append(a2)
-        payload.extend(to2)
-        payload.append(b1)
-        payload.append(b2)
-        payload.extend(from2)
-        payload.append(c1)
-        payload.append(c2)
-        payload.extend(int2bytes16(error))
-        payload.extend(int2bytes16(pktcount))
-        if first:
-            xtag = tag | 0x8000
-        else:
-            xtag = tag
-        payload.extend(int2bytes16(xtag))
-        if type_ & 0x1:
-            raise ValueError
-        if response:
-            xtype = type_ | 1
-        else:
-            xtype = type_
-        payload.extend(int2bytes16(xtype))
-        payload.extend(int2bytes16(subtype))
-        payload.extend(int2bytes32(arg1))
-        payload.extend(int2bytes32(arg2))
-        payload.extend(extra)
-
-        self.tx_ppp("ff:ff:ff:ff:ff:ff", SMA_PROTOCOL_ID, payload)
+        if self.tracer is not None:
+            self.tracer.record(DIR_TX, trace.LAYER_6560,
+                               (bytes(from2), bytes(to2), tag, type_,
+                                subtype, arg1, arg2, len(extra), response,
+                                error, pktcount, first))
+        template = self.template(from2, to2, a2, b1, b2, c1, c2, type_,
+                                 subtype, len(extra), response, error)
+        raw = template.build(tag, arg1, arg2, extra, pktcount, first)
+        self.tx_ppp_raw(self.BROADCAST, raw)
         return tag
 
     def tx_logon(self, password=b'0000', timeout=900):
@@ -381,17 +845,17 @@ class Connection(base.InverterConnection):
                             0x00, 0x01, 0x00, 0x01, tag,
                             0x040c, 0xfffd, 7, timeout, extra)
 
-    def tx_gdy(self):
-        return self.tx_6560(self.local_addr2, self.BROADCAST2,
+    def tx_gdy(self, to2=None):
+        return self.tx_6560(self.local_addr2, to2 or self.BROADCAST2,
                             0xa0, 0x00, 0x00, 0x00, 0x00, self.gettag(),
                             0x200, 0x5400, 0x00262200, 0x002622ff)
 
-    def tx_yield(self):
-        return self.tx_6560(self.local_addr2, self.BROADCAST2,
+    def tx_yield(self, to2=None):
+        return self.tx_6560(self.local_addr2, to2 or self.BROADCAST2,
                             0xa0, 0x00, 0x00, 0x00, 0x00, self.gettag(),
                             0x200, 0x5400, 0x00260100, 0x002601ff)
 
-    def tx_set_time(self, ts, tzoffset):
+    def tx_set_time(self, ts, tzoffset, to2=None):
         payload = bytearray()
         payload.extend(int2bytes32(0x00236d00))
         payload.extend(int2bytes32(ts))
@@ -401,95 +865,196 @@ class Connection(base.InverterConnection):
         payload.extend(int2bytes16(0))
         payload.extend(int2bytes32(0x007efe30))
         payload.extend(int2bytes32(0x00000001))
-        return self.tx_6560(self.local_addr2, self.BROADCAST2,
+        return self.tx_6560(self.local_addr2, to2 or self.BROADCAST2,
                             0xa0, 0x00, 0x00, 0x00, 0x00, self.gettag(),
                             0x20a, 0xf000, 0x00236d00, 0x00236d00, payload)
 
-    def tx_historic(self, fromtime, totime):
-        return self.tx_6560(self.local_addr2, self.BROADCAST2,
+    def tx_spot(self, subtype, first, last, to2=None):
+        return self.tx_6560(self.local_addr2, to2 or self.BROADCAST2,
+                            0xa0, 0x00, 0x00, 0x00, 0x00, self.gettag(),
+                            0x200, subtype, first, last)
+
+    def tx_historic(self, fromtime, totime, to2=None):
+        return self.tx_6560(self.local_addr2, to2 or self.BROADCAST2,
                             0xe0, 0x00, 0x00, 0x00, 0x00, self.gettag(),
                             0x200, 0x7000, fromtime, totime)
 
-    def tx_historic_daily(self, fromtime, totime):
-        return self.tx_6560(self.local_addr2, self.BROADCAST2,
+    def tx_historic_daily(self, fromtime, totime, to2=None):
+        return self.tx_6560(self.local_addr2, to2 or self.BROADCAST2,
                             0xe0, 0x00, 0x00, 0x00, 0x00, self.gettag(),
                             0x200, 0x7020, fromtime, totime)
 
-    def wait(self, class_, cond=None):
-        self.waitvar = None
-        setattr(self, '__waitcond_rx_' + class_, cond)
-        while self.waitvar is None:
-            self.rx()
-        delattr(self, '__waitcond_rx_' + class_)
-        return self.waitvar
+    def expect_6560(self, tag, multi=False, unit=None):
+        """Register interest in the reply to the request with tag
+
+        Any number of requests may be outstanding at once; the replies
+        are matched up by tag as they arrive.  If unit is given, only
+        replies from that 6560 address are accepted.
+        """
+        if tag in self.pending:
+            return self.pending[tag]
+        reply = PendingReply(tag, multi, self.rtt.rto, unit)
+        self.pending[tag] = reply
+        return reply
+
+    def request(self, txfn, *args, multi=False, retry=True, to2=None,
+                windowed=False):
+        """Send a request with txfn(*args) and expect its reply
+
+        The reply is decoded by the decoder registered in RESPONSES
+        for its kind.  If retry is set, the request must be
+        idempotent: if the reply doesn't arrive in time it is sent
+        again with a fresh tag.  If to2 is given, the request goes to
+        that unit alone, rather than being broadcast.
+
+        If windowed is set, the request is for historic data, with
+        its first two arguments giving the time range.  Should only
+        part of the reply arrive, only the rest is requested again.
+        """
+        if to2 is not None:
+            txfn = functools.partial(txfn, to2=to2)
+        tag = txfn(*args)
+        reply = PendingReply(tag, multi, self.rtt.rto, to2, decode=True)
+        self.pending[tag] = reply
+        if retry:
+            reply.resend = functools.partial(txfn, *args)
+            if windowed:
+                reply.window = args[:2]
+                reply.refetch = txfn
+        return reply
+
+    def retransmit(self, reply):
+        # The earlier tags stay registered, in case the reply to one
+        # of them was only delayed
+        reply.timeout = self.rtt.backoff(reply.timeout)
+        reply.restart(reply.resend())
+        self.pending[reply.tag] = reply
+
+    def recover(self, reply):
+        """Request just the parts of a partial reply which are missing"""
+        if reply.children is None:
+            # Stop collecting the original reply, and fill in the gaps
+            # in what we have of it
+            self.retire(reply)
+            reply.children = []
+            gaps = historic_gaps(reply.fragments, reply.expected,
+                                 *reply.window)
+        else:
+            # Ask again for the gaps which are still missing
+            gaps = [c.window for c in reply.children if not c.done]
+            for child in reply.children:
+                self.retire(child)
+            reply.children = [c for c in reply.children if c.done]
+
+        reply.retries += 1
+        reply.timeout = self.rtt.backoff(reply.timeout)
+        reply.touch()
+        for start, end in gaps:
+            child = PendingReply(reply.refetch(start, end), True,
+                                 reply.timeout, reply.unit)
+            child.window = (start, end)
+            child.parent = reply
+            reply.children.append(child)
+            self.pending[child.tag] = child
+        reply.adopt()
+
+    def retire(self, pending):
+        """Forget every tag under which pending was registered"""
+        for tag in pending.tags:
+            if self.pending.get(tag) is pending:
+                del self.pending[tag]
+        for child in getattr(pending, 'children', None) or ():
+            self.retire(child)
+
+    def abandon(self, pending):
+        """Stop waiting for pending
+
+        Any reply that turns up later goes to subscribers, if any.
+        """
+        if isinstance(pending, (PendingReply, PendingUnits)):
+            self.retire(pending)
+
+    def time_left(self, pending):
+        """Seconds left to wait for pending
+
+        Retransmits the request if it has already timed out and can
+        be resent, otherwise raises Timeout.
+        """
+        remaining = pending.remaining()
+        while (remaining is not None) and (remaining <= 0):
+            if (pending.resend is None) or \
+               (pending.retries >= self.MAXRETRIES):
+                self.abandon(pending)
+                self.stats.timeouts += 1
+                raise Timeout("Timed out waiting for reply from %s"
+                              " after %d retries"
+                              % (ba2bytes(self.remote_addr),
+                                 pending.retries))
+            if isinstance(pending, PendingReply) and pending.recoverable():
+                self.stats.recoveries += 1
+                self.recover(pending)
+            else:
+                self.stats.retransmits += 1
+                self.retransmit(pending)
+            remaining = pending.remaining()
+        return remaining
+
+    def wait_for(self, pending):
+        try:
+            while not pending.done:
+                self.rx(self.time_left(pending))
+        except Error as e:
+            self.trace_error(e)
+            raise
+        return pending.result()
+
+    def collect(self, pending):
+        """Receive until pending completes or times out"""
+        try:
+            remaining = pending.remaining()
+            while (not pending.done) and (remaining > 0):
+                self.rx(remaining)
+                remaining = pending.remaining()
+        finally:
+            self.abandon(pending)
+        return pending
 
     def wait_outer(self, wtype, wpl=bytearray()):
-        def wfn(from_, to_, type_, payload):
-            if ((type_ == wtype) and payload.startswith(wpl)):
-                return payload
-        return self.wait('outer', wfn)
+        w = PendingOuter(wtype, wpl, self.rtt.rto)
+        self.outer_waiters.append(w)
+        try:
+            return self.wait_for(w)
+        finally:
+            if w in self.outer_waiters:
+                self.outer_waiters.remove(w)
 
     def wait_6560(self, wtag):
-        def tagfn(from2, to2, a2, b1, b2, c1, c2, tag,
-                  type_, subtype, arg1, arg2, extra,
-                  response, error, pktcount, first):
-            if response and (tag == wtag):
-                if (pktcount != 0) or not first:
-                    raise Error("Unexpected multipacket reply")
-                if error:
-                    raise Error("SMA device returned error 0x%x\n", error)
-                return (from2, type_, subtype, arg1, arg2, extra)
-        return self.wait('6560', tagfn)
+        return self.wait_for(self.expect_6560(wtag))
 
     def wait_6560_multi(self, wtag):
-        tmplist = []
-
-        def multiwait_6560(from2, to2, a2, b1, b2, c1, c2, tag,
-                           type_, subtype, arg1, arg2, extra,
-                           response, error, pktcount, first):
-            if not response or (tag != wtag):
-                return None
-
-            if not tmplist:
-                if not first:
-                    raise Error("Didn't see first packet of reply")
-
-                tmplist.append(pktcount + 1)  # Expected number of packets
-            else:
-                expected = tmplist[0]
-                sofar = len(tmplist) - 1
-                if pktcount != (expected - sofar - 1):
-                    raise Error("Got packet index %d instead of %d"
-                                % (pktcount, expected - sofar))
-
-            tmplist.append((from2, type_, subtype, arg1, arg2, extra))
-            if pktcount == 0:
-                return True
-
-        self.wait('6560', multiwait_6560)
-        assert(len(tmplist) == (tmplist[0] + 1))
-        return tmplist[1:]
+        return self.wait_for(self.expect_6560(wtag, multi=True))
 
     # Operations
 
     def hello(self):
-        hellopkt = self.wait_outer(OTYPE_HELLO)
-        if hellopkt != bytearray(b'\x00\x04\x70\x00\x01\x00\x00\x00' +
-                                 b'\x00\x01\x00\x00\x00'):
-            raise Error("Unexpected HELLO %r" % hellopkt)
-        self.tx_outer("00:00:00:00:00:00", self.remote_addr,
-                      OTYPE_HELLO, hellopkt)
-        self.wait_outer(0x05)
+        with self.stats.operation("hello"):
+            hellopkt = self.wait_outer(OTYPE_HELLO)
+            if hellopkt != HELLO_PAYLOAD:
+                raise Error("Unexpected HELLO %r" % hellopkt)
+            self.tx_outer(self.ZERO, self.remote_addr,
+                          OTYPE_HELLO, hellopkt)
+            self.wait_outer(0x05)
 
     def getvar(self, varid):
-        self.tx_outer("00:00:00:00:00:00", self.remote_addr, OTYPE_GETVAR,
+        self.tx_outer(self.ZERO, self.remote_addr, OTYPE_GETVAR,
                       int2bytes16(varid))
         val = self.wait_outer(OTYPE_VARVAL, int2bytes16(varid))
         return val[2:]
 
     def getsignal(self):
-        val = self.getvar(OVAR_SIGNAL)
-        return val[2] / 0xff
+        with self.stats.operation("getsignal"):
+            self.stats.signal = decode_signal(self.getvar(OVAR_SIGNAL))
+        return self.stats.signal
 
     def do_6560(self, a2, b1, b2, c1, c2, tag, type_, subtype, arg1, arg2,
                 payload=bytearray()):
@@ -498,51 +1063,162 @@ class Connection(base.InverterConnection):
         return self.wait_6560(tag)
 
     def logon(self, password=b'0000', timeout=900):
-        tag = self.tx_logon(password, timeout)
-        self.wait_6560(tag)
+        with self.stats.operation("logon"):
+            tag = self.tx_logon(password, timeout)
+            self.wait_6560(tag)
+
+    def expect_units(self, tag, wait=None, expect=None):
+        if wait is None:
+            wait = self.rtt.rto
+        units = PendingUnits(tag, wait, expect)
+        self.pending[tag] = units
+        return units
+
+    def discover(self, password=b'0000', timeout=900, wait=None,
+                 expect=None):
+        """Log on to every unit on the piconet
+
+        The logon is broadcast, and every inverter reachable through
+        this connection answers it.  Waits wait seconds (by default
+        the current retransmission timeout) for their replies, or
+        until expect units have answered, then returns a Unit for
+        each, through which it can be queried.
+        """
+        with self.stats.operation("discover"):
+            units = self.expect_units(self.tx_logon(password, timeout),
+                                      wait, expect)
+            self.collect(units)
+        return [Unit(self, addr2) for addr2 in units.units]
+
+    def total_yield(self, to2=None):
+        with self.stats.operation("total_yield"):
+            return self.wait_for(self.request(self.tx_yield, to2=to2))
+
+    def daily_yield(self, to2=None):
+        with self.stats.operation("daily_yield"):
+            return self.wait_for(self.request(self.tx_gdy, to2=to2))
+
+    def historic(self, fromtime, totime, to2=None):
+        with self.stats.operation("historic"):
+            reply = self.request(self.tx_historic, fromtime, totime,
+                                 multi=True, to2=to2, windowed=True)
+            return self.wait_for(reply)
+
+    def historic_daily(self, fromtime, totime, to2=None):
+        with self.stats.operation("historic_daily"):
+            reply = self.request(self.tx_historic_daily, fromtime, totime,
+                                 multi=True, to2=to2, windowed=True)
+            return self.wait_for(reply)
+
+    def spot(self, subtype, first, last, to2=None):
+        """Read every spot value with LRI in first..last at once
+
+        subtype must be one with a registered decoder, such as those
+        of SPOT_AC and SPOT_DC.
+        """
+        with self.stats.operation("spot"):
+            reply = self.request(self.tx_spot, subtype, first, last,
+                                 multi=True, to2=to2)
+            return self.wait_for(reply)
+
+    def spot_values(self, to2=None):
+        """Read all the AC and DC spot values
+
+        The AC and DC requests are both sent before waiting for
+        either reply, so this costs one round trip.
+        """
+        with self.stats.operation("spot_values"):
+            replies = [self.request(self.tx_spot, *ranges, multi=True,
+                                    to2=to2)
+                       for ranges in (SPOT_AC, SPOT_DC)]
+            values = {}
+            for reply in replies:
+                values.update(self.wait_for(reply))
+            return values
+
+    def historic_pipelined(self, fromtime, totime, window, inflight=4,
+                           daily=False, to2=None):
+        """Fetch historic data as a series of smaller windows
+
+        Splits fromtime..totime into windows of window seconds and
+        keeps up to inflight requests for them outstanding at once,
+        each with its own tag.  Yields (start, end, series) for each
+        window in time order as soon as it is complete, so callers
+        can store each piece as it arrives.
+        """
+        if daily:
+            txfn = self.tx_historic_daily
+        else:
+            txfn = self.tx_historic
+
+        windows = historic_windows(fromtime, totime, window)
+        queue = collections.deque()
+
+        def submit():
+            for start, end in itertools.islice(windows, 1):
+                reply = self.request(txfn, start, end, multi=True, to2=to2,
+                                     windowed=True)
+                queue.append((start, end, reply))
+
+        for i in range(inflight):
+            submit()
+
+        try:
+            while queue:
+                start, end, reply = queue.popleft()
+                with self.stats.operation("historic_window"):
+                    series = self.wait_for(reply)
+                submit()
+                yield start, end, series
+        finally:
+            # Don't leave the windows still queued registered, if a
+            # window failed or the caller stopped early
+            for start, end, reply in queue:
+                self.abandon(reply)
+
+    def set_time(self, newtime, tzoffset, to2=None):
+        self.tx_set_time(newtime, tzoffset, to2)
+
+
+class Unit(object):
+    """One inverter on the piconet, queried through a shared Connection
+
+    Has the same query operations as a Connection, but addresses each
+    request to this unit alone and only accepts its replies.  Works
+    equally with an AsyncConnection, whose operations return
+    coroutines.
+    """
+
+    def __init__(self, conn, addr2):
+        self.conn = conn
+        self.addr2 = bytes(addr2)
+        self.susyid, self.serial = decode_addr2(self.addr2)
+
+    def __repr__(self):
+        return "Unit(%04x:%d)" % (self.susyid, self.serial)
 
     def total_yield(self):
-        tag = self.tx_yield()
-        from2, type_, subtype, arg1, arg2, extra = self.wait_6560(tag)
-        timestamp = bytes2int(extra[4:8])
-        total = bytes2int(extra[8:12])
-        return timestamp, total
+        return self.conn.total_yield(to2=self.addr2)
 
     def daily_yield(self):
-        tag = self.tx_gdy()
-        from2, type_, subtype, arg1, arg2, extra = self.wait_6560(tag)
-        timestamp = bytes2int(extra[4:8])
-        daily = bytes2int(extra[8:12])
-        return timestamp, daily
+        return self.conn.daily_yield(to2=self.addr2)
 
     def historic(self, fromtime, totime):
-        tag = self.tx_historic(fromtime, totime)
-        data = self.wait_6560_multi(tag)
-        points = []
-        for from2, type_, subtype, arg1, arg2, extra in data:
-            while extra:
-                timestamp = bytes2int(extra[0:4])
-                val = bytes2int(extra[4:8])
-                extra = extra[12:]
-                if val != 0xffffffff:
-                    points.append((timestamp, val))
-        return points
+        return self.conn.historic(fromtime, totime, to2=self.addr2)
 
     def historic_daily(self, fromtime, totime):
-        tag = self.tx_historic_daily(fromtime, totime)
-        data = self.wait_6560_multi(tag)
-        points = []
-        for from2, type_, subtype, arg1, arg2, extra in data:
-            while extra:
-                timestamp = bytes2int(extra[0:4])
-                val = bytes2int(extra[4:8])
-                extra = extra[12:]
-                if val != 0xffffffff:
-                    points.append((timestamp, val))
-        return points
+        return self.conn.historic_daily(fromtime, totime, to2=self.addr2)
+
+    def historic_pipelined(self, fromtime, totime, window, inflight=4,
+                           daily=False):
+        return self.conn.historic_pipelined(fromtime, totime, window,
+                                            inflight, daily, to2=self.addr2)
+
+    def spot_values(self):
+        return self.conn.spot_values(to2=self.addr2)
 
     def set_time(self, newtime, tzoffset):
-        self.tx_set_time(newtime, tzoffset)
+        return self.conn.set_time(newtime, tzoffset, to2=self.addr2)
 
 
 def ptime(str):
@@ -569,6 +1245,15 @@ def cmd_daily(sma, args):
           % (format_time(timestamp), daily))
 
 
+def cmd_spot(sma, args):
+    if len(args) != 1:
+        print("Command usage: spot")
+        sys.exit(1)
+
+    for name, (timestamp, value, unit) in sorted(sma.spot_values().items()):
+        print("%s: %s %s %s" % (format_time(timestamp), name, value, unit))
+
+
 def cmd_historic(sma, args):
     fromtime = ptime("2013-01-01")
     totime = int(time.time())  # Now
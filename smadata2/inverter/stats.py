@@ -0,0 +1,181 @@
+#! /usr/bin/python3
+#
+# smadata2.inverter.stats - Link statistics and operation latencies
+# Copyright (C) 2014 David Gibson <david@gibson.dropbear.id.au>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import bisect
+import contextlib
+import time
+
+__all__ = ['LatencyHistogram', 'OperationStats', 'LinkStats']
+
+# Upper bounds, in seconds, of the latency histogram buckets.  The
+# last bucket takes everything slower.
+BUCKETS = (0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0, 5.0, 10.0, 20.0,
+           60.0)
+
+# Link counters, in the order they are reported
+COUNTERS = ('bytes_rx', 'bytes_tx', 'packets_rx', 'packets_tx',
+            'frames_rx', 'frames_tx', 'header_errors', 'crc_errors',
+            'retransmits', 'recoveries', 'timeouts')
+
+
+class LatencyHistogram(object):
+    """Count latencies into the fixed buckets of BUCKETS"""
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.n = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, latency):
+        self.counts[bisect.bisect_left(BUCKETS, latency)] += 1
+        self.n += 1
+        self.total += latency
+        if (self.min is None) or (latency < self.min):
+            self.min = latency
+        if (self.max is None) or (latency > self.max):
+            self.max = latency
+
+    def mean(self):
+        if not self.n:
+            return None
+        return self.total / self.n
+
+    def percentile(self, p):
+        """Upper bound of the bucket holding the p-th percentile
+
+        This is the largest latency seen if that's in the last,
+        unbounded, bucket.
+        """
+        if not self.n:
+            return None
+        rank = p * self.n / 100.0
+        seen = 0
+        for bound, count in zip(BUCKETS, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def as_dict(self):
+        return {
+            "count": self.n,
+            "total": self.total,
+            "min": self.min,
+            "max": self.max,
+            "buckets": list(BUCKETS) + [None],
+            "counts": list(self.counts),
+        }
+
+
+class OperationStats(object):
+    """Calls, failures, latencies and traffic for one kind of operation
+
+    The traffic is the link's traffic while the operation was running,
+    which includes that of anything else running at the same time.
+    """
+
+    def __init__(self):
+        self.calls = 0
+        self.failures = 0
+        self.latency = LatencyHistogram()
+        self.bytes_rx = 0
+        self.bytes_tx = 0
+        self.packets_rx = 0
+        self.packets_tx = 0
+
+    def as_dict(self):
+        return {
+            "calls": self.calls,
+            "failures": self.failures,
+            "latency": self.latency.as_dict(),
+            "bytes_rx": self.bytes_rx,
+            "bytes_tx": self.bytes_tx,
+            "packets_rx": self.packets_rx,
+            "packets_tx": self.packets_tx,
+        }
+
+
+class LinkStats(object):
+    """Counters for a link to an inverter, and its operations' latencies
+
+    The counters are plain attributes, named in COUNTERS.  Packets are
+    outer protocol packets, frames are PPP frames.  signal is the last
+    getsignal() reading, if any.
+    """
+
+    def __init__(self):
+        for name in COUNTERS:
+            setattr(self, name, 0)
+        self.signal = None
+        self.operations = dict()
+
+    @contextlib.contextmanager
+    def operation(self, name):
+        """Time the body of the with statement as operation name"""
+        op = self.operations.get(name)
+        if op is None:
+            op = self.operations[name] = OperationStats()
+        bytes_rx, bytes_tx = self.bytes_rx, self.bytes_tx
+        packets_rx, packets_tx = self.packets_rx, self.packets_tx
+        start = time.monotonic()
+        try:
+            yield op
+        except BaseException:
+            op.failures += 1
+            raise
+        else:
+            op.latency.add(time.monotonic() - start)
+        finally:
+            op.calls += 1
+            op.bytes_rx += self.bytes_rx - bytes_rx
+            op.bytes_tx += self.bytes_tx - bytes_tx
+            op.packets_rx += self.packets_rx - packets_rx
+            op.packets_tx += self.packets_tx - packets_tx
+
+    def as_dict(self):
+        d = dict((name, getattr(self, name)) for name in COUNTERS)
+        d["signal"] = self.signal
+        d["operations"] = dict((name, op.as_dict())
+                               for name, op in self.operations.items())
+        return d
+
+    def format(self):
+        """Describe the statistics as a list of lines of text"""
+        lines = ["  " + ", ".join("%s %d" % (name.replace('_', ' '),
+                                             getattr(self, name))
+                                  for name in COUNTERS[:6]),
+                 "  " + ", ".join("%s %d" % (name.replace('_', ' '),
+                                             getattr(self, name))
+                                  for name in COUNTERS[6:])]
+        if self.signal is not None:
+            lines.append("  signal %.1f%%" % (self.signal * 100))
+        for name in sorted(self.operations):
+            op = self.operations[name]
+            hist = op.latency
+            line = "  %-16s %4d calls %3d failed" % (name, op.calls,
+                                                     op.failures)
+            if hist.n:
+                line += (", latency mean %.3fs p50 %.3fs p90 %.3fs"
+                         " max %.3fs" % (hist.mean(), hist.percentile(50),
+                                         hist.percentile(90), hist.max))
+            line += ", %d/%d bytes rx/tx" % (op.bytes_rx, op.bytes_tx)
+            lines.append(line)
+        return lines
@@ -0,0 +1,984 @@
+#! /usr/bin/python3
+
+import asyncio
+import io
+import random
+import socket
+import struct
+import threading
+import time
+
+from nose.tools import assert_equals, raises
+
+from smadata2.inverter import smabluetooth, asyncbluetooth, capture, codec
+from smadata2.inverter import simulator, stats, trace
+from smadata2.inverter.base import HistoricSeries
+from smadata2.inverter.smabluetooth import Error, Timeout
+from smadata2.inverter.base import HeaderError, CRCError
+
+
+class LoopbackSocket(object):
+    def __init__(self):
+        self.sent = []
+
+    def getsockname(self):
+        return ("00:11:22:33:44:55", 1)
+
+    def sendall(self, data):
+        self.sent.append(bytes(data))
+
+
+class LoopbackConnection(smabluetooth.Connection):
+    """Connection which receives whatever it transmits, no socket needed"""
+
+    def __init__(self):
+        super(LoopbackConnection, self).__init__("00:80:25:00:00:01",
+                                                 LoopbackSocket())
+        self.received = []
+
+    @property
+    def sent(self):
+        return self.sock.sent
+
+    def rx_6560(self, *args):
+        self.received.append(args)
+        super(LoopbackConnection, self).rx_6560(*args)
+
+    def loop(self):
+        sent = self.sock.sent
+        self.sock.sent = []
+        for pkt in sent:
+            self.rx_raw(bytearray(pkt))
+
+    def rx(self, timeout=None):
+        if not self.sent:
+            if timeout is None:
+                raise Error("Nothing to receive")
+            time.sleep(timeout)
+        self.loop()
+
+    def reply(self, tag, extra=bytearray(), error=0, pktcount=0, first=True,
+              subtype=0x5400):
+        self.tx_6560(self.local_addr2, self.local_addr2, 0xa0, 0, 0, 0, 0,
+                     tag, 0x200, subtype, 0, 0, extra, response=True,
+                     error=error, pktcount=pktcount, first=first)
+
+
+def test_bytes2int():
+    assert_equals(smabluetooth.bytes2int(b'\x34\x12'), 0x1234)
+    assert_equals(smabluetooth.bytes2int(memoryview(b'\x78\x56\x34\x12')),
+                  0x12345678)
+    assert_equals(smabluetooth.bytes2int(b''), 0)
+
+
+def test_ppp_unescape():
+    assert_equals(codec.ppp_unescape(b'\x01\x02'), b'\x01\x02')
+    assert_equals(codec.ppp_unescape(b'\x7d\x5e\x01\x7d\x5d\x7d\x31'),
+                  b'\x7e\x01\x7d\x11')
+
+
+def test_crc16_known():
+    # CRC-16/X.25 check value
+    assert_equals(codec.crc16(0xffff, b'123456789'), 0x906e)
+    assert_equals(codec.crc16_reference(0xffff, b'123456789'), 0x906e)
+
+
+def test_crc16_random():
+    rng = random.Random(0x6560)
+    for i in range(500):
+        data = bytes(rng.getrandbits(8) for j in range(rng.randrange(300)))
+        iv = rng.getrandbits(16)
+        assert_equals(codec.crc16(iv, data),
+                      codec.crc16_reference(iv, data))
+        assert_equals(codec.crc16(iv, memoryview(data)),
+                      codec.crc16_reference(iv, data))
+
+
+@raises(Error)
+def test_ppp_unescape_bad():
+    codec.ppp_unescape(b'\x01\x7d\x7d\x02')
+
+
+def test_codec_outer():
+    addr = b'\x01\x00\x00\x25\x80\x00'
+    pkt = codec.encode_outer(addr, bytes(6), codec.OTYPE_HELLO,
+                             codec.HELLO_PAYLOAD)
+    outer = codec.decode_outer(pkt)
+    assert_equals(outer, codec.OuterPacket(addr, bytes(6), codec.OTYPE_HELLO,
+                                           codec.HELLO_PAYLOAD))
+    assert_equals(codec.ba2bytes(outer.from_), "00:80:25:00:00:01")
+    assert_equals(codec.bytes2ba("00:80:25:00:00:01"), addr)
+
+
+def test_codec_6560_roundtrip():
+    from2 = b'\x78\x00\x3f\x10\xfb\x39'
+    to2 = b'\x7d\x00\x11\x22\x33\x44'
+    payload = codec.encode_6560(from2, to2, 0xa0, 0x00, 0x01, 0x00, 0x01,
+                                0x1234, 0x200, 0x5400, 0x00262200,
+                                0x002622ff, b'\x7e\x7d\x11\x13',
+                                response=True, pktcount=2)
+    inner = codec.decode_6560(payload)
+    assert_equals(inner, codec.InnerPacket(from2, to2, 0xa0, 0x00, 0x01,
+                                           0x00, 0x01, 0x1234, 0x200,
+                                           0x5400, 0x00262200, 0x002622ff,
+                                           b'\x7e\x7d\x11\x13', True, 0,
+                                           2, True))
+
+
+@raises(Error)
+def test_codec_6560_bad_length():
+    payload = codec.encode_6560(bytes(6), bytes(6), 0, 0, 0, 0, 0, 1,
+                                0x200, 0x5400, 0, 0, bytes(8))
+    codec.decode_6560(payload[:-4])
+
+
+def test_codec_ppp_escape():
+    data = bytes(range(256))
+    escaped = codec.ppp_escape(data)
+    assert_equals(len(escaped), 256 + 4)
+    for b in (0x7e, 0x11, 0x13):
+        assert bytes([b]) not in escaped
+    assert_equals(codec.ppp_unescape(escaped), data)
+
+
+def test_codec_template():
+    from2 = b'\x78\x00\x3f\x10\xfb\x39'
+    to2 = b'\xff' * 6
+    template = codec.FrameTemplate(from2, to2, 0xa0, 0, 0, 0, 0, 0x200,
+                                   0x5400, 8, response=True)
+    # Reusing the template must give the same frames as building each
+    # one from scratch
+    for tag, arg1, arg2, extra, pktcount, first in [
+            (1, 0x00262200, 0x002622ff, bytes(8), 0, True),
+            (0x7d7e, 0x11, 0x7e7e7e7e, b'\x13\x11\x7d\x7e' * 2, 3, False),
+            (0x7fff, 0, 0xffffffff, bytes(range(8)), 1, True)]:
+        payload = codec.encode_6560(from2, to2, 0xa0, 0, 0, 0, 0, tag,
+                                    0x200, 0x5400, arg1, arg2, extra,
+                                    True, 0, pktcount, first)
+        assert_equals(template.build(tag, arg1, arg2, extra, pktcount, first),
+                      codec.encode_ppp(codec.SMA_PROTOCOL_ID, payload))
+
+
+def codec_stream(extra):
+    payload = codec.encode_6560(bytes(6), b'\xff' * 6, 0xa0, 0, 0, 0, 0,
+                                7, 0x200, 0x5400, 1, 2, extra)
+    raw = codec.encode_ppp(codec.SMA_PROTOCOL_ID, payload)
+    stream = bytearray()
+    for type_, piece in codec.ppp_pieces(raw):
+        stream += codec.encode_outer(b'\x01\x00\x00\x25\x80\x00', bytes(6),
+                                     type_, piece)
+    return stream
+
+
+def test_codec_events():
+    extra = bytes(range(200))
+    stream = codec_stream(extra)
+    # Fed in small pieces, so packets straddle the reads
+    decoder = codec.Decoder(256, 64, 128)
+    events = []
+    for i in range(0, len(stream), 37):
+        for event in decoder.events(stream[i:i + 37]):
+            if isinstance(event, codec.OuterPacket):
+                events.append(event.type_)
+            elif isinstance(event, codec.PPPFrame):
+                events.append(event.protocol)
+            else:
+                events.append(event)
+
+    inner = events[-1]
+    assert_equals(events[:-1], [codec.OTYPE_PPP2, codec.OTYPE_PPP2,
+                                codec.OTYPE_PPP, codec.SMA_PROTOCOL_ID])
+    assert_equals(inner.tag, 7)
+    assert_equals((inner.arg1, inner.arg2), (1, 2))
+    assert_equals(bytes(inner.extra), extra)
+    assert_equals(decoder.rxstart, decoder.rxend)
+
+
+@raises(Error)
+def test_codec_bad_crc():
+    stream = codec_stream(bytes(8))
+    # Corrupt the last byte before the closing flag
+    stream[-2] ^= 0x01
+    list(codec.Decoder().events(stream))
+
+
+def test_link_stats_errors():
+    stream = codec_stream(bytes(8))
+    stream[-2] ^= 0x01
+    conn = LoopbackConnection()
+    try:
+        conn.rx_data(stream)
+        assert False, "Expected CRC error"
+    except CRCError:
+        pass
+    assert_equals((conn.stats.crc_errors, conn.stats.header_errors), (1, 0))
+
+    stream = codec_stream(bytes(8))
+    stream[3] ^= 0x01
+    conn = LoopbackConnection()
+    try:
+        conn.rx_data(stream)
+        assert False, "Expected header error"
+    except HeaderError:
+        pass
+    assert_equals((conn.stats.crc_errors, conn.stats.header_errors), (0, 1))
+
+
+def test_latency_histogram():
+    hist = stats.LatencyHistogram()
+    assert_equals(hist.percentile(50), None)
+    for latency in [0.005, 0.015, 0.015, 0.3, 100.0]:
+        hist.add(latency)
+    assert_equals(hist.n, 5)
+    assert_equals((hist.min, hist.max), (0.005, 100.0))
+    assert_equals(hist.percentile(20), 0.01)
+    assert_equals(hist.percentile(50), 0.02)
+    assert_equals(hist.percentile(80), 0.5)
+    assert_equals(hist.percentile(100), 100.0)
+    assert_equals(sum(hist.as_dict()["counts"]), 5)
+
+
+class TestLoopback6560(object):
+    def setUp(self):
+        self.conn = LoopbackConnection()
+
+    def check_roundtrip(self, extra):
+        conn = self.conn
+        conn.tx_6560(conn.local_addr2, conn.BROADCAST2, 0xa0, 0x00, 0x01,
+                     0x02, 0x03, 0x1234, 0x200, 0x7000, 0x7e7d1113,
+                     0xdeadbeef, extra, response=True, error=0x11,
+                     pktcount=3, first=False)
+        conn.loop()
+
+        assert_equals(len(conn.received), 1)
+        (from2, to2, a2, b1, b2, c1, c2, tag, type_, subtype, arg1, arg2,
+         rextra, response, error, pktcount, first) = conn.received[0]
+        assert_equals(from2, conn.local_addr2)
+        assert_equals(to2, conn.BROADCAST2)
+        assert_equals((a2, b1, b2, c1, c2), (0xa0, 0x00, 0x01, 0x02, 0x03))
+        assert_equals(tag, 0x1234)
+        assert_equals((type_, subtype), (0x200, 0x7000))
+        assert_equals((arg1, arg2), (0x7e7d1113, 0xdeadbeef))
+        assert_equals(bytes(rextra), bytes(extra))
+        assert response
+        assert not first
+        assert_equals(error, 0x11)
+        assert_equals(pktcount, 3)
+
+    def test_roundtrip(self):
+        self.check_roundtrip(bytearray())
+        self.conn.received = []
+        self.check_roundtrip(bytearray(b'\x7e\x7d\x11\x13' * 2))
+
+    def test_long_frame(self):
+        self.check_roundtrip(bytearray(range(256)) * 2)
+
+
+def historic_payload(points):
+    return b''.join(struct.pack('<III', ts, val, 0) for ts, val in points)
+
+
+def test_decode_historic():
+    points = [(1000 + 300*i, 50*i) for i in range(20)]
+    extras = [historic_payload(points[:7]),
+              memoryview(historic_payload(points[7:]))]
+    series = smabluetooth.decode_historic(extras)
+    assert isinstance(series, HistoricSeries)
+    assert_equals(len(series), len(points))
+    assert_equals(list(series), points)
+    assert_equals(series[0], points[0])
+    assert_equals(series[-1], points[-1])
+    assert_equals(list(series[2:4]), points[2:4])
+
+
+def test_decode_historic_nodata():
+    points = [(1000, 1), (1300, 0xffffffff), (1600, 2), (1900, 0xffffffff)]
+    series = smabluetooth.decode_historic([historic_payload(points)])
+    assert_equals(list(series), [(1000, 1), (1600, 2)])
+
+
+def test_decode_historic_empty():
+    series = smabluetooth.decode_historic([])
+    assert_equals(len(series), 0)
+    assert not series
+
+
+@raises(Error)
+def test_decode_historic_bad_length():
+    smabluetooth.decode_historic([b'\x00' * 13])
+
+
+def spot_payload(records):
+    return b''.join(struct.pack('<IIi16x', code, ts, value)
+                    for code, ts, value in records)
+
+
+def test_decode_spot():
+    extra = spot_payload([(0x40263f01, 1000, 1234),
+                          (0x40465701, 1000, 5002),
+                          (0x40451f02, 1000, 41050),
+                          (0x40999901, 1000, 7),
+                          (0x40452101, 1000, -0x80000000)])
+    values = smabluetooth.decode_spot([extra[:28], extra[28:]])
+    assert_equals(values, {
+        "ac_power": (1000, 1234, "W"),
+        "grid_frequency": (1000, 50.02, "Hz"),
+        "dc_voltage_2": (1000, 410.5, "V"),
+        "dc_current_1": (1000, None, "A"),
+    })
+
+
+@raises(Error)
+def test_decode_spot_bad_length():
+    smabluetooth.decode_spot([b'\x00' * 30])
+
+
+class TestPending(object):
+    def setUp(self):
+        self.conn = LoopbackConnection()
+
+    def test_interleaved(self):
+        conn = self.conn
+        r1 = conn.expect_6560(1)
+        r2 = conn.expect_6560(2, multi=True)
+        r3 = conn.expect_6560(3)
+
+        conn.reply(2, b'\x02\x00\x00\x00', pktcount=1, first=True)
+        conn.reply(3, b'\x03\x00\x00\x00')
+        conn.reply(2, b'\x12\x00\x00\x00', pktcount=0, first=False)
+        # Reply to something nobody is waiting for
+        conn.reply(4)
+        conn.reply(1, b'\x01\x00\x00\x00')
+
+        assert_equals(bytes(conn.wait_for(r3)[5]), b'\x03\x00\x00\x00')
+        assert r1.done
+        assert r2.done
+        assert_equals(conn.pending, {})
+
+        assert_equals(bytes(r1.result()[5]), b'\x01\x00\x00\x00')
+        assert_equals([bytes(p[5]) for p in r2.result()],
+                      [b'\x02\x00\x00\x00', b'\x12\x00\x00\x00'])
+
+    @raises(Error)
+    def test_error(self):
+        conn = self.conn
+        r1 = conn.expect_6560(1)
+        r2 = conn.expect_6560(2)
+        conn.reply(1, error=0x15)
+        conn.reply(2)
+        conn.loop()
+        assert r2.result()
+        conn.wait_for(r1)
+
+    def test_late_reply_after_resend(self):
+        conn = self.conn
+        reply = conn.request(conn.tx_yield)
+        first = reply.tag
+        # Time out, so the request is resent with a new tag
+        reply.touched -= reply.timeout + 1
+        conn.time_left(reply)
+        assert reply.tag != first
+
+        # The reply to the first copy is just late
+        conn.reply(first, struct.pack('<III', 0x00260101, 1000, 42))
+        assert_equals(conn.wait_for(reply), smabluetooth.Yield(1000, 42))
+        assert_equals(conn.pending, {})
+
+    def test_subscribe(self):
+        conn = self.conn
+        got = []
+        conn.subscribe(0x200, 0x7000,
+                       lambda from2, series: got.append(list(series)))
+        reply = conn.request(conn.tx_historic, 0, 600, multi=True,
+                             retry=False)
+        conn.abandon(reply)
+
+        # Replies to the abandoned request, and to one nobody asked
+        # for, go to the subscriber
+        for tag in (reply.tag, 100):
+            conn.reply(tag, historic_payload([(0, 1)]), pktcount=1,
+                       subtype=0x7000)
+            conn.reply(tag, historic_payload([(300, 2)]), first=False,
+                       subtype=0x7000)
+        # Replies of other kinds don't
+        conn.reply(101, struct.pack('<III', 0x00260101, 1000, 42))
+        conn.loop()
+        assert_equals(got, [[(0, 1), (300, 2)]] * 2)
+        assert_equals(conn.unsolicited, {})
+
+    def test_decode_response_unknown(self):
+        packets = [(b'\x00' * 6, 0x200, 0x1234, 0, 0, b'')]
+        assert_equals(smabluetooth.decode_response(packets), packets)
+
+    def test_multi_out_of_sequence(self):
+        conn = self.conn
+        reply = conn.expect_6560(7, multi=True)
+        conn.reply(7, b'\x03\x00\x00\x00', pktcount=2, first=True)
+        conn.reply(7, b'\x01\x00\x00\x00', pktcount=0, first=False)
+        conn.loop()
+        # Still waiting for the middle packet
+        assert not reply.done
+        conn.reply(7, b'\x01\x00\x00\x00', pktcount=0, first=False)
+        conn.reply(7, b'\x02\x00\x00\x00', pktcount=1, first=False)
+        assert_equals([bytes(p[5]) for p in conn.wait_for(reply)],
+                      [b'\x03\x00\x00\x00', b'\x02\x00\x00\x00',
+                       b'\x01\x00\x00\x00'])
+
+    @raises(Error)
+    def test_multi_bad_index(self):
+        conn = self.conn
+        conn.reply(7, pktcount=3, first=False)
+        conn.reply(7, pktcount=1, first=True)
+        conn.wait_6560_multi(7)
+
+
+def test_async_yield():
+    peer = LoopbackConnection()
+    peer.reply(1, struct.pack('<III', 0x00260101, 1400000000, 12345))
+    a, b = socket.socketpair()
+
+    async def run():
+        conn = asyncbluetooth.AsyncConnection("00:80:25:00:00:01", a)
+        try:
+            return await conn.total_yield()
+        finally:
+            conn.close()
+
+    b.sendall(b''.join(peer.sent))
+    assert_equals(asyncio.run(run()), (1400000000, 12345))
+    b.close()
+
+
+def test_historic_windows():
+    assert_equals(list(smabluetooth.historic_windows(0, 999, 300)),
+                  [(0, 299), (300, 599), (600, 899), (900, 999)])
+    assert_equals(list(smabluetooth.historic_windows(0, 299, 300)),
+                  [(0, 299)])
+    assert_equals(list(smabluetooth.historic_windows(10, 5, 300)), [])
+
+
+def historic_fragments(pieces):
+    return {pktcount: (None, 0x200, 0x7000, 0, 0, historic_payload(points))
+            for pktcount, points in pieces}
+
+
+def test_historic_gaps():
+    a = [(300, 1), (600, 2)]
+    b = [(900, 3), (1200, 4)]
+    c = [(1500, 5)]
+    # Complete, so nothing is missing
+    assert_equals(smabluetooth.historic_gaps(
+        historic_fragments([(2, a), (1, b), (0, c)]), 3, 0, 2000), [])
+    # Middle, last and first packets missing
+    assert_equals(smabluetooth.historic_gaps(
+        historic_fragments([(2, a), (0, c)]), 3, 0, 2000), [(601, 1499)])
+    assert_equals(smabluetooth.historic_gaps(
+        historic_fragments([(2, a), (1, b)]), 3, 0, 2000), [(1201, 2000)])
+    assert_equals(smabluetooth.historic_gaps(
+        historic_fragments([(1, b), (0, c)]), None, 0, 2000), [(0, 899)])
+    # Only the middle packet arrived
+    assert_equals(smabluetooth.historic_gaps(
+        historic_fragments([(1, b)]), None, 0, 2000),
+        [(0, 899), (1201, 2000)])
+
+
+class LossyHistoricResponder(LoopbackConnection):
+    """Answers historic requests in packets of two records, but loses
+    the second packet of the first reply"""
+
+    def __init__(self):
+        super(LossyHistoricResponder, self).__init__()
+        self.requests = []
+        self.rtt.rto = 0.01
+
+    def tx_historic(self, fromtime, totime):
+        parent = super(LossyHistoricResponder, self)
+        tag = parent.tx_historic(fromtime, totime)
+        self.requests.append((fromtime, totime))
+        first = fromtime + (-fromtime % 300)
+        points = [(ts, ts // 300) for ts in range(first, totime + 1, 300)]
+        pieces = [points[i:i + 2] for i in range(0, len(points), 2)]
+        for i, piece in enumerate(pieces):
+            if (len(self.requests) == 1) and (i == 1):
+                continue
+            self.reply(tag, historic_payload(piece),
+                       pktcount=len(pieces) - i - 1, first=(i == 0),
+                       subtype=0x7000)
+        return tag
+
+
+def test_historic_recovery():
+    conn = LossyHistoricResponder()
+    series = conn.historic(0, 3000)
+    assert_equals(list(series), [(ts, ts // 300)
+                                 for ts in range(0, 3001, 300)])
+    # Only the range of the lost packet was asked for again
+    assert_equals(conn.requests, [(0, 3000), (301, 1199)])
+    assert_equals(conn.pending, {})
+
+
+class HistoricResponder(LoopbackConnection):
+    """Answers its own historic requests with one sample per 300s"""
+
+    def __init__(self):
+        super(HistoricResponder, self).__init__()
+        self.maxpending = 0
+
+    def tx_historic(self, fromtime, totime):
+        tag = super(HistoricResponder, self).tx_historic(fromtime, totime)
+        # Count the request we're about to register
+        self.maxpending = max(self.maxpending, len(self.pending) + 1)
+        first = fromtime + (-fromtime % 300)
+        points = [(ts, ts // 300) for ts in range(first, totime + 1, 300)]
+        self.reply(tag, historic_payload(points), subtype=0x7000)
+        return tag
+
+
+def test_historic_pipelined():
+    conn = HistoricResponder()
+    windows = list(conn.historic_pipelined(0, 3000, 600, inflight=3))
+    assert_equals([(start, end) for start, end, series in windows],
+                  [(0, 599), (600, 1199), (1200, 1799), (1800, 2399),
+                   (2400, 2999), (3000, 3000)])
+    points = []
+    for start, end, series in windows:
+        points.extend(series)
+    assert_equals(points, [(ts, ts // 300) for ts in range(0, 3001, 300)])
+    assert_equals(conn.maxpending, 3)
+    assert_equals(conn.pending, {})
+
+
+class SilentHistoricResponder(HistoricResponder):
+    """Answers historic requests only for windows before silent"""
+
+    def __init__(self, silent):
+        super(SilentHistoricResponder, self).__init__()
+        self.rtt = smabluetooth.RTTEstimator(initial=0.01, minrto=0.01,
+                                             maxrto=0.02)
+        self.silent = silent
+
+    def tx_historic(self, fromtime, totime):
+        if fromtime >= self.silent:
+            return LoopbackConnection.tx_historic(self, fromtime, totime)
+        return super(SilentHistoricResponder, self).tx_historic(fromtime,
+                                                                totime)
+
+
+@raises(Timeout)
+def test_historic_pipelined_timeout():
+    conn = SilentHistoricResponder(600)
+    try:
+        for window in conn.historic_pipelined(0, 3000, 600, inflight=3):
+            pass
+    finally:
+        # The windows queued behind the one that timed out are dropped
+        assert_equals(conn.pending, {})
+
+
+def test_historic_pipelined_close():
+    conn = SilentHistoricResponder(600)
+    windows = conn.historic_pipelined(0, 3000, 600, inflight=3)
+    next(windows)
+    assert_equals(len(conn.pending), 3)
+    windows.close()
+    assert_equals(conn.pending, {})
+
+
+def test_rtt_estimator():
+    rtt = smabluetooth.RTTEstimator(initial=3.0, minrto=0.5, maxrto=10.0)
+    assert_equals(rtt.rto, 3.0)
+    rtt.sample(1.0)
+    assert_equals((rtt.srtt, rtt.rttvar, rtt.rto), (1.0, 0.5, 3.0))
+    rtt.sample(1.0)
+    assert_equals((rtt.srtt, rtt.rttvar, rtt.rto), (1.0, 0.375, 2.5))
+    for i in range(100):
+        rtt.sample(0.01)
+    assert_equals(rtt.rto, 0.5)
+    assert_equals(rtt.backoff(4.0), 8.0)
+    assert_equals(rtt.backoff(8.0), 10.0)
+
+
+class LossyYieldResponder(LoopbackConnection):
+    """Answers yield requests, but ignores the first few"""
+
+    def __init__(self, drop):
+        super(LossyYieldResponder, self).__init__()
+        self.rtt = smabluetooth.RTTEstimator(initial=0.01, minrto=0.01)
+        self.drop = drop
+        self.tags = []
+
+    def tx_yield(self):
+        tag = super(LossyYieldResponder, self).tx_yield()
+        self.tags.append(tag)
+        if self.drop:
+            self.drop -= 1
+        else:
+            self.reply(tag, struct.pack('<III', 0x00260101, 1000, 42))
+        return tag
+
+
+def test_retransmit():
+    conn = LossyYieldResponder(2)
+    assert_equals(conn.total_yield(), (1000, 42))
+    assert_equals(len(conn.tags), 3)
+    assert_equals(len(set(conn.tags)), 3)
+    assert_equals(conn.pending, {})
+
+
+def test_timeout():
+    conn = LossyYieldResponder(100)
+    try:
+        conn.total_yield()
+        assert False, "Expected timeout"
+    except Timeout:
+        pass
+    assert_equals(len(conn.tags), conn.MAXRETRIES + 1)
+    assert_equals(conn.pending, {})
+
+
+def test_trace():
+    peer = LoopbackConnection()
+    tracer = peer.start_trace(8)
+    peer.reply(1, struct.pack('<III', 0x00260101, 1000, 42))
+    peer.loop()
+    events = tracer.events()
+    assert_equals([(e.direction, e.layer) for e in events],
+                  [(capture.DIR_TX, trace.LAYER_6560),
+                   (capture.DIR_TX, trace.LAYER_PPP),
+                   (capture.DIR_TX, trace.LAYER_OUTER),
+                   (capture.DIR_TX, trace.LAYER_RAW),
+                   (capture.DIR_RX, trace.LAYER_RAW),
+                   (capture.DIR_RX, trace.LAYER_OUTER),
+                   (capture.DIR_RX, trace.LAYER_PPP),
+                   (capture.DIR_RX, trace.LAYER_6560)])
+    assert_equals(events[0].fields, events[-1].fields)
+    tag, type_, subtype = events[-1].fields[2:5]
+    assert_equals((tag, type_, subtype), (1, 0x200, 0x5400))
+
+    # Only the latest events are kept
+    peer.reply(2, struct.pack('<III', 0x00260101, 1000, 42))
+    peer.loop()
+    assert_equals(len(tracer.events()), 8)
+    assert_equals(tracer.events()[0].fields[2], 2)
+
+    f = io.StringIO()
+    tracer.export(f)
+    lines = f.getvalue().splitlines()
+    assert_equals(len(lines), 8)
+    assert '"layer": "6560"' in lines[0]
+
+
+def test_trace_dump_on_timeout():
+    conn = LossyYieldResponder(100)
+    f = io.StringIO()
+    conn.start_trace(16, f)
+    try:
+        conn.total_yield()
+        assert False, "Expected timeout"
+    except Timeout:
+        pass
+    lines = f.getvalue().splitlines()
+    assert lines[0].startswith("Protocol trace leading up to Timeout")
+    assert_equals(len(lines), 17)
+    # The loopback sees its own last request, which went unanswered
+    assert "Rx< 6560" in lines[-1]
+    assert "tag=0x%x" % conn.tags[-1] in lines[-1]
+
+
+class SmallBufferConnection(smabluetooth.Connection):
+    MAXBUFFER = 256
+    MINREAD = 64
+    MAXREAD = 128
+
+
+def test_ring_buffer():
+    peer = LoopbackConnection()
+    for tag in range(1, 41):
+        peer.reply(tag, struct.pack('<III', 0x00260101, tag, 1000 + tag))
+    data = b''.join(peer.sent)
+
+    a, b = socket.socketpair()
+    conn = SmallBufferConnection("00:80:25:00:00:01", a)
+    replies = [conn.expect_6560(tag) for tag in range(1, 41)]
+    # Deliver in awkwardly sized pieces
+    while data:
+        b.sendall(data[:37])
+        data = data[37:]
+    b.close()
+
+    for tag, reply in enumerate(replies, 1):
+        assert_equals(smabluetooth.decode_yield(conn.wait_for(reply)),
+                      (tag, 1000 + tag))
+    assert_equals(conn.decoder.rxstart, conn.decoder.rxend)
+    a.close()
+
+
+class TimeoutCountingSocket(object):
+    """Wraps a socket, counting calls to settimeout()"""
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.settimeouts = 0
+
+    def __getattr__(self, name):
+        return getattr(self.sock, name)
+
+    def settimeout(self, timeout):
+        self.settimeouts += 1
+        self.sock.settimeout(timeout)
+
+
+def test_rx_timeout():
+    a, b = socket.socketpair()
+    sock = TimeoutCountingSocket(a)
+    conn = smabluetooth.Connection("00:80:25:00:00:01", sock)
+    conn.rx(0.01)
+    conn.rx(0.01)
+    assert_equals(sock.settimeouts, 1)
+    conn.rx(0.02)
+    assert_equals(sock.settimeouts, 2)
+    a.close()
+    b.close()
+
+
+def test_capture_replay():
+    peer = LoopbackConnection()
+    f = io.BytesIO()
+    peer.start_capture(f)
+    points = [(1000 + 300*i, i) for i in range(4)]
+    peer.reply(1, struct.pack('<III', 0x00260101, 1000, 42))
+    peer.reply(2, historic_payload(points))
+    peer.loop()
+
+    f.seek(0)
+    assert_equals(capture.read_header(f),
+                  ("00:11:22:33:44:55", "00:80:25:00:00:01"))
+    records = list(capture.read_capture(f))
+    assert_equals([d for d, ts, pkt in records],
+                  [capture.DIR_TX, capture.DIR_TX,
+                   capture.DIR_RX, capture.DIR_RX])
+    assert_equals([pkt for d, ts, pkt in records[2:]],
+                  [pkt for d, ts, pkt in records[:2]])
+
+    f.seek(0)
+    conn = capture.replay(f, smabluetooth.Connection)
+    r1 = conn.expect_6560(1)
+    r2 = conn.expect_6560(2, multi=True)
+    assert_equals(smabluetooth.decode_yield(conn.wait_for(r1)), (1000, 42))
+    assert_equals(list(smabluetooth.decode_historic(
+        p[5] for p in conn.wait_for(r2))), points)
+
+
+class TestSimulator(object):
+    def setUp(self):
+        self.sock, self.sim = simulator.simulate_pair(
+            history_days=3, records_per_packet=10, fragment=23, seed=1)
+        self.unit = self.sim.master
+        self.conn = smabluetooth.Connection(self.sim.bdaddr, self.sock)
+        self.conn.hello()
+
+    def tearDown(self):
+        self.conn.close()
+
+    def test_signal(self):
+        assert_equals(self.conn.getsignal(), 0xc0 / 0xff)
+
+    def test_stats(self):
+        conn = self.conn
+        conn.logon()
+        conn.getsignal()
+        now = self.unit.now()
+        conn.historic(now - 86400, now)
+        try:
+            conn.logon(b'1234')
+        except Error:
+            pass
+
+        link = conn.stats
+        assert_equals(link.signal, 0xc0 / 0xff)
+        assert_equals(sorted(link.operations),
+                      ["getsignal", "hello", "historic", "logon"])
+        logon = link.operations["logon"]
+        assert_equals((logon.calls, logon.failures, logon.latency.n),
+                      (2, 1, 1))
+        historic = link.operations["historic"]
+        assert_equals(historic.latency.n, 1)
+        # 24 hours of 5 minute samples, 10 to a packet
+        assert historic.packets_rx >= 29
+        assert historic.bytes_rx > 288 * 12
+        # One request packet for each operation
+        assert_equals(link.packets_tx, 5)
+        assert link.frames_rx <= link.packets_rx
+        assert_equals((link.crc_errors, link.header_errors), (0, 0))
+        assert_equals(len(link.format()), 3 + len(link.operations))
+
+    @raises(Error)
+    def test_bad_password(self):
+        self.conn.logon(b'1234')
+
+    def test_tcp(self):
+        listener = socket.socket()
+        listener.bind(("127.0.0.1", 0))
+        listener.listen()
+        thread = threading.Thread(target=simulator.serve,
+                                  args=(listener,), daemon=True)
+        thread.start()
+        conn = smabluetooth.Connection(self.sim.bdaddr,
+                                       socket.create_connection(
+                                           listener.getsockname()))
+        try:
+            conn.hello()
+            conn.logon()
+            assert conn.total_yield()[1] > 0
+        finally:
+            conn.close()
+
+    @raises(Error)
+    def test_no_logon(self):
+        self.conn.total_yield()
+
+    def test_yields(self):
+        self.conn.logon()
+        now = self.unit.now()
+        ts, total = self.conn.total_yield()
+        assert_equals(total, self.unit.total_at(ts))
+        assert abs(ts - now) <= 1
+        ts, daily = self.conn.daily_yield()
+        assert_equals(daily,
+                      total - self.unit.total_at(ts - ts % simulator.DAY))
+
+    def test_historic(self):
+        self.conn.logon()
+        now = self.unit.now()
+        data = self.conn.historic(now - 86400, now)
+        assert_equals(list(data), self.unit.samples(now - 86400, now, 300))
+
+    def test_historic_lossy(self):
+        self.conn.logon()
+        self.conn.rtt.minrto = self.conn.rtt.rto = 0.05
+        self.sim.loss = 0.1
+        now = self.unit.now()
+        data = self.conn.historic(now - 86400, now)
+        assert_equals(list(data), self.unit.samples(now - 86400, now, 300))
+
+    def test_historic_empty(self):
+        self.conn.logon()
+        assert_equals(len(self.conn.historic(1000, 2000)), 0)
+
+    def test_historic_daily(self):
+        self.conn.logon()
+        now = self.unit.now()
+        data = self.conn.historic_daily(now - 10 * 86400, now)
+        assert_equals([ts for ts, v in data],
+                      [self.unit.epoch + i * 86400 for i in range(4)])
+
+    def test_historic_pipelined(self):
+        self.conn.logon()
+        now = self.unit.now()
+        data = HistoricSeries()
+        for start, end, series in self.conn.historic_pipelined(
+                now - 2 * 86400, now, 3600, inflight=8):
+            data.extend(series)
+        assert_equals(list(data), self.unit.samples(now - 2 * 86400, now, 300))
+
+    def test_spot_values(self):
+        self.conn.logon()
+        values = self.conn.spot_values()
+        power = self.unit.power_at(values["ac_power"].timestamp)
+        assert_equals(values["ac_power"].value, power)
+        assert_equals(values["dc_power_1"].value, power // 2)
+        assert_equals(values["dc_voltage_2"].value, 400.0)
+        assert_equals(values["grid_frequency"].value, 50.0)
+
+    def test_spot_range(self):
+        self.conn.logon()
+        values = self.conn.spot(*smabluetooth.SPOT_DC)
+        assert_equals(sorted(values),
+                      ["dc_current_1", "dc_current_2", "dc_power_1",
+                       "dc_power_2", "dc_voltage_1", "dc_voltage_2"])
+
+    def test_set_time(self):
+        self.conn.logon()
+        self.conn.set_time(int(time.time()) + 3600, 0)
+        self.conn.total_yield()
+        assert abs(self.unit.clock_offset - 3600) <= 1
+
+
+def test_simulator_async():
+    async def download(sock, sim):
+        conn = asyncbluetooth.AsyncConnection(sim.bdaddr, sock)
+        await conn.hello()
+        await conn.logon()
+        now = sim.master.now()
+        data = await conn.historic(now - 86400, now)
+        conn.close()
+        return list(data) == sim.master.samples(now - 86400, now, 300)
+
+    async def download_all(sims):
+        return await asyncio.gather(*(download(sock, sim)
+                                      for sock, sim in sims))
+
+    sims = [simulator.simulate_pair(bdaddr="00:80:25:00:00:%02X" % i,
+                                    latency=0.01)
+            for i in range(1, 5)]
+    assert_equals(asyncio.run(download_all(sims)), [True] * 4)
+
+
+class TestPiconet(object):
+    def setUp(self):
+        self.sock, self.sim = simulator.simulate_pair(
+            history_days=2, slaves=[2130000002, 2130000003])
+        self.conn = smabluetooth.Connection(self.sim.bdaddr, self.sock)
+        self.conn.hello()
+
+    def tearDown(self):
+        self.conn.close()
+
+    def test_discover(self):
+        units = self.conn.discover(wait=0.5)
+        assert_equals(sorted(unit.serial for unit in units),
+                      [2130000001, 2130000002, 2130000003])
+
+    def test_discover_expect(self):
+        start = time.monotonic()
+        units = self.conn.discover(wait=30, expect=3)
+        assert time.monotonic() - start < 10
+        assert_equals(len(units), 3)
+
+    def test_units(self):
+        units = self.conn.discover(expect=3)
+        for unit, sim in zip(sorted(units, key=lambda u: u.serial),
+                             self.sim.units):
+            ts, total = unit.total_yield()
+            assert_equals(total, sim.total_at(ts))
+            now = sim.now()
+            data = unit.historic(now - 86400, now)
+            assert_equals(list(data), sim.samples(now - 86400, now, 300))
+
+    def test_unit_pipelined(self):
+        units = {u.serial: u for u in self.conn.discover(expect=3)}
+        sim = self.sim.units[2]
+        now = sim.now()
+        data = HistoricSeries()
+        for start, end, series in units[sim.serial].historic_pipelined(
+                now - 86400, now, 3600):
+            data.extend(series)
+        assert_equals(list(data), sim.samples(now - 86400, now, 300))
+
+
+def test_piconet_async():
+    async def query(sock, sim):
+        conn = asyncbluetooth.AsyncConnection(sim.bdaddr, sock)
+        await conn.hello()
+        units = await conn.discover(expect=2)
+        results = await asyncio.gather(*(unit.total_yield()
+                                         for unit in units))
+        conn.close()
+        return dict(zip((unit.serial for unit in units), results))
+
+    sock, sim = simulator.simulate_pair(slaves=[2130000002])
+    results = asyncio.run(query(sock, sim))
+    assert_equals(sorted(results), [2130000001, 2130000002])
+    for unit in sim.units:
+        ts, total = results[unit.serial]
+        assert_equals(total, unit.total_at(ts))
@@ -0,0 +1,136 @@
+#! /usr/bin/python3
+#
+# smadata2.inverter.trace - In-memory protocol event tracing
+# Copyright (C) 2014 David Gibson <david@gibson.dropbear.id.au>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import collections
+import json
+import sys
+import time
+
+from .capture import DIR_RX
+from .codec import ba2bytes
+
+__all__ = ['LAYER_RAW', 'LAYER_OUTER', 'LAYER_PPP', 'LAYER_6560',
+           'TraceEvent', 'Tracer']
+
+LAYER_RAW = 0
+LAYER_OUTER = 1
+LAYER_PPP = 2
+LAYER_6560 = 3
+
+LAYER_NAMES = {
+    LAYER_RAW: "raw",
+    LAYER_OUTER: "outer",
+    LAYER_PPP: "ppp",
+    LAYER_6560: "6560",
+}
+
+# The fields recorded at each layer.  Payloads aren't kept, only
+# their lengths, so an event costs about the same whatever its size.
+FIELDS = {
+    LAYER_RAW: ('length',),
+    LAYER_OUTER: ('from_', 'to_', 'type_', 'length'),
+    # protocol is None for transmitted frames, which are traced once
+    # they are already escaped
+    LAYER_PPP: ('addr', 'protocol', 'length'),
+    LAYER_6560: ('from2', 'to2', 'tag', 'type_', 'subtype', 'arg1',
+                 'arg2', 'length', 'response', 'error', 'pktcount',
+                 'first'),
+}
+
+# Shown in hex when formatted
+HEXFIELDS = frozenset(['type_', 'protocol', 'tag', 'subtype', 'arg1',
+                       'arg2', 'error'])
+
+TraceEvent = collections.namedtuple('TraceEvent',
+                                    'timestamp direction layer fields')
+
+
+def _jsonable(value):
+    if isinstance(value, bytes):
+        return ba2bytes(value)
+    return value
+
+
+class Tracer(object):
+    """Keep the last size protocol events in a ring buffer
+
+    Each event is a TraceEvent, with a time.monotonic() timestamp and
+    a tuple of the fields FIELDS lists for its layer.  Nothing is
+    written anywhere until the events are dumped or exported.  If
+    errfile is set, the events are dumped there when the connection
+    fails.
+    """
+
+    def __init__(self, size=1024, errfile=None):
+        self.ring = collections.deque(maxlen=size)
+        self.errfile = errfile
+
+    def record(self, direction, layer, fields):
+        self.ring.append(TraceEvent(time.monotonic(), direction, layer,
+                                    fields))
+
+    def events(self):
+        return list(self.ring)
+
+    def clear(self):
+        self.ring.clear()
+
+    def format_event(self, event, start=None):
+        if start is None:
+            start = event.timestamp
+        arrow = "Rx<" if event.direction == DIR_RX else "Tx>"
+        fields = []
+        for name, value in zip(FIELDS[event.layer], event.fields):
+            if isinstance(value, bytes):
+                value = ba2bytes(value)
+            elif (name in HEXFIELDS) and (value is not None):
+                value = "0x%x" % value
+            fields.append("%s=%s" % (name.rstrip('_'), value))
+        return "%12.6f %s %-5s %s" % (event.timestamp - start, arrow,
+                                      LAYER_NAMES[event.layer],
+                                      " ".join(fields))
+
+    def dump(self, f=sys.stderr):
+        """Write the events, one per line, to f"""
+        events = self.events()
+        if not events:
+            return
+        start = events[0].timestamp
+        for event in events:
+            print(self.format_event(event, start), file=f)
+
+    def export(self, f):
+        """Write the events to f as JSON, one object per line"""
+        for event in self.events():
+            obj = {
+                "timestamp": event.timestamp,
+                "direction": "rx" if event.direction == DIR_RX else "tx",
+                "layer": LAYER_NAMES[event.layer],
+            }
+            for name, value in zip(FIELDS[event.layer], event.fields):
+                obj[name.rstrip('_')] = _jsonable(value)
+            f.write(json.dumps(obj) + "\n")
+
+    def error(self, exc):
+        """Dump the events leading up to exception exc, if wanted"""
+        if self.errfile is None:
+            return
+        print("Protocol trace leading up to %s: %s"
+              % (type(exc).__name__, exc), file=self.errfile)
+        self.dump(self.errfile)
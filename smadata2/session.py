@@ -0,0 +1,273 @@
+#! /usr/bin/python3
+#
+# smadata2.session - Daemon holding logged on inverter connections
+# Copyright (C) 2014 David Gibson <david@gibson.dropbear.id.au>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import sys
+import asyncio
+import copy
+import json
+import os
+import socket
+import stat
+import time
+
+from . import download
+from .inverter.base import Error as InverterError
+
+DEFAULT_SOCKET = os.path.expanduser("~/.smadata2.sock")
+
+# Lifetime we ask for when logging on, and how long before expiry we
+# log on again
+LOGON_TIMEOUT = 900
+REFRESH_MARGIN = 120
+
+__all__ = ['Error', 'DEFAULT_SOCKET', 'Session', 'SessionBroker',
+           'SessionClient']
+
+
+class Error(Exception):
+    pass
+
+
+def summarise(data):
+    """Reduce downloaded samples to [count, first time, last time]"""
+    if len(data):
+        return [len(data), data[0][0], data[-1][0]]
+    else:
+        return [0, None, None]
+
+
+async def status_async(ic, db, req, sma):
+    dtime, daily = await sma.daily_yield()
+    ttime, total = await sma.total_yield()
+    return [dtime, daily, ttime, total]
+
+
+async def download_async(ic, db, req, sma):
+    ic = copy.copy(ic)
+    if req.get("window") is not None:
+        ic.download_window = req["window"]
+    if req.get("inflight") is not None:
+        ic.download_inflight = req["inflight"]
+    data, daily = await download.download_connection_async(ic, db, sma)
+    return [summarise(data), summarise(daily)]
+
+
+async def settime_async(ic, db, req, sma):
+    oldtime, tmp = await sma.total_yield()
+    await sma.set_time(req["time"], req["tzoffset"])
+    newtime, tmp = await sma.total_yield()
+    return [oldtime, newtime]
+
+
+OPERATIONS = {
+    "status": status_async,
+    "download": download_async,
+    "settime": settime_async,
+}
+
+
+class Session(object):
+    """A logged on connection to one inverter, kept between requests"""
+
+    def __init__(self, ic):
+        self.ic = ic
+        self.conn = None
+        self.expiry = 0
+        self.lock = asyncio.Lock()
+
+    def stale(self):
+        return ((self.conn is None) or
+                (time.monotonic() > self.expiry - REFRESH_MARGIN))
+
+    async def logon(self):
+        if self.conn is None:
+            conn = await self.ic.connect_async()
+            try:
+                await conn.hello()
+            except BaseException:
+                conn.close()
+                raise
+            self.conn = conn
+        await self.conn.logon(timeout=LOGON_TIMEOUT)
+        self.expiry = time.monotonic() + LOGON_TIMEOUT
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    async def run(self, fn, *args):
+        """Call fn(conn, *args) on a logged on connection
+
+        If the existing connection has failed, it is discarded and the
+        operation is tried once more on a fresh one.
+        """
+        async with self.lock:
+            for retry in (False, True):
+                try:
+                    if self.stale():
+                        await self.logon()
+                    return await fn(*args, self.conn)
+                except (InverterError, OSError):
+                    self.close()
+                    if retry:
+                        raise
+
+    async def refresh(self):
+        """Log on again if the logon is close to expiring"""
+        async with self.lock:
+            if self.stale():
+                try:
+                    await self.logon()
+                except (InverterError, OSError) as e:
+                    self.close()
+                    print("ERROR logging on to %s: %s" % (self.ic.name, e),
+                          file=sys.stderr)
+
+
+class SessionBroker(object):
+    """Serve status, download and settime requests over a Unix socket
+
+    Each request is a line of JSON: {"op": <operation>, ...}, with an
+    optional "serial" to restrict it to one inverter.  The reply is a
+    line of JSON with a "results" list holding a {"serial", "name",
+    "result"} or {"serial", "name", "error"} object per inverter, or
+    just an "error" if the request itself was bad.
+    """
+    KEEPALIVE_INTERVAL = 60
+
+    def __init__(self, config, path=DEFAULT_SOCKET):
+        self.config = config
+        self.path = path
+        self.sessions = [Session(inv) for system in config.systems()
+                         for inv in system.inverters()]
+        self.db = None
+
+    def database(self):
+        if self.db is None:
+            self.db = self.config.database()
+        return self.db
+
+    async def dispatch(self, line):
+        try:
+            req = json.loads(line.decode('utf-8'))
+            fn = OPERATIONS[req["op"]]
+        except (ValueError, KeyError, TypeError):
+            return {"error": "Bad request %r" % line}
+
+        sessions = [s for s in self.sessions
+                    if req.get("serial") in (None, s.ic.serial)]
+        db = self.database() if (req["op"] == "download") else None
+        results = await asyncio.gather(*(s.run(fn, s.ic, db, req)
+                                         for s in sessions),
+                                       return_exceptions=True)
+
+        replies = []
+        for s, result in zip(sessions, results):
+            reply = {"serial": s.ic.serial, "name": s.ic.name}
+            if download.failed(result):
+                reply["error"] = str(result)
+            else:
+                reply["result"] = result
+            replies.append(reply)
+        return {"results": replies}
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                reply = await self.dispatch(line)
+                writer.write(json.dumps(reply).encode('utf-8') + b'\n')
+                await writer.drain()
+        finally:
+            writer.close()
+
+    async def keepalive(self):
+        while True:
+            await asyncio.gather(*(s.refresh() for s in self.sessions))
+            await asyncio.sleep(self.KEEPALIVE_INTERVAL)
+
+    def claim_socket(self):
+        """Remove a stale socket left at path by an earlier daemon
+
+        Raises Error if another daemon is still listening there, or
+        something else is in the way.
+        """
+        try:
+            mode = os.stat(self.path).st_mode
+        except FileNotFoundError:
+            return
+        if not stat.S_ISSOCK(mode):
+            raise Error("%s exists and is not a socket" % self.path)
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            try:
+                sock.connect(self.path)
+            except ConnectionRefusedError:
+                os.unlink(self.path)
+                return
+        raise Error("A session daemon is already listening on %s"
+                    % self.path)
+
+    async def serve(self, started=None):
+        self.claim_socket()
+        server = await asyncio.start_unix_server(self.handle, path=self.path)
+        keepalive = asyncio.ensure_future(self.keepalive())
+        if started is not None:
+            started()
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            keepalive.cancel()
+            try:
+                await keepalive
+            except asyncio.CancelledError:
+                pass
+            for s in self.sessions:
+                s.close()
+            os.unlink(self.path)
+
+    def run(self):
+        asyncio.run(self.serve())
+
+
+class SessionClient(object):
+    """Send requests to a SessionBroker"""
+
+    def __init__(self, path=DEFAULT_SOCKET, timeout=None):
+        self.path = path
+        self.timeout = timeout
+
+    def request(self, op, **kwargs):
+        kwargs["op"] = op
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(self.timeout)
+            sock.connect(self.path)
+            sock.sendall(json.dumps(kwargs).encode('utf-8') + b'\n')
+            with sock.makefile('rb') as f:
+                line = f.readline()
+
+        if not line:
+            raise Error("Session daemon closed the connection")
+        reply = json.loads(line.decode('utf-8'))
+        if "error" in reply:
+            raise Error(reply["error"])
+        return reply["results"]
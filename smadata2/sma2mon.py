@@ -19,20 +19,100 @@
 
 import sys
 import argparse
+import asyncio
 import os.path
 import datetime
 import dateutil.parser
 import time
 import csv
+import json
 
 import smadata2.config
 import smadata2.db.sqlite
 import smadata2.datetimeutil
 import smadata2.download
+import smadata2.inverter.base
+import smadata2.inverter.stats
+import smadata2.session
 import smadata2.upload
 
 
+def print_status(dtime, daily, ttime, total):
+    print("\t\tDaily generation at %s:\t%d Wh"
+          % (smadata2.datetimeutil.format_time(dtime), daily))
+    print("\t\tTotal generation at %s:\t%d Wh"
+          % (smadata2.datetimeutil.format_time(ttime), total))
+
+
+async def status_inverter_async(inv):
+    sma = await inv.connect_and_logon_async()
+    try:
+        dtime, daily = await sma.daily_yield()
+        ttime, total = await sma.total_yield()
+        if inv.stats is not None:
+            await sma.getsignal()
+    finally:
+        sma.close()
+    return dtime, daily, ttime, total
+
+
+def session_results(config, args, op, **kwargs):
+    """Make a request of the session daemon
+
+    Returns a list with either the result or an exception for each
+    inverter, in configuration order.
+    """
+    client = smadata2.session.SessionClient(args.session_socket)
+    replies = {r["serial"]: r for r in client.request(op, **kwargs)}
+
+    results = []
+    for system in config.systems():
+        for inv in system.inverters():
+            reply = replies.get(inv.serial,
+                                {"error": "Unknown to session daemon"})
+            if "error" in reply:
+                results.append(smadata2.session.Error(reply["error"]))
+            else:
+                results.append(reply["result"])
+    return results
+
+
+def print_status_results(config, results):
+    results = iter(results)
+
+    for system in config.systems():
+        print("%s:" % system.name)
+
+        for inv in system.inverters():
+            print("\t%s:" % inv.name)
+
+            result = next(results)
+            if smadata2.download.failed(result):
+                print("ERROR contacting inverter: %s" % result,
+                      file=sys.stderr)
+            else:
+                print_status(*result)
+
+
+def status_parallel(config):
+    async def status_all(invs):
+        return await asyncio.gather(*(status_inverter_async(inv)
+                                      for inv in invs),
+                                    return_exceptions=True)
+
+    invs = [inv for system in config.systems() for inv in system.inverters()]
+    print_status_results(config, asyncio.run(status_all(invs)))
+
+
 def status(config, args):
+    if args.session:
+        print_status_results(config, session_results(config, args, "status"))
+        return
+
+    if args.parallel:
+        status_parallel(config)
+        return
+
     for system in config.systems():
         print("%s:" % system.name)
 
@@ -41,18 +121,148 @@ def status(config, args):
 
             try:
                 sma = inv.connect_and_logon()
-
-                dtime, daily = sma.daily_yield()
-                print("\t\tDaily generation at %s:\t%d Wh"
-                      % (smadata2.datetimeutil.format_time(dtime), daily))
-
-                ttime, total = sma.total_yield()
-                print("\t\tTotal generation at %s:\t%d Wh"
-                      % (smadata2.datetimeutil.format_time(ttime), total))
+                try:
+                    dtime, daily = sma.daily_yield()
+                    ttime, total = sma.total_yield()
+                    if inv.stats is not None:
+                        sma.getsignal()
+                finally:
+                    sma.close()
+                print_status(dtime, daily, ttime, total)
             except Exception as e:
                 print("ERROR contacting inverter: %s" % e, file=sys.stderr)
 
 
+def logon_live(conn, link):
+    """Log on to the inverters on one link, returning targets to query
+
+    The targets are (inverter config, connection or unit) pairs.
+    """
+    if len(link) == 1:
+        conn.logon(timeout=smadata2.session.LOGON_TIMEOUT)
+        return [(link[0], conn)]
+
+    units = conn.discover(timeout=smadata2.session.LOGON_TIMEOUT,
+                          expect=len(link))
+    units = {unit.serial: unit for unit in units}
+    targets = []
+    for inv in link:
+        if int(inv.serial) in units:
+            targets.append((inv, units[int(inv.serial)]))
+        else:
+            print("ERROR: %s did not answer through %s"
+                  % (inv.name, inv.bdaddr), file=sys.stderr)
+    return targets
+
+
+def connect_live(link):
+    """Connect and log on to the inverters on one link
+
+    Returns (conn, targets): the connection to close afterwards, and
+    (inverter config, connection or unit) pairs to query through it.
+    """
+    conn = link[0].connect()
+    try:
+        conn.hello()
+        targets = logon_live(conn, link)
+    except BaseException:
+        conn.close()
+        raise
+    return conn, targets
+
+
+class LiveLink(object):
+    """A link polled by sma2mon live
+
+    Like session.Session, logs on again before the logon expires, and
+    reconnects if the connection fails.
+    """
+
+    def __init__(self, link):
+        self.link = link
+        self.conn = None
+        self.targets = []
+        self.expiry = 0
+
+    def stale(self):
+        return ((self.conn is None) or
+                (time.monotonic()
+                 > self.expiry - smadata2.session.REFRESH_MARGIN))
+
+    def logon(self):
+        if self.conn is None:
+            self.conn, self.targets = connect_live(self.link)
+        else:
+            self.targets = logon_live(self.conn, self.link)
+        self.expiry = time.monotonic() + smadata2.session.LOGON_TIMEOUT
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+            self.targets = []
+
+    def refresh(self):
+        """Log on, or reconnect, if the logon is close to expiring"""
+        if self.stale():
+            try:
+                self.logon()
+            except (smadata2.inverter.base.Error, OSError) as e:
+                self.close()
+                print("ERROR contacting %s: %s" % (self.link[0].bdaddr, e),
+                      file=sys.stderr)
+
+    def poll(self):
+        self.refresh()
+        for inv, sma in self.targets:
+            try:
+                print_spot(inv, sma.spot_values())
+            except (smadata2.inverter.base.Error, OSError) as e:
+                print("ERROR reading %s: %s" % (inv.name, e),
+                      file=sys.stderr)
+                # Reconnect straight away, ready for the next poll
+                self.close()
+                self.refresh()
+                break
+
+
+def print_spot(inv, values):
+    if "ac_power" in values:
+        ts = values["ac_power"].timestamp
+    else:
+        ts = int(time.time())
+    fields = ["%s %s %s" % (name, v.value, v.unit)
+              for name, v in sorted(values.items()) if v.value is not None]
+    print("%s\t%s:\t%s" % (smadata2.datetimeutil.format_time(ts), inv.name,
+                           ", ".join(fields)))
+
+
+def live(config, args):
+    invs = [inv for system in config.systems() for inv in system.inverters()]
+    links = [LiveLink(link) for link in smadata2.download.group_links(invs)]
+    try:
+        deadline = time.monotonic()
+        polls = 0
+        while (args.count is None) or (polls < args.count):
+            for link in links:
+                link.poll()
+            sys.stdout.flush()
+
+            polls += 1
+            # Keep to the cadence, however long the polls took
+            deadline += args.interval
+            delay = deadline - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                deadline = time.monotonic()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for link in links:
+            link.close()
+
+
 def yieldat(config, args):
     db = config.database()
 
@@ -60,63 +270,168 @@ def yieldat(config, args):
         print("No date specified", file=sys.stderr)
         sys.exit(1)
 
-    dt = dateutil.parser.parse(args.datetime)
+    dts = [dateutil.parser.parse(s) for s in args.datetime]
 
     for system in config.systems():
         print("%s:" % system.name)
 
-        if dt.tzinfo is None:
-            sdt = datetime.datetime(dt.year, dt.month, dt.day,
-                                    dt.hour, dt.minute, dt.second,
-                                    dt.microsecond, tzinfo=system.timezone())
-        else:
-            sdt = dt
+        sdts = []
+        for dt in dts:
+            if dt.tzinfo is None:
+                dt = datetime.datetime(dt.year, dt.month, dt.day,
+                                       dt.hour, dt.minute, dt.second,
+                                       dt.microsecond,
+                                       tzinfo=system.timezone())
+            sdts.append(dt)
 
-        ts = smadata2.datetimeutil.totimestamp(sdt)
+        tss = [smadata2.datetimeutil.totimestamp(sdt) for sdt in sdts]
         ids = [inv.serial for inv in system.inverters()]
 
-        details = db.get_yield_at_details(ts, ids)
+        # Look up every instant at once
+        alldetails = db.get_yield_at_details_many(tss, ids)
 
-        for inv in system.inverters():
-            iyield, its = details[inv.serial]
-            print("\t\t{}: {} Wh @ {}".format(inv.name,
-                                               iyield,
-                                               smadata2.datetimeutil.format_time(its)))
+        for sdt, ts, details in zip(sdts, tss, alldetails):
+            for inv in system.inverters():
+                iyield, its = details[inv.serial]
+                print("\t\t{}: {} Wh @ {}".format(inv.name,
+                                                   iyield,
+                                                   smadata2.datetimeutil.format_time(its)))
+
+            sys.stdout.flush()
+            val = smadata2.db.sqlite.total_yield_at(ts, details)
 
-        sys.stdout.flush()
-        val = db.get_yield_at(ts, ids)
+            print("\tTotal generation at %s: %d Wh" % (sdt, val))
 
-        print("\tTotal generation at %s: %d Wh" % (sdt, val))
+
+def print_download_summary(fast, daily):
+    count, first, last = fast
+    if count:
+        print("Downloaded %d observations from %s to %s"
+              % (count,
+                 smadata2.datetimeutil.format_time(first),
+                 smadata2.datetimeutil.format_time(last)))
+    else:
+        print("No new fast sampled data")
+    count, first, last = daily
+    if count:
+        print("Downloaded %d daily observations from %s to %s"
+              % (count,
+                 smadata2.datetimeutil.format_time(first),
+                 smadata2.datetimeutil.format_time(last)))
+    else:
+        print("No new daily data")
+
+
+def print_download(data, daily):
+    print_download_summary(smadata2.session.summarise(data),
+                           smadata2.session.summarise(daily))
+
+
+def print_ingested(db, inv):
+    for sample_type, what in ((smadata2.db.SAMPLE_INV_FAST, "fast sampled"),
+                              (smadata2.db.SAMPLE_INV_DAILY, "daily")):
+        counts = db.ingested.get((inv.serial, sample_type))
+        if counts is None:
+            continue
+        print("Stored %d new %s observations, %d already stored,"
+              " %d conflicting with stored values"
+              % (counts.new, what, counts.unchanged, counts.conflicting))
+
+
+def download_session(config, args):
+    results = session_results(config, args, "download",
+                              window=args.window, inflight=args.inflight)
+    invs = [inv for system in config.systems() for inv in system.inverters()]
+    for inv, result in zip(invs, results):
+        print("%s (SN: %s)" % (inv.name, inv.serial))
+        if smadata2.download.failed(result):
+            print("ERROR downloading inverter: %s" % result, file=sys.stderr)
+        else:
+            print_download_summary(*result)
 
 
 def download(config, args):
+    if args.session:
+        download_session(config, args)
+        return
+
     db = config.database()
 
     for system in config.systems():
         for inv in system.inverters():
+            if args.window is not None:
+                inv.download_window = args.window
+            if args.inflight is not None:
+                inv.download_inflight = args.inflight
+
+    if args.parallel:
+        invs = [inv for system in config.systems()
+                for inv in system.inverters()]
+        results = smadata2.download.download_inverters_parallel(invs, db)
+        for inv, result in zip(invs, results):
             print("%s (SN: %s)" % (inv.name, inv.serial))
-
+            if smadata2.download.failed(result):
+                print("ERROR downloading inverter: %s" % result,
+                      file=sys.stderr)
+            else:
+                print_download(*result)
+                print_ingested(db, inv)
+        return
+
+    invs = [inv for system in config.systems() for inv in system.inverters()]
+    for link in smadata2.download.group_links(invs):
+        if len(link) > 1:
+            # Several inverters reached through one master
             try:
-                data, daily = smadata2.download.download_inverter(inv, db)
-                if len(data):
-                    print("Downloaded %d observations from %s to %s"
-                          % (len(data),
-                             smadata2.datetimeutil.format_time(data[0][0]),
-                             smadata2.datetimeutil.format_time(data[-1][0])))
-                else:
-                    print("No new fast sampled data")
-                if len(daily):
-                    print("Downloaded %d daily observations from %s to %s"
-                          % (len(daily),
-                             smadata2.datetimeutil.format_time(daily[0][0]),
-                             smadata2.datetimeutil.format_time(daily[-1][0])))
-                else:
-                    print("No new daily data")
+                results = smadata2.download.download_linked(link, db)
             except Exception as e:
-                print("ERROR downloading inverter: %s" % e, file=sys.stderr)
+                results = [e] * len(link)
+            for inv, result in zip(link, results):
+                print("%s (SN: %s)" % (inv.name, inv.serial))
+                if smadata2.download.failed(result):
+                    print("ERROR downloading inverter: %s" % result,
+                          file=sys.stderr)
+                else:
+                    print_download(*result)
+                    print_ingested(db, inv)
+            continue
+
+        inv = link[0]
+        print("%s (SN: %s)" % (inv.name, inv.serial))
+
+        try:
+            data, daily = smadata2.download.download_inverter(inv, db)
+            print_download(data, daily)
+            print_ingested(db, inv)
+        except Exception as e:
+            print("ERROR downloading inverter: %s" % e, file=sys.stderr)
+
+
+def settime_session(config, args):
+    newts = int(time.time())
+    newtz = smadata2.datetimeutil.get_tzoffset()
+    results = session_results(config, args, "settime",
+                              time=newts, tzoffset=newtz)
+    invs = [inv for system in config.systems() for inv in system.inverters()]
+    for inv, result in zip(invs, results):
+        print("%s (SN: %s)" % (inv.name, inv.serial))
+        if smadata2.download.failed(result):
+            print("ERROR contacting inverter: %s" % result, file=sys.stderr)
+            continue
+        oldtime, newtime = result
+        print("\t\tPrevious time: %s"
+              % (smadata2.datetimeutil.format_time(oldtime)))
+        print("\t\tNew time: %s (TZ %d)"
+              % (smadata2.datetimeutil.format_time(newts), newtz))
+        print("\t\tUpdated time: %s"
+              % (smadata2.datetimeutil.format_time(newtime)))
 
 
 def settime(config, args):
+    if args.session:
+        settime_session(config, args)
+        return
+
     for system in config.systems():
         for inv in system.inverters():
             print("%s (SN: %s)" % (inv.name, inv.serial))
@@ -141,6 +456,17 @@ def settime(config, args):
                 print("ERROR contacting inverter: %s" % e, file=sys.stderr)
 
 
+def daemon(config, args):
+    print("Serving inverter sessions on %s" % args.session_socket)
+    try:
+        smadata2.session.SessionBroker(config, args.session_socket).run()
+    except smadata2.session.Error as e:
+        print("ERROR: %s" % e, file=sys.stderr)
+        sys.exit(1)
+    except KeyboardInterrupt:
+        pass
+
+
 def upload(config, args):
     db = config.database()
 
@@ -164,7 +490,7 @@ def setupdb(config, args):
     else:
         print("Updating database schema for '%s'..." % dbname)
     try:
-        smadata2.db.sqlite.create_or_update(config.dbname)
+        smadata2.db.sqlite.create_or_update(config.dbname, config.dbtuning)
     except smadata2.db.WrongSchema as e:
         print(e)
 
@@ -224,25 +550,78 @@ def yieldlog(config, args):
                   + "\t".join(str(y) for y in row[1:]))
 
 
+def print_stats(config):
+    for system in config.systems():
+        for inv in system.inverters():
+            print("%s (%s):" % (inv.name, inv.bdaddr))
+            print("\n".join(inv.stats.format()))
+
+
+def export_stats(config, fname):
+    stats = dict((inv.serial, dict(name=inv.name, bluetooth=inv.bdaddr,
+                                   **inv.stats.as_dict()))
+                 for system in config.systems()
+                 for inv in system.inverters())
+    with open(fname, "w") as f:
+        json.dump(stats, f, indent=2, sort_keys=True)
+
+
 def argparser():
     parser = argparse.ArgumentParser(description="Work with Bluetooth"
                                      " enabled SMA photovoltaic inverters")
 
     parser.add_argument("--config")
+    parser.add_argument("--capture", metavar="DIR",
+                        help="Record inverter traffic to capture files"
+                        " in DIR")
+    parser.add_argument("--trace", metavar="N", type=int,
+                        help="Keep the last N protocol events, and dump"
+                        " them if a connection fails")
+    parser.add_argument("--stats", action='store_true',
+                        help="Print link statistics and operation"
+                        " latencies for each inverter afterwards")
+    parser.add_argument("--stats-json", metavar="FILE",
+                        help="Write link statistics for each inverter"
+                        " to FILE as JSON")
+    parser.add_argument("--session", action='store_true',
+                        help="Talk to inverters through the session daemon")
+    parser.add_argument("--session-socket", metavar="SOCKET",
+                        default=smadata2.session.DEFAULT_SOCKET,
+                        help="Unix socket the session daemon listens on"
+                        " (default %(default)s)")
 
     subparsers = parser.add_subparsers()
 
     parse_status = subparsers.add_parser("status", help="Read inverter status")
     parse_status.set_defaults(func=status)
+    parse_status.add_argument("--parallel", action='store_true',
+                              help="Contact all inverters concurrently")
+
+    help = "Poll live power, voltage, current and frequency readings"
+    parse_live = subparsers.add_parser("live", help=help)
+    parse_live.set_defaults(func=live)
+    parse_live.add_argument("--interval", type=float, default=10,
+                            help="Seconds between polls")
+    parse_live.add_argument("--count", type=int,
+                            help="Stop after this many polls")
 
     help = "Get production at a given date"
     parse_yieldat = subparsers.add_parser("yieldat", help=help)
     parse_yieldat.set_defaults(func=yieldat)
-    parse_yieldat.add_argument(type=str, dest="datetime")
+    parse_yieldat.add_argument(type=str, dest="datetime", nargs="+")
 
     help = "Download power history and record in database"
     parse_download = subparsers.add_parser("download", help=help)
     parse_download.set_defaults(func=download)
+    parse_download.add_argument("--parallel", action='store_true',
+                                help="Download from all inverters"
+                                " concurrently")
+    parse_download.add_argument("--window", type=int,
+                                help="Request fast samples in windows of"
+                                " this many seconds")
+    parse_download.add_argument("--inflight", type=int,
+                                help="Number of window requests to keep"
+                                " outstanding at once")
 
     help = "Create database or update schema"
     parse_setupdb = subparsers.add_parser("setupdb", help=help)
@@ -252,6 +631,10 @@ def argparser():
     parse_settime = subparsers.add_parser("settime", help=help)
     parse_settime.set_defaults(func=settime)
 
+    help = "Run a daemon keeping inverters logged on between commands"
+    parse_daemon = subparsers.add_parser("daemon", help=help)
+    parse_daemon.set_defaults(func=daemon)
+
     help = "Upload power history to pvoutput.org"
     parse_upload_date = subparsers.add_parser("upload", help=help)
     parse_upload_date.set_defaults(func=upload)
@@ -274,7 +657,26 @@ def main(argv=sys.argv):
 
     config = smadata2.config.SMAData2Config(args.config)
 
-    args.func(config, args)
+    if args.capture is not None:
+        for system in config.systems():
+            for inv in system.inverters():
+                inv.capture_dir = args.capture
+    if args.trace is not None:
+        for system in config.systems():
+            for inv in system.inverters():
+                inv.trace_size = args.trace
+    if args.stats or args.stats_json:
+        for system in config.systems():
+            for inv in system.inverters():
+                inv.stats = smadata2.inverter.stats.LinkStats()
+
+    try:
+        args.func(config, args)
+    finally:
+        if args.stats:
+            print_stats(config)
+        if args.stats_json:
+            export_stats(config, args.stats_json)
 
 
 if __name__ == '__main__':
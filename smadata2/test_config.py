@@ -2,7 +2,10 @@
 
 import io
 import os.path
+import shutil
+import tempfile
 import time
+import unittest.mock
 import datetime
 import dateutil.tz
 
@@ -26,6 +29,32 @@ class TestMinimalConfig(BaseTestConfig):
     def test_systems(self):
         assert_equals(self.c.systems(), [])
 
+    def test_dbtuning(self):
+        assert_equals(self.c.dbtuning, {})
+
+
+class TestConfigDatabaseTuning(BaseTestConfig):
+    json = """
+    {
+        "database": {
+            "filename": "/tmp/test.sqlite",
+            "profile": "wal",
+            "synchronous": "full",
+            "mmap-size": 268435456
+        }
+    }"""
+
+    def test_dbname(self):
+        assert_equals(self.c.dbname, "/tmp/test.sqlite")
+
+    def test_dbtuning(self):
+        assert_equals(self.c.dbtuning, {
+            "journal_mode": "wal",
+            "synchronous": "full",
+            "busy_timeout": 5000,
+            "mmap_size": 268435456,
+        })
+
 
 class TestConfigWithPVOutput(BaseTestConfig):
     json = """
@@ -144,9 +173,54 @@ class TestConfigBareInverter(BaseTestConfig):
         assert_equals(inv.bdaddr, "aa:bb:cc:dd:ee:ff")
         assert_equals(inv.serial, "TESTSERIAL")
         assert inv.starttime is None
+        assert inv.download_window is None
         assert isinstance(str(inv), str)
 
 
+class TestConfigCapture(BaseTestConfig):
+    json = TestConfigBareInverter.json
+
+    def setUp(self):
+        super(TestConfigCapture, self).setUp()
+        self.inv = self.c.systems()[0].inverters()[0]
+        self.inv.capture_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.inv.capture_dir)
+
+    def test_capture_names(self):
+        # Several connections in the same instant get their own files
+        with unittest.mock.patch("time.time", return_value=1e9 + 0.25):
+            files = [self.inv.open_capture() for i in range(3)]
+        for f in files:
+            f.close()
+        names = sorted(os.path.basename(f.name) for f in files)
+        assert_equals(len(set(names)), 3)
+        for name in names:
+            assert name.startswith("TESTSERIAL-")
+            assert "-250000" in name
+            assert name.endswith(".smacap")
+
+
+class TestConfigDownloadWindow(BaseTestConfig):
+    json = """
+    {
+        "inverters": [
+            {
+                "bluetooth": "aa:bb:cc:dd:ee:ff",
+                "serial": "TESTSERIAL",
+                "download-window": 86400,
+                "download-inflight": 2
+            }
+        ]
+    }"""
+
+    def test_window(self):
+        inv = self.c.systems()[0].inverters()[0]
+        assert_equals(inv.download_window, 86400)
+        assert_equals(inv.download_inflight, 2)
+
+
 class TestConfigUTCSystem(TestConfigEmptySystem):
     json = """
     {
@@ -0,0 +1,175 @@
+#! /usr/bin/python3
+
+import asyncio
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+
+from nose.tools import assert_equals, raises
+
+import smadata2.config
+import smadata2.db.sqlite
+import smadata2.session
+from smadata2.inverter import asyncbluetooth, simulator
+
+
+class SimulatedInverterConfig(smadata2.config.SMAData2InverterConfig):
+    def __init__(self, index):
+        invjson = {
+            "bluetooth": "00:80:25:00:00:%02X" % (index + 1),
+            "serial": 2130000000 + index,
+        }
+        super(SimulatedInverterConfig, self).__init__(invjson,
+                                                      "sim%d" % index)
+        self.starttime = int(time.time()) - 86400
+        self.sims = []
+
+    async def connect_async(self):
+        sock, sim = simulator.simulate_pair(bdaddr=self.bdaddr,
+                                            serial=self.serial,
+                                            history_days=2)
+        self.sims.append(sim)
+        return asyncbluetooth.AsyncConnection(self.bdaddr, sock)
+
+
+class SimulatedConfig(object):
+    def __init__(self, dbname):
+        self.dbname = dbname
+        self.invs = [SimulatedInverterConfig(i) for i in range(2)]
+
+    def systems(self):
+        return [self]
+
+    def inverters(self):
+        return self.invs
+
+    def database(self):
+        return smadata2.db.sqlite.create_or_update(self.dbname)
+
+
+class TestSessionBroker(object):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.config = SimulatedConfig(os.path.join(self.tmpdir, "test.db"))
+        path = os.path.join(self.tmpdir, "session.sock")
+        self.broker = smadata2.session.SessionBroker(self.config, path)
+        self.client = smadata2.session.SessionClient(path, timeout=10)
+
+        self.loop = asyncio.new_event_loop()
+        started = threading.Event()
+        self.task = self.loop.create_task(self.broker.serve(started.set))
+        self.thread = threading.Thread(target=self.run)
+        self.thread.start()
+        started.wait(10)
+
+    def run(self):
+        try:
+            self.loop.run_until_complete(self.task)
+        except asyncio.CancelledError:
+            pass
+
+    def tearDown(self):
+        self.loop.call_soon_threadsafe(self.task.cancel)
+        self.thread.join()
+        self.loop.close()
+        shutil.rmtree(self.tmpdir)
+
+    def connects(self):
+        return [len(inv.sims) for inv in self.config.invs]
+
+    def test_status(self):
+        for i in range(3):
+            results = self.client.request("status")
+            assert_equals([r["serial"] for r in results],
+                          [inv.serial for inv in self.config.invs])
+            for r, inv in zip(results, self.config.invs):
+                dtime, daily, ttime, total = r["result"]
+                assert_equals(total, inv.sims[-1].master.total_at(ttime))
+        assert_equals(self.connects(), [1, 1])
+
+    def test_one_inverter(self):
+        serial = self.config.invs[1].serial
+        results = self.client.request("status", serial=serial)
+        assert_equals([r["serial"] for r in results], [serial])
+
+    def test_download(self):
+        results = self.client.request("download", window=21600)
+        for r in results:
+            fast, daily = r["result"]
+            assert fast[0] > 0
+        results = self.client.request("download")
+        for r in results:
+            fast, daily = r["result"]
+            assert_equals(fast, [0, None, None])
+
+    def test_settime(self):
+        now = int(time.time())
+        results = self.client.request("settime", time=now + 3600,
+                                      tzoffset=0)
+        for r in results:
+            oldtime, newtime = r["result"]
+            assert abs(newtime - oldtime - 3600) <= 1
+
+    def test_refresh(self):
+        self.client.request("status")
+        for s in self.broker.sessions:
+            s.expiry = 0
+        self.client.request("status")
+        for s in self.broker.sessions:
+            assert s.expiry > time.monotonic()
+        assert_equals(self.connects(), [1, 1])
+
+    def test_reconnect(self):
+        self.client.request("status")
+        self.config.invs[0].sims[0].sock.close()
+        results = self.client.request("status")
+        assert "result" in results[0]
+        assert_equals(self.connects(), [2, 1])
+
+    @raises(smadata2.session.Error)
+    def test_bad_request(self):
+        self.client.request("reboot")
+
+    def test_second_daemon(self):
+        broker = smadata2.session.SessionBroker(self.config,
+                                                self.broker.path)
+        try:
+            broker.claim_socket()
+        except smadata2.session.Error:
+            pass
+        else:
+            assert False, "Took the socket of a running daemon"
+        # The first daemon still has it
+        self.client.request("status")
+
+
+class TestClaimSocket(object):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, "session.sock")
+        self.broker = smadata2.session.SessionBroker(SimulatedConfig(None),
+                                                     self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_missing(self):
+        self.broker.claim_socket()
+
+    def test_stale(self):
+        # Bound, but nobody is listening any more
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.bind(self.path)
+        self.broker.claim_socket()
+        assert not os.path.exists(self.path)
+
+    @raises(smadata2.session.Error)
+    def test_not_socket(self):
+        open(self.path, "w").close()
+        try:
+            self.broker.claim_socket()
+        finally:
+            assert os.path.exists(self.path)
@@ -1,11 +1,125 @@
 #! /usr/bin/python3
 
 import argparse
+import asyncio
+import socket
+import time
 
+from nose.tools import assert_equals, raises
+
+import smadata2.config
+import smadata2.session
 import smadata2.sma2mon
+from smadata2.inverter import simulator, smabluetooth
 
 
 def test_argparser():
     "Test that the function to generate the argparser doesn't crash"
     ap = smadata2.sma2mon.argparser()
     assert isinstance(ap, argparse.ArgumentParser)
+
+
+def test_session_before_subcommand():
+    "--session doesn't swallow the subcommand name"
+    ap = smadata2.sma2mon.argparser()
+    args = ap.parse_args(["--session", "status"])
+    assert args.session
+    assert args.func is smadata2.sma2mon.status
+    assert args.session_socket == smadata2.session.DEFAULT_SOCKET
+
+
+def test_session_socket():
+    ap = smadata2.sma2mon.argparser()
+    args = ap.parse_args(["--session", "--session-socket", "/tmp/sock",
+                          "download"])
+    assert args.session
+    assert args.func is smadata2.sma2mon.download
+    assert args.session_socket == "/tmp/sock"
+
+
+def test_no_session():
+    ap = smadata2.sma2mon.argparser()
+    args = ap.parse_args(["status"])
+    assert not args.session
+
+
+class OneInverterConfig(object):
+    def __init__(self, inv):
+        self.name = "system"
+        self.invs = [inv]
+
+    def systems(self):
+        return [self]
+
+    def inverters(self):
+        return self.invs
+
+
+class Aborted(BaseException):
+    pass
+
+
+def test_status_results_base_exception():
+    "A result that is a BaseException is reported as an error"
+    config = OneInverterConfig(SimulatedInverterConfig())
+    smadata2.sma2mon.print_status_results(config, [Aborted("aborted")])
+
+
+@raises(asyncio.CancelledError)
+def test_status_results_cancelled():
+    "Cancellation isn't reported as a failure to contact an inverter"
+    config = OneInverterConfig(SimulatedInverterConfig())
+    smadata2.sma2mon.print_status_results(config,
+                                          [asyncio.CancelledError()])
+
+
+class SimulatedInverterConfig(smadata2.config.SMAData2InverterConfig):
+    def __init__(self):
+        invjson = {
+            "bluetooth": "00:80:25:00:00:01",
+            "serial": 2130000001,
+        }
+        super(SimulatedInverterConfig, self).__init__(invjson, "sim")
+        self.sims = []
+
+    def connect(self):
+        sock, sim = simulator.simulate_pair(bdaddr=self.bdaddr,
+                                            serial=self.serial)
+        self.sims.append(sim)
+        return smabluetooth.Connection(self.bdaddr, sock)
+
+
+class TestLiveLink(object):
+    def setUp(self):
+        self.inv = SimulatedInverterConfig()
+        self.link = smadata2.sma2mon.LiveLink([self.inv])
+
+    def tearDown(self):
+        self.link.close()
+
+    def test_poll(self):
+        self.link.poll()
+        self.link.poll()
+        assert_equals(len(self.inv.sims), 1)
+        assert_equals(len(self.link.targets), 1)
+
+    def test_relogon(self):
+        self.link.poll()
+        conn = self.link.conn
+        # Logon about to expire
+        self.link.expiry = time.monotonic()
+        self.link.poll()
+        assert self.link.conn is conn
+        assert_equals(len(self.inv.sims), 1)
+        assert (self.link.expiry >
+                time.monotonic() + smadata2.session.REFRESH_MARGIN)
+
+    def test_reconnect(self):
+        self.link.poll()
+        # Break the link under the connection
+        self.link.conn.sock.shutdown(socket.SHUT_RDWR)
+        self.link.poll()
+        assert_equals(len(self.inv.sims), 2)
+        assert self.link.conn is not None
+        self.link.poll()
+        assert_equals(len(self.inv.sims), 2)